@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  كاش مشترك لإجابات Gemini مع دمج الأسئلة المتطابقة الجارية (Request Coalescing)
+# ==============================================================================
+import os
+import re
+import atexit
+import json
+import time
+import asyncio
+import hashlib
+import threading
+
+from ttl_cache import TTLCache
+from retrieval import normalize_arabic
+
+_WORD = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """تطبيع السؤال للمقارنة: توحيد الحروف وحذف التشكيل وعلامات الترقيم والمسافات الزائدة."""
+    return " ".join(_WORD.findall(normalize_arabic(text)))
+
+
+# كلمات تدل على أن السؤال يكمل ما قبله في المحادثة ("اشرح أكثر"، "وماذا عن ذلك؟"، "أعطني مثالاً آخر")
+_FOLLOW_UP_WORDS = frozenset(normalize_text(
+    "أكثر المزيد آخر أخرى السابق السابقة سابقا ذكرت قلت قلته إجابتك كلامك أكمل تابع وضح وضحه وضحها "
+    "اشرحه اشرحها عنه عنها فيه فيها منه منها ذلك تلك وماذا ولماذا وكيف وهل ومتى وأين فماذا فلماذا فكيف فهل"
+).split())
+
+
+def is_follow_up(normalized, min_words=4):
+    """هل السؤال (بعد normalize_text) سؤال متابعة لا يُفهم بدون المحادثة السابقة؟ الأسئلة القصيرة جداً تُعتبر كذلك."""
+    words = normalized.split()
+    return len(words) < min_words or any(word in _FOLLOW_UP_WORDS for word in words)
+
+
+class AnswerCache:
+    """
+    إجابات Gemini مخزنة (LRU + TTL) بمفتاح: الوضع (عام/كتاب) + آي دي الكتاب ونسخته + السؤال بعد التطبيع.
+    الأسئلة المطابقة التي تصل بينما نفس السؤال قيد التنفيذ تنتظر نفس الطلب بدلاً من تكراره.
+
+    السؤال المستقل له نفس المفتاح مهما سبقه في المحادثة. أما سؤال المتابعة (is_follow_up) فيعتمد على ما قبله،
+    فيدخل في مفتاحه آخر history_turns أسئلة للمستخدم بعد التطبيع، ولا يُخزن إذا كانت history_turns = 0.
+    persist_path اختياري: الكاش يُحفظ على القرص كل persist_every إجابة جديدة ويُحمّل عند التشغيل.
+    """
+
+    def __init__(self, maxsize=5000, ttl=6 * 3600, persist_path=None, persist_every=50, history_turns=1):
+        self._cache = TTLCache(maxsize=maxsize, default_ttl=ttl)
+        self._inflight = {}  # key -> asyncio.Future (كل الطلبات على حلقة engine نفسها)
+        self.persist_path = persist_path
+        self.persist_every = persist_every
+        self.history_turns = history_turns
+        self._unsaved = 0
+        self._save_lock = threading.Lock()
+        self.coalesced = 0
+        self.computed = 0
+        self.bypassed = 0
+        self.follow_ups = 0
+        if persist_path:
+            self._load()
+            atexit.register(self.save)
+
+    def make_key(self, mode, question, chat_history=None, book_id=None, book_version=None):
+        """مفتاح الكاش للسؤال، أو None إذا كان السؤال لا يُخزن (سؤال متابعة مع history_turns = 0)."""
+        normalized = normalize_text(question)
+        history_window = ""
+        if chat_history and is_follow_up(normalized):
+            if not self.history_turns:
+                self.bypassed += 1
+                return None
+            self.follow_ups += 1
+            # أسئلة المستخدم فقط: ردود Gemini تختلف من طلب لآخر فلا تصلح للمفتاح
+            previous = ["".join(part.get("text", "") for part in message.get("parts", []))
+                        for message in chat_history if message.get("role") == "user"]
+            history_window = "\x1e".join(normalize_text(text) for text in previous[-self.history_turns:])
+        parts = [mode, book_id or "", book_version or "", normalized, history_window]
+        return hashlib.sha1("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """الإجابة المخزنة أو None (آمنة من أي خيط)."""
+        if key is None:
+            return None
+        found, answer = self._cache.get(key)
+        return answer if found else None
+
+    async def get_or_compute(self, key, compute, cacheable=lambda answer: True):
+        """
+        الإجابة من الكاش، أو من طلب مطابق جارٍ، أو بتنفيذ compute() (coroutine function).
+        يرجع (الإجابة, المصدر) حيث المصدر "cache" أو "coalesced" أو "gemini".
+        الإجابات التي لا يقبلها cacheable (رسائل الخطأ مثلاً) تُشارك مع المنتظرين لكن لا تُخزن.
+        """
+        if key is None:
+            return await compute(), "gemini"
+        answer = self.lookup(key)
+        if answer is not None:
+            return answer, "cache"
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), "coalesced"
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            answer = await compute()
+            self.computed += 1
+            future.set_result(answer)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # تجنب تحذير "exception was never retrieved" إذا لم يكن هناك منتظرون
+            raise
+        finally:
+            del self._inflight[key]
+
+        if cacheable(answer):
+            self._cache.set(key, answer)
+            self._unsaved += 1
+            if self.persist_path and self._unsaved >= self.persist_every:
+                self._unsaved = 0
+                await asyncio.to_thread(self.save)
+        return answer, "gemini"
+
+    # --------------------------------------------------------------------------
+    #  الحفظ على القرص (اختياري)
+    # --------------------------------------------------------------------------
+    def _load(self):
+        try:
+            with open(self.persist_path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires_at, answer in data.get("entries", []):
+            if expires_at > now:
+                self._cache.set(key, answer, ttl=expires_at - now)
+        print(f"تم تحميل {len(self._cache)} إجابة من كاش الإجابات.")
+
+    def save(self):
+        """حفظ الإجابات الصالحة (كتابة ذرية)."""
+        if not self.persist_path:
+            return
+        now = time.time()
+        entries = [[key, now + remaining, answer] for key, remaining, answer in self._cache.items()]
+        with self._save_lock:
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.persist_path)
+
+    def stats(self):
+        cache_stats = self._cache.stats()
+        saved = cache_stats["hits"] + self.coalesced
+        total = saved + self.computed
+        return {
+            "size": cache_stats["size"],
+            "maxsize": cache_stats["maxsize"],
+            "hits": cache_stats["hits"],
+            "coalesced": self.coalesced,
+            "gemini_calls": self.computed,
+            "gemini_calls_saved": saved,
+            "saved_ratio": round(saved / total, 3) if total else 0.0,
+            "bypassed": self.bypassed,
+            "follow_ups": self.follow_ups,
+            "in_flight": len(self._inflight),
+        }
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  محرك asyncio في الخلفية (طلبات HTTP غير متزامنة + وضع Webhook)
+# ==============================================================================
+import atexit
+import asyncio
+import threading
+
+import aiohttp
+from aiohttp import web
+
+
+class AsyncEngine:
+    """
+    حلقة asyncio تعمل في خيط مستقل. المعالجات المتزامنة (telebot) ترسل إليها العمليات الطويلة
+    (مثل طلبات Gemini) كـ coroutines وتعود فوراً، فيمكن لآلاف الأسئلة أن تكون قيد التنفيذ
+    في نفس الوقت دون حجز خيط لكل سؤال.
+    """
+
+    def __init__(self, max_connections=200):
+        self.max_connections = max_connections
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._runner = None
+        self._thread = threading.Thread(target=self._run_loop, name="async-engine", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # --------------------------------------------------------------------------
+    #  تشغيل coroutines من الكود المتزامن
+    # --------------------------------------------------------------------------
+    def submit(self, coro):
+        """جدولة coroutine على الحلقة دون انتظار. يرجع concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """تشغيل coroutine وانتظار نتيجتها (للاستخدام من الخيوط المتزامنة فقط)."""
+        return self.submit(coro).result(timeout)
+
+    @property
+    def session(self):
+        """جلسة aiohttp مشتركة بمجمع اتصالات (تُنشأ داخل الحلقة عند أول استخدام)."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    # --------------------------------------------------------------------------
+    #  وضع Webhook
+    # --------------------------------------------------------------------------
+    def start_webhook(self, on_update, host="0.0.0.0", port=8443, path="/webhook", secret_token=None):
+        """
+        تشغيل خادم HTTP يستقبل تحديثات تليجرام. on_update تستقبل نص JSON للتحديث
+        ويجب أن تكون سريعة (مثلاً bot.process_new_updates الذي يسلم التحديث لمجمع الخيوط).
+        """
+        async def handle(request):
+            if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+                return web.Response(status=403)
+            on_update(await request.text())
+            return web.Response(text="OK")
+
+        async def start():
+            app = web.Application()
+            app.router.add_post(path, handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+
+        self.run(start())
+
+    def close(self):
+        """إغلاق الجلسة والخادم وإيقاف الحلقة."""
+        if not self.loop.is_running():
+            return
+
+        async def shutdown():
+            if self._runner is not None:
+                await self._runner.cleanup()
+            if self._session is not None and not self._session.closed:
+                await self._session.close()
+
+        try:
+            self.run(shutdown(), timeout=5)
+        except Exception as e:
+            print(f"تحذير: فشل إغلاق المحرك غير المتزامن بشكل نظيف: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
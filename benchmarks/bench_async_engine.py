@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+اختبار حمل: عدد الأسئلة التي يمكن أن تكون قيد التنفيذ في نفس الوقت.
+النموذج القديم: كل سؤال يحجز خيطاً من مجمع خيوط telebot طوال مدة طلب Gemini.
+النموذج الجديد: AsyncEngine ينفذ طلب Gemini وإرسال الرد كـ coroutine (aiohttp).
+الطرفان يستخدمان خوادم Gemini و Telegram وهمية بزمن استجابة محدد.
+
+التشغيل:
+    python benchmarks/bench_async_engine.py [--questions 200] [--workers 8] [--latency 0.5]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from async_engine import AsyncEngine
+from fake_gemini import start_fake_gemini
+from fake_telegram import start_fake_telegram
+
+GEMINI_PATH = "/v1beta/models/gemini-1.5-flash:generateContent?key=k"
+
+
+def payload(i):
+    return {"contents": [{"role": "user", "parts": [{"text": f"سؤال {i}"}]}]}
+
+
+def blocking_question(gemini_url, telegram_url, i):
+    """ما يفعله المعالج القديم: طلب Gemini متزامن ثم sendMessage."""
+    request = urllib.request.Request(gemini_url + GEMINI_PATH, data=json.dumps(payload(i)).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        answer = json.loads(response.read())["candidates"][0]["content"]["parts"][0]["text"]
+    request = urllib.request.Request(f"{telegram_url}/botTOKEN/sendMessage",
+                                     data=json.dumps({"chat_id": i, "text": answer}).encode(),
+                                     headers={"Content-Type": "application/json"})
+    urllib.request.urlopen(request, timeout=30).read()
+
+
+async def async_question(engine, gemini_url, telegram_url, i):
+    async with engine.session.post(gemini_url + GEMINI_PATH, json=payload(i)) as response:
+        answer = (await response.json())["candidates"][0]["content"]["parts"][0]["text"]
+    async with engine.session.post(f"{telegram_url}/botTOKEN/sendMessage", json={"chat_id": i, "text": answer}) as response:
+        await response.read()
+
+
+def run_threads(gemini_url, telegram_url, questions, workers):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        wait([executor.submit(blocking_question, gemini_url, telegram_url, i) for i in range(questions)])
+    return time.perf_counter() - start
+
+
+def run_async(gemini_url, telegram_url, questions):
+    engine = AsyncEngine(max_connections=questions)
+    start = time.perf_counter()
+    futures = [engine.submit(async_question(engine, gemini_url, telegram_url, i)) for i in range(questions)]
+    wait(futures)
+    elapsed = time.perf_counter() - start
+    errors = sum(1 for f in futures if f.exception())
+    engine.close()
+    return elapsed, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8, help="عدد خيوط telebot في النموذج القديم")
+    parser.add_argument("--latency", type=float, default=0.5, help="زمن استجابة Gemini الوهمي بالثواني")
+    args = parser.parse_args()
+
+    gemini, gemini_url, _ = start_fake_gemini(rpm=10 ** 9, latency=args.latency)
+    telegram, telegram_url, _ = start_fake_telegram()
+
+    threaded = run_threads(gemini_url, telegram_url, args.questions, args.workers)
+    asynchronous, errors = run_async(gemini_url, telegram_url, args.questions)
+    print(f"{args.questions} سؤال، زمن Gemini = {args.latency}s")
+    print(f"  خيوط ({args.workers}):  {threaded:.2f}s  ({args.questions / threaded:.1f} سؤال/ث)")
+    print(f"  AsyncEngine:  {asynchronous:.2f}s  ({args.questions / asynchronous:.1f} سؤال/ث) | أخطاء: {errors}")
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+جلسات book_chat على خادم Gemini الوهمي، لكتب بأحجام مختلفة، بأربع طرق:
+- النص كاملاً مع كل سؤال (أقدم طريقة).
+- أجزاء BM25 ضمن ميزانية الاسترجاع مع كل سؤال (الطريقة الحالية بدون كاش).
+- كاش السياق دائماً (ContextCacheManager بدون شرط الكلفة، مع حد API الأدنى 32768 رمزاً: الأصغر يبقى على BM25).
+- كاش السياق عند الحاجة (نفس شرط البوت: الكاش فقط إذا كان أرخص طوال الجلسة من أجزاء الاسترجاع، وإلا أجزاء BM25).
+
+يقيس الرموز المعالجة بالسعر الكامل، ورموز الكاش (cachedContentTokenCount من usageMetadata)، ورموز إنشاء الكاشات،
+ثم الكلفة التقديرية بوحدة "رمز إدخال عادي" = المعالجة + الإنشاء + الكاش × --cached-price
++ رموز الكاشات × --storage-price × مدة CONTEXT_CACHE_IDLE بالساعات (أقل مدة يبقى فيها الكاش مخزناً).
+
+التشغيل:
+    python benchmarks/bench_context_cache.py [--users 20] [--questions 5] [--keys 2] [--pages 10 40 200]
+        [--budget 12000] [--cached-price 0.25] [--storage-price 13.3] [--idle 900]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_cache import ContextCacheManager
+from retrieval import BookIndex
+from fake_gemini import start_fake_gemini
+from bench_retrieval import make_book, QUESTIONS
+
+MODES = (("النص كاملاً", "full"), ("أجزاء BM25", "bm25"), ("كاش دائماً", "cache"), ("كاش عند الحاجة", "gated"))
+
+
+async def ask(session, base_url, key, question, context=None, cached_content=None):
+    """طلب generateContent واحد. يرجع (الحالة, الزمن, usageMetadata)."""
+    if cached_content:
+        body = {"cachedContent": cached_content, "contents": [{"role": "user", "parts": [{"text": f"السؤال: {question}"}]}]}
+    else:
+        prompt = f"--- النص المرجعي ---\n{context}\n--- نهاية النص المرجعي ---\n\nالسؤال: {question}"
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    start = time.perf_counter()
+    async with session.post(f"{base_url}/v1beta/models/m:generateContent?key={key}", json=body) as response:
+        result = await response.json()
+        return response.status, time.perf_counter() - start, result.get("usageMetadata", {})
+
+
+async def run(args, book, mode):
+    server, base_url, state = start_fake_gemini(rpm=10 ** 9, latency=0.05, latency_per_1k_tokens=0.02)
+    index = BookIndex.build(book)
+    keys = [f"key{i}" for i in range(args.keys)]
+    latencies = []
+    usage_totals = {"cached": 0, "cached_per_question": 0}
+    async with aiohttp.ClientSession() as session:
+        # الأسئلة المتوقعة لكل كاش: كل مفتاح له كاشه، والأسئلة موزعة على المفاتيح
+        manager = ContextCacheManager(base_url, "m", lambda: session, ttl=args.idle, idle_timeout=args.idle,
+                                      cached_price=args.cached_price, storage_price=args.storage_price,
+                                      expected_questions=args.users * args.questions // args.keys,
+                                      retrieval_chars=args.budget if mode == "gated" else None)
+
+        async def user(u):
+            manager.touch(u, "book")
+            for q in range(args.questions):
+                key = keys[(u + q) % len(keys)]
+                question = f"{QUESTIONS[(u + q) % len(QUESTIONS)]} (المستخدم {u})"
+                name = await manager.get(key, "book", "v1", lambda: book) if mode in ("cache", "gated") else None
+                context = book if mode == "full" else index.build_context(book, question, char_budget=args.budget)
+                status, elapsed, usage = await ask(session, base_url, key, question, context=context, cached_content=name)
+                assert status == 200, status
+                latencies.append(elapsed)
+                cached = usage.get("cachedContentTokenCount", 0)
+                usage_totals["cached"] += cached
+                usage_totals["cached_per_question"] = max(usage_totals["cached_per_question"], cached)
+            book_id = manager.leave(u)
+            if book_id:
+                await manager.drop_book(book_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(u) for u in range(args.users)))
+        total = time.perf_counter() - start
+    server.shutdown()
+    latencies.sort()
+    processed = state.counters["prompt_tokens"]
+    creation = state.counters["caches_created"] * usage_totals["cached_per_question"]
+    storage = creation * args.storage_price * args.idle / 3600
+    return {
+        "processed_tokens": processed,
+        "cached_tokens": usage_totals["cached"],
+        "creation_tokens": creation,
+        "cost": round(processed + creation + usage_totals["cached"] * args.cached_price + storage),
+        "created": state.counters["caches_created"],
+        "too_small": manager.too_small,
+        "too_costly": manager.too_costly,
+        "p50": latencies[len(latencies) // 2],
+        "total": total,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--keys", type=int, default=2)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 40, 200])
+    parser.add_argument("--budget", type=int, default=12000, help="RETRIEVAL_CHAR_BUDGET")
+    parser.add_argument("--cached-price", type=float, default=0.25, help="CONTEXT_CACHE_PRICE_RATIO")
+    parser.add_argument("--storage-price", type=float, default=13.3, help="CONTEXT_CACHE_STORAGE_PRICE")
+    parser.add_argument("--idle", type=int, default=900, help="CONTEXT_CACHE_IDLE")
+    args = parser.parse_args()
+
+    print(f"{args.users} مستخدم × {args.questions} أسئلة على نفس الكتاب، {args.keys} مفاتيح، "
+          f"ميزانية الاسترجاع {args.budget} حرف، سعر رمز الكاش {args.cached_price}")
+    for pages in args.pages:
+        book = make_book(pages)
+        print(f"\n{pages} صفحة ({len(book):,} حرف)")
+        print(f"{'':>16} | {'رموز معالجة':>12} | {'رموز من الكاش':>13} | {'رموز الإنشاء':>12} | {'الكلفة':>10} | "
+              f"{'كاشات':>6} | {'p50 (s)':>8} | {'الكل (s)':>8}")
+        for label, mode in MODES:
+            r = asyncio.run(run(args, book, mode))
+            note = (" (أغلى من الاسترجاع: أجزاء BM25)" if r["too_costly"] else
+                    " (أصغر من حد API: أجزاء BM25)" if r["too_small"] else "")
+            print(f"{label:>16} | {r['processed_tokens']:>12,} | {r['cached_tokens']:>13,} | {r['creation_tokens']:>12,} | "
+                  f"{r['cost']:>10,} | {r['created']:>6} | {r['p50']:>8.2f} | {r['total']:>8.2f}{note}")
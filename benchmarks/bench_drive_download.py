@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+ذروة الذاكرة أثناء تحميل كتاب من Drive: الطريقة القديمة (الملف كاملاً في io.BytesIO ثم نسخة مؤقتة على القرص)
+مقابل DriveDownloader (أجزاء مباشرة إلى القرص + تحقق md5)، مع خادم Drive وهمي وأحجام كتب مختلفة.
+الذروة من tracemalloc وتشمل مخزن الرد في الخادم الوهمي (نفس العملية)، لذلك هي تقريبية لكن المقارنة عادلة.
+
+التشغيل:
+    python benchmarks/bench_drive_download.py [--sizes-mb 16 64 128] [--chunk-mb 8] [--error-rate 0.05]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from drive_download import DriveDownloader
+from fake_drive import start_fake_drive
+
+
+def fetch_range(base_url, file_id):
+    def fetch(start, end):
+        request = urllib.request.Request(f"{base_url}/drive/v3/files/{file_id}?alt=media",
+                                         headers={"Range": f"bytes={start}-{end}"})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.read()
+    return fetch
+
+
+def run_legacy(base_url, file_id, directory):
+    file_io = io.BytesIO()
+    with urllib.request.urlopen(f"{base_url}/drive/v3/files/{file_id}?alt=media", timeout=60) as response:
+        file_io.write(response.read())
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp:
+        tmp.write(file_io.getbuffer())
+    return tmp.name
+
+
+def run_streamed(downloader, base_url, state, file_id):
+    meta = state.files[file_id]["meta"]
+    return downloader.download(meta["md5Checksum"], fetch_range(base_url, file_id),
+                               size=int(meta["size"]), md5=meta["md5Checksum"], suffix=".txt")
+
+
+def measure(task):
+    tracemalloc.start()
+    started = time.perf_counter()
+    task()
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / (1024 * 1024), 1), round(seconds, 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--chunk-mb", type=float, default=8)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="نسبة أخطاء 503 من الخادم (لتجربة الاستئناف)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_drive_")
+    try:
+        for size_mb in args.sizes_mb:
+            server, base_url, state = start_fake_drive(error_rate=args.error_rate)
+            file_id = f"book-{size_mb}"
+            state.add_book(file_id, f"{file_id}.txt", "سطر من نص الكتاب التجريبي.\n" * (size_mb * 1024 * 1024 // 50))
+            downloader = DriveDownloader(os.path.join(directory, str(size_mb)), chunk_size=int(args.chunk_mb * 1024 * 1024),
+                                         max_bytes=0)
+            streamed = measure(lambda: run_streamed(downloader, base_url, state, file_id))
+            state.error_rate = 0.0
+            legacy = measure(lambda: run_legacy(base_url, file_id, directory))
+            server.shutdown()
+            print(f"{size_mb:>5} MB: BytesIO peak={legacy[0]} MB ({legacy[1]}s) | "
+                  f"DriveDownloader peak={streamed[0]} MB ({streamed[1]}s) {downloader.stats()}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
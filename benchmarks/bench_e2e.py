@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+"""
+اختبار حمل شامل (End-to-End): main.py الحقيقي بكل معالجاته، مع خوادم Telegram و Gemini و Drive وهمية محلية.
+
+كل مستخدم وهمي يعيد سيناريو واقعياً عبر نفس مدخل الـ Webhook (process_webhook_update):
+/start ← "بحث في المصادر" ← اختيار كتاب ← أسئلة (بعضها موجود في قاعدة المعرفة KB وبعضها يذهب لـ Gemini)،
+ونسبة من المستخدمين تستخدم "بحث عام" بدلاً من الكتب. زمن كل خطوة يُقاس من إرسال التحديث حتى وصول
+الرد المتوقع لخادم Telegram الوهمي (مثلاً رسالة الإجابة المنسقة بـ Markdown).
+
+النتيجة: الإنتاجية، p50/p95/p99 لكل نوع خطوة، استهلاك المعالج والذاكرة (للعملية كلها، بما فيها الخوادم الوهمية)،
+وأزمنة المراحل من مقاييس البوت نفسه. تُحفظ بصيغة JSON للمقارنة بين الإصدارات (--compare).
+
+مع --workers N يُشغل main.py كعملية منفصلة بوضع العمال (BOT_WORKERS=N) وتُرسل التحديثات لعمليته الأمامية
+عبر HTTP، وتُجمع أزمنة المراحل من /metrics لكل عامل، والموارد تشمل كل العمليات.
+
+التشغيل:
+    python benchmarks/bench_e2e.py [--users 50] [--questions 5] [--kb-hit-ratio 0.5] [--gemini-latency 0.5]
+        [--telegram-429-rate 0.01] [--drive-error-rate 0.0] [--workers 4] [--output results.json] [--compare old.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+from key_pool import percentile
+from metrics import bucket_quantile
+from fake_gemini import start_fake_gemini
+from fake_telegram import start_fake_telegram
+from fake_drive import start_fake_drive
+from bench_retrieval import make_book
+
+SCHEMA_VERSION = 1
+BOT_ID = 1000000
+KB_QUESTIONS = [f"ما هي الفكرة الرئيسية رقم {i + 1} في هذا الكتاب؟" for i in range(10)]
+TOPIC_WORDS = ["الخلية", "الطاقة", "الضوء", "الحركة", "الذرة", "المادة", "الصوت", "الحرارة"]
+# أسئلة شائعة يسألها مستخدمون كثيرون عن نفس الكتاب (غالباً بعد أسئلة أخرى، أي مع سجل محادثة)
+COMMON_QUESTIONS = [f"اشرح العلاقة بين {a} و{b} بالتفصيل" for a, b in zip(TOPIC_WORDS, TOPIC_WORDS[1:])][:5]
+
+# الرد المتوقع لكل خطوة: (method, params) -> هل هذا هو الرد الذي ينتظره المستخدم؟
+EXPECTED_REPLY = {
+    "start": lambda m, p: m == "sendMessage" and "search_books" in p.get("reply_markup", ""),
+    "menu": lambda m, p: m in ("editMessageText", "sendMessage") and "book:" in p.get("reply_markup", ""),
+    "general_chat": lambda m, p: m in ("editMessageText", "sendMessage") and "البحث العام" in p.get("text", ""),
+    "select_book": lambda m, p: m == "sendMessage" and '"keyboard"' in p.get("reply_markup", ""),
+    "question": lambda m, p: m in ("sendMessage", "editMessageText") and p.get("parse_mode") == "Markdown",
+}
+
+
+def kb_responder(prompt):
+    """طلبات توليد قاعدة المعرفة تحصل على JSON صالح، حتى تكون أسئلة KB_QUESTIONS موجودة في KB كل كتاب."""
+    if "أخرج القائمة بصيغة JSON" not in prompt:
+        return None
+    entries = [{"standard_question": q, "answer": f"إجابة من قاعدة المعرفة: {q}"} for q in KB_QUESTIONS]
+    return "```json\n" + json.dumps(entries, ensure_ascii=False) + "\n```"
+
+
+# ==============================================================================
+#  تحديثات Telegram الوهمية
+# ==============================================================================
+class UpdateFactory:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 1
+
+    def _id(self):
+        with self._lock:
+            self._next += 1
+            return self._next
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"مستخدم{uid}", "username": f"user{uid}"}
+
+    def message(self, uid, text):
+        message = {"message_id": self._id(), "from": self._user(uid), "date": int(time.time()), "text": text,
+                   "chat": {"id": uid, "type": "private", "first_name": f"مستخدم{uid}"}}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._id(), "message": message}
+
+    def callback(self, uid, data):
+        message = {"message_id": self._id(), "date": int(time.time()), "text": "...",
+                   "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot"},
+                   "chat": {"id": uid, "type": "private", "first_name": f"مستخدم{uid}"}}
+        return {"update_id": self._id(), "callback_query": {"id": str(self._id()), "from": self._user(uid),
+                                                            "chat_instance": str(uid), "data": data, "message": message}}
+
+
+# ==============================================================================
+#  المستخدم الوهمي
+# ==============================================================================
+class SimulatedUser:
+    def __init__(self, uid, deliver, telegram_state, updates, args, books, results):
+        self.uid = uid
+        self.deliver = deliver  # تسليم التحديث للبوت (process_webhook_update أو POST للعملية الأمامية)
+        self.telegram = telegram_state
+        self.updates = updates
+        self.args = args
+        self.books = books
+        self.results = results
+        self.rng = random.Random(uid)
+
+    def step(self, kind, update):
+        """إرسال تحديث وانتظار الرد المتوقع. يرجع params الرد أو None عند انتهاء المهلة."""
+        since = self.telegram.mark(self.uid)
+        started = time.monotonic()
+        self.deliver(update)
+        ack_at, _ = self.telegram.wait_for(self.uid, since, lambda m, p: m in ("sendMessage", "editMessageText"),
+                                           timeout=self.args.timeout)
+        replied_at, index = self.telegram.wait_for(self.uid, since, EXPECTED_REPLY["question" if kind.startswith("question") else kind],
+                                                   timeout=self.args.timeout)
+        with self.telegram.lock:
+            params = self.telegram.events[str(self.uid)][index - 1][2] if replied_at else None
+        self.results.record(kind, started, ack_at, replied_at, params)
+        return params
+
+    def think(self):
+        if self.args.think:
+            time.sleep(self.rng.uniform(0.5, 1.5) * self.args.think)
+
+    def run(self):
+        if self.step("start", self.updates.message(self.uid, "/start")) is None:
+            return
+        self.think()
+        if self.rng.random() < self.args.general_ratio:
+            if self.step("general_chat", self.updates.callback(self.uid, "general_chat")) is None:
+                return
+            kinds = ["question_general"] * self.args.questions
+        else:
+            if self.step("menu", self.updates.callback(self.uid, "search_books")) is None:
+                return
+            self.think()
+            book_id = self.rng.choice(self.books)
+            reply = self.step("select_book", self.updates.callback(self.uid, f"book:{book_id}"))
+            if reply is None or not reply.get("text", "").startswith("✅"):
+                return
+            kinds = ["question_kb_hit" if self.rng.random() < self.args.kb_hit_ratio else "question_kb_miss"
+                     for _ in range(self.args.questions)]
+        for n, kind in enumerate(kinds):
+            self.think()
+            if kind == "question_kb_hit":
+                text = self.rng.choice(KB_QUESTIONS)
+            elif self.rng.random() < self.args.repeat_ratio:
+                text = self.rng.choice(COMMON_QUESTIONS)
+            else:  # سؤال فريد حتى لا يُجاب من كاش الإجابات
+                text = f"اشرح العلاقة بين {self.rng.choice(TOPIC_WORDS)} و{self.rng.choice(TOPIC_WORDS)} (سؤال {self.uid}-{n})"
+            self.step(kind, self.updates.message(self.uid, text))
+
+
+class Results:
+    def __init__(self, failure_replies):
+        self.failure_replies = failure_replies
+        self.lock = threading.Lock()
+        self.steps = []  # (النوع, زمن أول رد, زمن الرد المتوقع, حالة)
+
+    def record(self, kind, started, ack_at, replied_at, params):
+        if replied_at is None:
+            status = "timeout"
+        elif params.get("text") in self.failure_replies:
+            status = "failed_reply"
+        else:
+            status = "ok"
+        with self.lock:
+            self.steps.append((kind, ack_at - started if ack_at else None,
+                               replied_at - started if replied_at else None, status))
+
+    def summary(self):
+        kinds = {}
+        for kind, ack, latency, status in self.steps:
+            entry = kinds.setdefault(kind, {"count": 0, "ok": 0, "timeout": 0, "failed_reply": 0, "_lat": [], "_ack": []})
+            entry["count"] += 1
+            entry[status] += 1
+            if status == "ok":
+                entry["_lat"].append(latency)
+            if ack is not None:
+                entry["_ack"].append(ack)
+        for entry in kinds.values():
+            latencies, acks = sorted(entry.pop("_lat")), sorted(entry.pop("_ack"))
+            entry.update({f"p{p}": percentile(latencies, p) for p in (50, 95, 99)})
+            entry["max"] = round(latencies[-1], 3) if latencies else None
+            entry["ack_p50"] = percentile(acks, 50)
+            entry["ack_p95"] = percentile(acks, 95)
+        return kinds
+
+
+# ==============================================================================
+#  استهلاك الموارد
+# ==============================================================================
+def descendant_pids(pid):
+    """كل العمليات المتفرعة من pid (العملية الأمامية وعمالها) من /proc."""
+    result, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                children = [int(child) for child in f.read().split()]
+        except (OSError, ValueError):
+            children = []
+        result.extend(children)
+        pending.extend(children)
+    return result
+
+
+def process_cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ResourceSampler:
+    """
+    عينات دورية من ذاكرة العملية (RSS) وعدد الخيوط، وزمن المعالج الكلي.
+    child_pid اختياري: عملية البوت المنفصلة (--workers)، فتُضاف ذاكرتها ومعالجها مع كل عمالها.
+    """
+
+    def __init__(self, interval=0.5, child_pid=None):
+        self.interval = interval
+        self.child_pid = child_pid
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self._child_cpu = {}  # pid -> (أول قراءة, آخر قراءة)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    @staticmethod
+    def rss_bytes(pid="self"):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return 0
+
+    def _children(self):
+        return [self.child_pid] + descendant_pids(self.child_pid) if self.child_pid else []
+
+    def _sample_children(self):
+        rss = 0
+        for pid in self._children():
+            rss += self.rss_bytes(pid)
+            cpu = process_cpu_seconds(pid)
+            if cpu is not None:
+                first, _ = self._child_cpu.get(pid, (cpu, cpu))
+                self._child_cpu[pid] = (first, cpu)
+        return rss
+
+    def _total_rss(self):
+        return self.rss_bytes() + self._sample_children()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self._total_rss())
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self._cpu = os.times()
+        self._wall = time.monotonic()
+        self.start_rss = self._total_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        end_rss = self._total_rss()
+        cpu = os.times()
+        wall = time.monotonic() - self._wall
+        used = (cpu.user - self._cpu.user) + (cpu.system - self._cpu.system)
+        used += sum(last - first for first, last in self._child_cpu.values())
+        self.result = {
+            "cpu_seconds": round(used, 2),
+            "cpu_percent": round(used / wall * 100, 1) if wall else 0.0,
+            "start_rss_mb": round(self.start_rss / 2 ** 20, 1),
+            "peak_rss_mb": round(max(self.peak_rss, end_rss) / 2 ** 20, 1),
+            "peak_threads": self.peak_threads,
+        }
+
+
+# ==============================================================================
+#  التشغيل
+# ==============================================================================
+def configure_environment(args, telegram_url, gemini_url, drive_url):
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": f"{BOT_ID}:BENCH", "LOG_BOT_TOKEN": "2:BENCHLOG", "LOG_CHAT_ID": "-100",
+        "API_KEYS": ",".join(f"bench-key-{i}" for i in range(args.keys)),
+        "TELEGRAM_API_URL": telegram_url, "GEMINI_API_BASE": gemini_url,
+        "DRIVE_API_ENDPOINT": f"{drive_url}/drive/v3/", "DRIVE_FOLDER_ID": "folder",
+        "BOT_MODE": "webhook", "METRICS_PORT": "0", "ADMIN_IDS": "",
+        "COOLDOWN_SECONDS": str(args.cooldown), "RATE_LIMIT_FILE": "", "ANSWER_CACHE_FILE": "",
+        "GEMINI_KEY_RPM": str(args.key_rpm), "STREAM_RESPONSES": "1" if args.stream else "0",
+    })
+
+
+STAGES = ("book_content_seconds", "drive_download_seconds", "kb_build_seconds", "kb_match_seconds",
+          "gemini_key_wait_seconds", "gemini_attempt_seconds", "membership_check_seconds",
+          "telegram_queue_seconds", "telegram_send_seconds")
+
+
+def stage_metrics(bot_module):
+    """p50/p95 وعدد القياسات لكل مرحلة من مقاييس البوت (metrics.py)."""
+    stages = {}
+    for name in STAGES:
+        histogram = getattr(bot_module, name)
+        count = sum(total for _, _, total in histogram.series().values())
+        q50, q95 = histogram.quantile(0.5), histogram.quantile(0.95)
+        stages[name] = {"count": count, "p50": round(q50, 4) if q50 is not None else None,
+                        "p95": round(q95, 4) if q95 is not None else None}
+    return stages
+
+
+def scrape_stage_metrics(bot_module, ports):
+    """نفس stage_metrics لكن من نص /metrics لكل عامل (وضع --workers)، بجمع أعداد الحدود من كل العمال."""
+    lines = []
+    for port in ports:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                lines.extend(response.read().decode("utf-8").splitlines())
+        except OSError as e:
+            print(f"تعذر قراءة مقاييس العامل على المنفذ {port}: {e}")
+    stages = {}
+    for name in STAGES:
+        histogram = getattr(bot_module, name)
+        cumulative, total = [0] * len(histogram.buckets), 0
+        for line in lines:
+            if not line.startswith(f"{histogram.name}_bucket{{"):
+                continue
+            labels, _, value = line.rpartition(" ")
+            bound = labels.rsplit('le="', 1)[1].split('"', 1)[0]
+            if bound == "+Inf":
+                total += int(value)
+            else:
+                cumulative[histogram.buckets.index(float(bound))] += int(value)
+        q50 = bucket_quantile(0.5, histogram.buckets, cumulative, total)
+        q95 = bucket_quantile(0.95, histogram.buckets, cumulative, total)
+        stages[name] = {"count": total, "p50": round(q50, 4) if q50 is not None else None,
+                        "p95": round(q95, 4) if q95 is not None else None}
+    return stages
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_bot_process(args, workdir):
+    """
+    تشغيل main.py كعملية منفصلة بوضع العمال. يرجع (العملية، دالة تسليم التحديثات، منافذ مقاييس العمال).
+    التحديثات تُرسل للعملية الأمامية عبر Webhook كما يرسلها تليجرام.
+    """
+    front_port, metrics_port, worker_port = free_port(), free_port(), free_port()
+    secret = "bench-secret"
+    env = dict(os.environ, BOT_WORKERS=str(args.workers), WEBHOOK_URL=f"http://127.0.0.1:{front_port}/hook",
+               WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(front_port), WEBHOOK_SECRET=secret,
+               METRICS_PORT=str(metrics_port), WORKER_BASE_PORT=str(worker_port))
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "main.py")], cwd=workdir, env=env)
+
+    def deliver(update):
+        request = urllib.request.Request(f"http://127.0.0.1:{front_port}/hook", data=json.dumps(update).encode("utf-8"),
+                                         headers={"Content-Type": "application/json",
+                                                  "X-Telegram-Bot-Api-Secret-Token": secret})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    # انتظار العملية الأمامية والعمال (العامل الجاهز يفتح منفذ مقاييسه)
+    deadline = time.monotonic() + 60
+    pending = {front_port} | {metrics_port + i for i in range(args.workers)}
+    while pending and time.monotonic() < deadline:
+        for port in list(pending):
+            with socket.socket() as sock:
+                if sock.connect_ex(("127.0.0.1", port)) == 0:
+                    pending.discard(port)
+        time.sleep(0.2)
+    if pending:
+        process.terminate()
+        raise RuntimeError(f"البوت لم يبدأ خلال المهلة (منافذ غير جاهزة: {sorted(pending)})")
+    return process, deliver, [metrics_port + i for i in range(args.workers)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    telegram, telegram_url, telegram_state = start_fake_telegram(latency=args.telegram_latency,
+                                                                 error_rate=args.telegram_429_rate)
+    gemini, gemini_url, gemini_state = start_fake_gemini(rpm=10 ** 9, latency=args.gemini_latency,
+                                                         latency_jitter=args.gemini_jitter, error_rate=args.gemini_error_rate,
+                                                         answer_chars=args.answer_chars, responder=kb_responder)
+    drive, drive_url, drive_state = start_fake_drive(latency=args.drive_latency, error_rate=args.drive_error_rate,
+                                                     bandwidth=args.drive_bandwidth)
+    books = []
+    for i in range(args.books):
+        book_id = f"book{i}"
+        drive_state.add_book(book_id, f"كتاب تجريبي {i + 1}.txt", make_book(args.book_pages, seed=i))
+        books.append(book_id)
+
+    configure_environment(args, telegram_url, gemini_url, drive_url)
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.chdir(workdir)  # قواعد البيانات وكاش الكتب وقواعد المعرفة تُنشأ هنا وليس في المستودع
+    import main as bot_module  # في وضع --workers يُستخدم فقط لأسماء المقاييس والردود الثابتة
+    process, metrics_ports = None, None
+    if args.workers:
+        process, deliver, metrics_ports = start_bot_process(args, workdir)
+    else:
+        bot_module.kb_store.start()
+        bot_module.book_catalog.start()
+        deliver = bot_module.process_webhook_update
+
+    results = Results(set(bot_module.GEMINI_FAILURE_REPLIES))
+    updates = UpdateFactory()
+    users = [SimulatedUser(10_000 + u, deliver, telegram_state, updates, args, books, results) for u in range(args.users)]
+    threads = [threading.Thread(target=user.run, daemon=True) for user in users]
+    with ResourceSampler(child_pid=process.pid if process else None) as resources:
+        started = time.monotonic()
+        for i, thread in enumerate(threads):
+            thread.start()
+            if args.ramp and i < len(threads) - 1:
+                time.sleep(args.ramp / len(threads))
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+    stages = scrape_stage_metrics(bot_module, metrics_ports) if process else stage_metrics(bot_module)
+    if process:
+        process.terminate()  # العملية الأمامية توقف عمالها عند الخروج
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    steps = results.summary()
+    answered = sum(entry["ok"] for kind, entry in steps.items() if kind.startswith("question"))
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "label": args.label,
+        "git_commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "elapsed_seconds": round(elapsed, 2),
+        "throughput": {
+            "steps_per_second": round(len(results.steps) / elapsed, 2),
+            "questions_answered_per_second": round(answered / elapsed, 2),
+        },
+        "steps": steps,
+        "resources": resources.result,
+        "stages": stages,
+        "stand_ins": {
+            "telegram_calls": dict(telegram_state.calls), "telegram_429": telegram_state.rejected,
+            "gemini": dict(gemini_state.counters), "drive": dict(drive_state.counters),
+        },
+        "bot": None if process else {"send_queue": bot_module.send_queue.stats(),
+                                     "answer_cache": bot_module.answer_cache.stats()},
+    }
+
+
+def print_report(report):
+    print(f"\n{report['config']['users']} مستخدم | {report['elapsed_seconds']}s | "
+          f"{report['throughput']['steps_per_second']} خطوة/ث | {report['throughput']['questions_answered_per_second']} إجابة/ث")
+    print(f"{'الخطوة':>18} | {'العدد':>6} | {'نجاح':>5} | {'مهلة':>5} | {'فشل':>4} | {'p50':>7} | {'p95':>7} | {'p99':>7} | {'أول رد p50':>10}")
+    for kind, e in sorted(report["steps"].items()):
+        p50, p95, p99, ack = (str(e[k]) if e[k] is not None else "-" for k in ("p50", "p95", "p99", "ack_p50"))
+        print(f"{kind:>18} | {e['count']:>6} | {e['ok']:>5} | {e['timeout']:>5} | {e['failed_reply']:>4} | "
+              f"{p50:>7} | {p95:>7} | {p99:>7} | {ack:>10}")
+    r = report["resources"]
+    print(f"المعالج: {r['cpu_seconds']}s ({r['cpu_percent']}%) | الذاكرة: {r['start_rss_mb']} ← {r['peak_rss_mb']} MB | "
+          f"أقصى عدد خيوط: {r['peak_threads']}")
+    if report["bot"]:
+        print("كاش الإجابات:", report["bot"]["answer_cache"])
+    print("المراحل (p50/p95):", ", ".join(f"{name}={s['p50']}/{s['p95']} ({s['count']})"
+                                          for name, s in report["stages"].items() if s["count"]))
+
+
+def compare(old, new):
+    """مقارنة أهم الأرقام بين تقريرين (مثلاً إصدار سابق والحالي)."""
+    rows = [("إجابة/ث", ("throughput", "questions_answered_per_second")),
+            ("خطوة/ث", ("throughput", "steps_per_second")),
+            ("أقصى ذاكرة MB", ("resources", "peak_rss_mb")),
+            ("المعالج %", ("resources", "cpu_percent"))]
+    for kind in sorted(set(old["steps"]) | set(new["steps"])):
+        for p in ("p50", "p95", "p99"):
+            rows.append((f"{kind} {p}", ("steps", kind, p)))
+
+    def lookup(report, path):
+        for key in path:
+            report = report.get(key) if isinstance(report, dict) else None
+        return report
+
+    print(f"\nمقارنة: {old.get('label') or old.get('git_commit')} ← {new.get('label') or new.get('git_commit')}")
+    for title, path in rows:
+        a, b = lookup(old, path), lookup(new, path)
+        change = f"{(b - a) / a * 100:+.1f}%" if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a else ""
+        print(f"{title:>28} | {a!s:>10} | {b!s:>10} | {change:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="اختبار حمل شامل لـ main.py مع خوادم وهمية")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=5, help="عدد الأسئلة لكل مستخدم")
+    parser.add_argument("--kb-hit-ratio", type=float, default=0.5, help="نسبة الأسئلة الموجودة في قاعدة المعرفة")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0,
+                        help="نسبة الأسئلة غير الموجودة في KB التي تُختار من أسئلة شائعة (لقياس كاش الإجابات)")
+    parser.add_argument("--general-ratio", type=float, default=0.2, help="نسبة المستخدمين في البحث العام")
+    parser.add_argument("--think", type=float, default=1.0, help="متوسط زمن التفكير بين خطوات المستخدم (ثوانٍ)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="توزيع بدء المستخدمين على هذه المدة (ثوانٍ)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="أقصى انتظار لرد خطوة واحدة")
+    parser.add_argument("--cooldown", type=int, default=0, help="COOLDOWN_SECONDS للبوت أثناء الاختبار")
+    parser.add_argument("--books", type=int, default=3)
+    parser.add_argument("--book-pages", type=int, default=60)
+    parser.add_argument("--keys", type=int, default=4, help="عدد مفاتيح Gemini")
+    parser.add_argument("--key-rpm", type=int, default=1000, help="GEMINI_KEY_RPM للبوت")
+    parser.add_argument("--stream", type=int, default=1, help="STREAM_RESPONSES (1/0)")
+    parser.add_argument("--gemini-latency", type=float, default=0.5)
+    parser.add_argument("--gemini-jitter", type=float, default=0.5)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-429-rate", type=float, default=0.0)
+    parser.add_argument("--drive-latency", type=float, default=0.05)
+    parser.add_argument("--drive-error-rate", type=float, default=0.0)
+    parser.add_argument("--drive-bandwidth", type=int, default=0, help="بايت/ثانية لتحميل الكتب (0 = بدون حد)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="تشغيل البوت كعملية منفصلة بهذا العدد من العمال (0 = داخل نفس العملية)")
+    parser.add_argument("--label", default="", help="اسم للتشغيل (مثلاً رقم الإصدار)")
+    parser.add_argument("--output", help="مسار ملف JSON للنتائج (افتراضياً benchmarks/results/e2e_<الوقت>.json)")
+    parser.add_argument("--compare", help="ملف نتائج سابق للمقارنة معه")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(BENCH_DIR, "results", f"e2e_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+
+    report = run(args)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report)
+    print(f"\nتم حفظ النتائج في {output}")
+    if previous:
+        compare(previous, report)
+    os._exit(0)  # خيوط البوت الخلفية (polling/flush) لا تحتاج لإغلاق منظم في نهاية الاختبار
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة زمن الرد عند وجود طلبات عالقة: مهلة ثابتة مع إعادة المحاولة بالتتابع (الطريقة القديمة)
+مقابل مهلات متكيفة من زمن المفتاح + طلب احتياطي على مفتاح آخر (LatencyTracker / HedgeBudget / HedgeRace)،
+باستخدام خادم Gemini وهمي يحقن نسبة من الطلبات البطيئة.
+
+التشغيل:
+    python benchmarks/bench_hedging.py [--requests 300] [--concurrency 8] [--slow-rate 0.03] [--slow-latency 5]
+
+ملاحظة: الطلبات هنا عبر urllib في خيوط (aiohttp غير مطلوب للتجربة)، فالطلب الخاسر يُهمل ولا يُقطع اتصاله؛
+في البوت يُلغى طلب aiohttp الخاسر فعلاً.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from key_pool import KeyPool, percentile
+from hedging import LatencyTracker, HedgeBudget, HedgeRace
+from fake_gemini import start_fake_gemini
+
+KEYS = ["fake-key-aaaa-0001", "fake-key-bbbb-0002", "fake-key-cccc-0003"]
+FIXED_TIMEOUT = 120.0
+MAX_RETRIES = 3
+
+
+def post(base_url, key, timeout):
+    """طلب generateContent واحد. يرجع ("ok"|"retry"|"error", رمز الحالة)."""
+    body = json.dumps({"contents": [{"role": "user", "parts": [{"text": "ما هو التعريف؟"}]}]}).encode()
+    request = urllib.request.Request(
+        f"{base_url}/v1beta/models/gemini-1.5-flash:generateContent?key={key}",
+        data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return "ok", response.status
+    except urllib.error.HTTPError as e:
+        return "retry", e.code
+    except OSError:
+        return "error", None  # انتهاء المهلة أو خطأ اتصال
+
+
+class Runner:
+    def __init__(self, base_url, hedged, percentile_timeout=99, multiplier=3, hedge_percentile=95, budget=0.1):
+        self.base_url = base_url
+        self.hedged = hedged
+        self.pool = KeyPool(KEYS, rpm=100000)
+        self.latency = LatencyTracker(min_samples=20)
+        self.budget = HedgeBudget(budget, burst=5)
+        self.percentile_timeout = percentile_timeout
+        self.multiplier = multiplier
+        self.hedge_percentile = hedge_percentile
+        self.executor = ThreadPoolExecutor(max_workers=64)
+        self.counters = {"ok": 0, "failed": 0, "attempts": 0, "hedges_fired": 0, "hedges_won": 0}
+
+    async def attempt(self, lease):
+        timeout = FIXED_TIMEOUT
+        if self.hedged:
+            timeout = self.latency.timeout(lease.label, "response", self.percentile_timeout, self.multiplier, 1.0, FIXED_TIMEOUT)
+        started = time.perf_counter()
+        self.counters["attempts"] += 1
+        try:
+            outcome, status = await asyncio.get_running_loop().run_in_executor(
+                self.executor, post, self.base_url, lease.key, timeout)
+        finally:
+            self.pool.release(lease)
+        if outcome == "ok":
+            self.latency.record(lease.label, "response", time.perf_counter() - started)
+        return outcome, status
+
+    async def one(self):
+        for _ in range(MAX_RETRIES):
+            lease = await self.pool.acquire_async(estimated_tokens=50, timeout=60)
+            race = HedgeRace(succeeded=lambda result: result[0] == "ok")
+
+            def start_hedge(primary_key=lease.key):
+                if not self.budget.try_spend():
+                    return None
+                hedge_lease = self.pool.try_acquire(50, exclude={primary_key})
+                if hedge_lease is None:
+                    self.budget.refund()
+                    return None
+                return self.attempt(hedge_lease)
+
+            delay = None
+            if self.hedged:
+                self.budget.earn()
+                observed = self.latency.percentile(lease.label, "response", self.hedge_percentile)
+                delay = max(0.05, observed) if observed is not None else 1.0
+            outcome, _ = await race.run(self.attempt(lease), start_hedge, delay)
+            self.counters["hedges_fired"] += race.hedge_fired
+            self.counters["hedges_won"] += race.hedge_won
+            if outcome == "ok":
+                self.counters["ok"] += 1
+                return
+        self.counters["failed"] += 1
+
+    async def run(self, n_requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        durations = []
+
+        async def timed():
+            async with semaphore:
+                started = time.perf_counter()
+                await self.one()
+                durations.append(time.perf_counter() - started)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed() for _ in range(n_requests)))
+        self.executor.shutdown(wait=False)
+        durations.sort()
+        result = dict(self.counters, elapsed=round(time.perf_counter() - start, 2))
+        for pct in (50, 95, 99):
+            result[f"p{pct}"] = round(percentile(durations, pct), 3)
+        result["max"] = round(durations[-1], 3)
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.03)
+    parser.add_argument("--slow-latency", type=float, default=5.0)
+    parser.add_argument("--budget", type=float, default=0.1)
+    args = parser.parse_args()
+
+    for name, hedged in (("fixed timeout + retries", False), ("adaptive + hedged", True)):
+        server, base_url, state = start_fake_gemini(rpm=100000, latency=args.latency, latency_jitter=args.jitter,
+                                                    slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+        result = asyncio.run(Runner(base_url, hedged, budget=args.budget).run(args.requests, args.concurrency))
+        server.shutdown()
+        print(f"{name:>24}: {result} (slow injected: {state.counters['slow']})")
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة مطابقة أسئلة قاعدة المعرفة: process.extractOne مع token_sort_ratio (الطريقة القديمة)
+مقابل KBMatcher (مصفوفات NumPy + إعادة ترتيب أفضل المرشحين)، لقواعد من 20 إلى 20,000 إدخال.
+يقيس الزمن لكل سؤال، ونسبة الاتفاق في قرار حد التطابق 85%.
+
+التشغيل:
+    python benchmarks/bench_kb_matcher.py [--sizes 20 200 2000 20000] [--queries 100]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+from fuzzywuzzy import fuzz, process
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kb_matcher import KBMatcher
+
+SUBJECTS = ["قاعدة البيانات", "المفتاح الأساسي", "الجدول", "الاستعلام", "الفهرس", "المعاملة", "التطبيع",
+            "الخوارزمية", "المصفوفة", "القائمة المترابطة", "الشجرة الثنائية", "الذاكرة", "المعالج", "الشبكة"]
+TEMPLATES = ["ما هو تعريف {s} في {t}؟", "اشرح مفهوم {s} مع مثال من {t}", "ما الفرق بين {s} و {t}؟",
+             "ما هي أنواع {s} المستخدمة في {t}؟", "كيف يتم استخدام {s} داخل {t}؟", "ما فوائد {s} بالنسبة إلى {t}؟"]
+THRESHOLD = 85
+
+
+def make_kb(size, rng):
+    questions = set()
+    while len(questions) < size:
+        s, t = rng.sample(SUBJECTS, 2)
+        questions.add(rng.choice(TEMPLATES).format(s=s, t=t) + f" ({rng.randint(1, size)})" * (size > 500))
+    return [{"standard_question": q, "answer": f"إجابة {i}"} for i, q in enumerate(sorted(questions))]
+
+
+def perturb(question, rng):
+    """صيغة مختلفة قليلاً لنفس السؤال: تبديل كلمات، حذف علامة الاستفهام، تشكيل، أو خطأ إملائي."""
+    words = question.replace("؟", "").split()
+    choice = rng.random()
+    if choice < 0.3 and len(words) > 3:
+        i = rng.randrange(len(words) - 1)
+        words[i], words[i + 1] = words[i + 1], words[i]
+    elif choice < 0.6:
+        words = [w.replace("ا", "أ", 1) if rng.random() < 0.3 else w for w in words]
+    elif choice < 0.8:
+        i = rng.randrange(len(words))
+        words[i] = words[i][:-1] or words[i]
+    else:
+        words = [w + "ُ" if rng.random() < 0.2 else w for w in words]
+    return " ".join(words)
+
+
+def legacy_match(query, kb):
+    questions = [entry['standard_question'] for entry in kb]
+    best = process.extractOne(query, questions, scorer=fuzz.token_sort_ratio)
+    if best and best[1] >= THRESHOLD:
+        return next(i for i, e in enumerate(kb) if e['standard_question'] == best[0])
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 200, 2000, 20000])
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    print(f"{'الإدخالات':>10} | {'بناء (ms)':>10} | {'قديم (ms/سؤال)':>15} | {'جديد (ms/سؤال)':>15} | "
+          f"{'اتفاق':>6} | {'صحيح قديم':>10} | {'صحيح جديد':>10}")
+    for size in args.sizes:
+        kb = make_kb(size, rng)
+        start = time.perf_counter()
+        matcher = KBMatcher(kb)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # نصف الأسئلة صيغ معدلة لأسئلة موجودة (الإجابة الصحيحة معروفة)، والنصف الآخر أسئلة لا علاقة لها بالقاعدة
+        queries = []
+        for _ in range(args.queries // 2):
+            i = rng.randrange(size)
+            queries.append((perturb(kb[i]['standard_question'], rng), i))
+        for _ in range(args.queries - len(queries)):
+            queries.append((f"سؤال عام عن {rng.choice(['الطقس', 'الرياضة', 'التاريخ', 'الطبخ'])} رقم {rng.randint(1, 999)}", None))
+
+        legacy_time = new_time = 0.0
+        agree = legacy_correct = new_correct = 0
+        for query, expected in queries:
+            start = time.perf_counter()
+            legacy = legacy_match(query, kb)
+            legacy_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = matcher.match(query, threshold=THRESHOLD)
+            new_time += time.perf_counter() - start
+            new = result[0] if result else None
+
+            # إدخالات مختلفة بنفس نص السؤال تُعتبر نفس النتيجة
+            same = lambda a, b: a == b or (a is not None and b is not None and kb[a]['standard_question'] == kb[b]['standard_question'])
+            agree += same(legacy, new)
+            legacy_correct += same(legacy, expected)
+            new_correct += same(new, expected)
+
+        n = len(queries)
+        print(f"{size:>10} | {build_ms:>10.1f} | {legacy_time / n * 1000:>15.3f} | {new_time / n * 1000:>15.3f} | "
+              f"{agree / n:>6.0%} | {legacy_correct / n:>10.0%} | {new_correct / n:>10.0%}")
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+زمن بدء التشغيل مع عدد متزايد من ملفات kb_*.json:
+الطريقة القديمة (load_all_book_kbs: قراءة كل الملفات وبناء مطابق لكل منها قبل بدء الاستقبال)
+مقابل KBStore (قراءة الـ manifest فقط، والقواعد تُحمّل عند أول سؤال).
+
+التشغيل:
+    python benchmarks/bench_kb_startup.py [--books 10 1000 10000] [--entries 40] [--legacy-max 1000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kb_store import KBStore
+from kb_matcher import KBMatcher
+
+SUBJECTS = ["قاعدة البيانات", "المفتاح الأساسي", "الجدول", "الاستعلام", "الفهرس", "المعاملة", "التطبيع",
+            "الخوارزمية", "المصفوفة", "الشجرة الثنائية", "الذاكرة", "المعالج", "الشبكة"]
+
+
+def make_library(directory, books, entries, rng):
+    for b in range(books):
+        kb = [{"standard_question": f"ما هو {rng.choice(SUBJECTS)} في {rng.choice(SUBJECTS)} ({b}-{i})؟",
+               "answer": "إجابة " * rng.randint(20, 60)} for i in range(entries)]
+        with open(os.path.join(directory, f"kb_book{b:05d}.json"), "w", encoding='utf-8') as f:
+            json.dump(kb, f, indent=4, ensure_ascii=False)
+
+
+def legacy_startup(directory):
+    """نفس ما كانت تفعله load_all_book_kbs."""
+    knowledge_bases, matchers = {}, {}
+    for name in os.listdir(directory):
+        if name.startswith('kb_') and name.endswith('.json'):
+            book_id = name[3:-5]
+            with open(os.path.join(directory, name), "r", encoding='utf-8') as f:
+                knowledge_bases[book_id] = json.load(f)
+            matchers[book_id] = KBMatcher(knowledge_bases[book_id])
+    return knowledge_bases, matchers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--books", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--entries", type=int, default=40)
+    parser.add_argument("--legacy-max", type=int, default=1000, help="تخطي الطريقة القديمة للمكتبات الأكبر (بطيئة جداً)")
+    args = parser.parse_args()
+    rng = random.Random(5)
+
+    print(f"{'الكتب':>7} | {'قديم: بدء (s)':>14} | {'جديد: بدء (ms)':>15} | {'فهرسة أول مرة (s)':>18} | {'أول سؤال (ms)':>14} | {'التالي (ms)':>12}")
+    for books in args.books:
+        directory = tempfile.mkdtemp(prefix="kb_bench_")
+        try:
+            make_library(directory, books, args.entries, rng)
+
+            legacy = "-"
+            if books <= args.legacy_max:
+                start = time.perf_counter()
+                legacy_startup(directory)
+                legacy = f"{time.perf_counter() - start:.2f}"
+
+            # فهرسة أول مرة (مرة واحدة فقط في عمر المكتبة، وفي الإنتاج تتم في خيط خلفي)
+            start = time.perf_counter()
+            KBStore(directory).reconcile()
+            first_index = time.perf_counter() - start
+
+            # بدء التشغيل الفعلي: قراءة الـ manifest فقط
+            start = time.perf_counter()
+            store = KBStore(directory)
+            cold = (time.perf_counter() - start) * 1000
+
+            book_id = f"book{rng.randrange(books):05d}"
+            start = time.perf_counter()
+            store.get(book_id)
+            first_get = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            store.get(book_id)
+            warm_get = (time.perf_counter() - start) * 1000
+
+            print(f"{books:>7} | {legacy:>14} | {cold:>15.1f} | {first_index:>18.2f} | {first_get:>14.1f} | {warm_get:>12.3f}")
+        finally:
+            shutil.rmtree(directory)
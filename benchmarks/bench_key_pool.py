@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة توزيع الطلبات على مفاتيح Gemini: itertools.cycle مع time.sleep (الطريقة القديمة)
+مقابل KeyPool، باستخدام خادم Gemini وهمي يحاكي نفاد الحصة (429).
+
+التشغيل:
+    python benchmarks/bench_key_pool.py [--requests 60] [--threads 12]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from key_pool import KeyPool, KeyPoolExhausted
+from fake_gemini import start_fake_gemini
+
+KEYS = ["fake-key-aaaa-0001", "fake-key-bbbb-0002", "fake-key-cccc-0003"]
+WINDOW = 6.0      # نافذة الحصة في الخادم الوهمي (ثوانٍ) لتسريع التجربة
+PER_WINDOW = 10   # عدد الطلبات المسموحة لكل مفتاح في النافذة
+MAX_RETRIES = 3
+
+
+def post(base_url, key):
+    """طلب generateContent واحد. يرجع رمز الحالة."""
+    body = json.dumps({"contents": [{"role": "user", "parts": [{"text": "ما هو التعريف؟"}]}]}).encode()
+    request = urllib.request.Request(
+        f"{base_url}/v1beta/models/gemini-1.5-flash:generateContent?key={key}",
+        data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_legacy(base_url, n_requests, n_threads):
+    cycler, lock = cycle(KEYS), threading.Lock()
+    counters = {"ok": 0, "failed": 0, "429": 0}
+
+    def one():
+        for attempt in range(MAX_RETRIES):
+            with lock:
+                key = next(cycler)
+            status = post(base_url, key)
+            if status == 429:
+                counters["429"] += 1
+                time.sleep((2 ** attempt) + 1)
+                continue
+            counters["ok"] += 1
+            return
+        counters["failed"] += 1
+
+    return run(one, n_requests, n_threads, counters)
+
+
+def run_pool(base_url, n_requests, n_threads):
+    pool = KeyPool(KEYS, rpm=PER_WINDOW, window=WINDOW, cooldown=WINDOW / 2)
+    counters = {"ok": 0, "failed": 0, "429": 0}
+
+    def one():
+        for _ in range(MAX_RETRIES):
+            try:
+                lease = pool.acquire(estimated_tokens=50, timeout=60)
+            except KeyPoolExhausted:
+                break
+            status = post(base_url, lease.key)
+            pool.release(lease, status_code=status)
+            if status == 429:
+                counters["429"] += 1
+                continue
+            counters["ok"] += 1
+            return
+        counters["failed"] += 1
+
+    result = run(one, n_requests, n_threads, counters)
+    result["stats"] = pool.stats()
+    return result
+
+
+def run(task, n_requests, n_threads, counters):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for _ in range(n_requests):
+            executor.submit(task)
+    counters["elapsed"] = round(time.perf_counter() - start, 2)
+    return counters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=12)
+    args = parser.parse_args()
+
+    for name, runner in (("itertools.cycle + sleep", run_legacy), ("KeyPool", run_pool)):
+        server, base_url, state = start_fake_gemini(rpm=PER_WINDOW, window=WINDOW, latency=0.05)
+        result = runner(base_url, args.requests, args.threads)
+        server.shutdown()
+        stats = result.pop("stats", None)
+        print(f"{name:>24}: {result}")
+        for item in stats or []:
+            print(f"{'':>26}{item['key']}: requests={item['total_requests']} 429={item['rate_429']} p95={item['p95']}s")
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة استخراج نص PDF على خيط واحد (الطريقة القديمة: "".join(page.get_text() for page in doc))
+مقابل PDFExtractor بعدد مختلف من العمليات، على ملفات PDF مولدة بمئات الصفحات.
+
+التشغيل:
+    python benchmarks/bench_pdf_extract.py [--pages 300 800] [--workers 1 2 4 8]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import fitz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pdf_extract import PDFExtractor
+
+WORDS = ("database relation key value record process system storage retrieval analysis model "
+         "design execution performance memory processor network protocol server client security").split()
+
+
+def make_pdf(path, pages, seed=3):
+    """كتاب مولد: كل صفحة مليئة بأسطر نصية (بدون صور) مثل الكتب الدراسية."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page()
+        lines = [f"Chapter {page_number // 20 + 1} - page {page_number + 1}"]
+        lines += [" ".join(rng.choice(WORDS) for _ in range(11)) for _ in range(55)]
+        page.insert_text((36, 40), "\n".join(lines), fontsize=8)
+    doc.save(path)
+    doc.close()
+
+
+def legacy_extract(path):
+    with open(path, "rb") as f:
+        with fitz.open(stream=f.read(), filetype="pdf") as doc:
+            return "".join(page.get_text() for page in doc)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[300, 800])
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+    print(f"عدد الأنوية: {os.cpu_count()}")
+
+    for pages in args.pages:
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            make_pdf(path, pages)
+            start = time.perf_counter()
+            expected = legacy_extract(path)
+            legacy_time = time.perf_counter() - start
+            print(f"\n{pages} صفحة ({os.path.getsize(path) / 1e6:.1f} MB) | خيط واحد: {legacy_time:.2f}s")
+
+            for workers in args.workers:
+                extractor = PDFExtractor(workers=workers, max_pages=pages, timeout=600, parallel_min_pages=0)
+                extractor.extract_text(path)  # تشغيل العمليات قبل القياس
+                start = time.perf_counter()
+                text = extractor.extract_text(path, separator="")
+                elapsed = time.perf_counter() - start
+                extractor.close()
+                assert text == expected, "النص المستخرج لا يطابق الاستخراج على خيط واحد"
+                print(f"  {workers:>2} عملية: {elapsed:.2f}s  (تسريع x{legacy_time / elapsed:.1f})")
+        finally:
+            os.remove(path)
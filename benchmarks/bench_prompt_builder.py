@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة رموز الطلب وزمنه في محادثة طويلة: الطريقة القديمة (آخر 10 رسائل كاملة + النص المرجعي كاملاً)
+مقابل PromptBuilder (ميزانية رموز + ملخص المحاورات الأقدم)، مع خادم Gemini وهمي يزيد زمن الاستجابة
+مع عدد رموز الطلب (latency_per_1k_tokens). التقدير المحلي يُعاير من usageMetadata مثل البوت.
+
+التشغيل:
+    python benchmarks/bench_prompt_builder.py [--turns 30] [--answer-chars 5000] [--budget 6000]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from key_pool import percentile
+from prompt_builder import TokenEstimator, PromptBuilder, contents_chars, fold_digest
+from fake_gemini import start_fake_gemini
+
+KEY = "fake-key-aaaa-0001"
+CONTEXT_PART = "[صفحة {page}]\n" + "نص تجريبي من الكتاب يشرح المفهوم بالتفصيل مع أمثلة. " * 28
+
+
+def post(base_url, contents):
+    """طلب generateContent واحد. يرجع (الإجابة, usageMetadata, الزمن)."""
+    body = json.dumps({"contents": contents}, ensure_ascii=False).encode("utf-8")
+    request = urllib.request.Request(f"{base_url}/v1beta/models/gemini-1.5-flash:generateContent?key={KEY}",
+                                     data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=60) as response:
+        result = json.loads(response.read())
+    return result["candidates"][0]["content"]["parts"][0]["text"], result["usageMetadata"], time.perf_counter() - started
+
+
+def legacy_contents(prompt, context, history):
+    final_prompt = PromptBuilder.question_text(prompt, context)
+    return history[-10:] + [{"role": "user", "parts": [{"text": final_prompt}]}]
+
+
+def run(base_url, args, budgeted):
+    estimator = TokenEstimator()
+    builder = PromptBuilder(estimator, budget=args.budget)
+    context = "\n\n---\n\n".join(CONTEXT_PART.format(page=i) for i in range(1, 9))
+    history, digest, tokens, latencies, errors = [], "", [], [], []
+    for turn in range(args.turns):
+        prompt = f"السؤال رقم {turn + 1}: ما العلاقة بين هذا المفهوم وما ناقشناه سابقاً؟"
+        if budgeted:
+            built = builder.build(prompt, context, history, digest)
+            contents = built.contents
+            estimated = built.estimated_tokens
+        else:
+            contents = legacy_contents(prompt, context, history)
+            estimated = estimator.estimate_contents(contents)
+        answer, usage, seconds = post(base_url, contents)
+        estimator.calibrate(contents_chars(contents), usage["promptTokenCount"])
+        tokens.append(usage["promptTokenCount"])
+        latencies.append(seconds)
+        errors.append(abs(estimated - usage["promptTokenCount"]) / usage["promptTokenCount"])
+
+        history += [{"role": "user", "parts": [{"text": prompt}]}, {"role": "model", "parts": [{"text": answer}]}]
+        if budgeted and len(history) > 20:
+            digest = fold_digest(digest, history[:2])
+            history = history[2:]
+        elif not budgeted:
+            history = history[-10:]
+
+    latencies.sort()
+    tail = tokens[len(tokens) // 2:]  # النصف الثاني من المحادثة (السجل ممتلئ)
+    return {
+        "prompt_tokens_total": sum(tokens),
+        "prompt_tokens_late_avg": round(sum(tail) / len(tail)),
+        "prompt_tokens_max": max(tokens),
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "estimate_error_late": f"{sum(errors[len(errors) // 2:]) / len(tail) * 100:.1f}%",
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--answer-chars", type=int, default=5000)
+    parser.add_argument("--budget", type=int, default=6000)
+    parser.add_argument("--latency-per-1k", type=float, default=0.02)
+    args = parser.parse_args()
+
+    for name, budgeted in (("history[-10:] + full context", False), ("PromptBuilder", True)):
+        server, base_url, _ = start_fake_gemini(rpm=100000, latency=0.01, answer_chars=args.answer_chars,
+                                                latency_per_1k_tokens=args.latency_per_1k)
+        result = run(base_url, args, budgeted)
+        server.shutdown()
+        print(f"{name:>30}: {result}")
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+مقارنة حجم الطلب وزمنه عند إرسال الكتاب كاملاً إلى Gemini (الطريقة القديمة)
+مقابل أفضل الأجزاء من فهرس BM25 ضمن ميزانية الحروف.
+الكتاب مولد عشوائياً (صفحات عربية)، وخادم Gemini الوهمي يزيد زمنه مع عدد الرموز.
+
+التشغيل:
+    python benchmarks/bench_retrieval.py [--pages 300] [--budget 12000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import BookIndex, PAGE_SEPARATOR
+from fake_gemini import start_fake_gemini
+
+TOPICS = ["قواعد البيانات", "الجبر العلائقي", "لغة الاستعلام", "المعاملات", "الفهرسة", "التطبيع",
+          "الشبكات", "نظم التشغيل", "الخوارزميات", "هياكل البيانات", "الذكاء الاصطناعي", "التشفير"]
+WORDS = ("تعتمد تستخدم مفهوم أساسي جدول علاقة مفتاح قيمة سجل عملية نظام بيانات تخزين استرجاع "
+         "تحليل نموذج تصميم تنفيذ أداء سرعة ذاكرة معالج شبكة بروتوكول خادم عميل أمان").split()
+QUESTIONS = ["ما هو التطبيع في قواعد البيانات؟", "اشرح المعاملات", "ما فائدة الفهرسة؟",
+             "عرّف الجبر العلائقي", "ما هي هياكل البيانات؟", "كيف يعمل التشفير؟"]
+
+
+def make_book(pages, seed=7):
+    rng = random.Random(seed)
+    book = []
+    for page in range(pages):
+        topic = TOPICS[(page // 25) % len(TOPICS)]
+        lines = [f"الفصل الخاص بـ {topic} - صفحة {page + 1}"]
+        for _ in range(30):
+            lines.append(f"{topic} " + " ".join(rng.choice(WORDS) for _ in range(12)))
+        book.append("\n".join(lines))
+    return PAGE_SEPARATOR.join(book)
+
+
+def ask(base_url, context, question):
+    prompt = f"--- النص المرجعي ---\n{context}\n--- نهاية النص المرجعي ---\n\nالسؤال: {question}"
+    body = json.dumps({"contents": [{"role": "user", "parts": [{"text": prompt}]}]}, ensure_ascii=False).encode()
+    request = urllib.request.Request(f"{base_url}/v1beta/models/m:generateContent?key=k", data=body,
+                                     headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    urllib.request.urlopen(request, timeout=600).read()
+    return time.perf_counter() - start, len(prompt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--budget", type=int, default=12000)
+    parser.add_argument("--top-k", type=int, default=8)
+    args = parser.parse_args()
+
+    text = make_book(args.pages)
+    start = time.perf_counter()
+    index = BookIndex.build(text, "v1")
+    build_time = time.perf_counter() - start
+    print(f"الكتاب: {args.pages} صفحة، {len(text):,} حرف | بناء الفهرس: {build_time:.2f}s ({len(index.chunks)} جزء)")
+
+    # زمن Gemini الوهمي: 0.2 ثانية + 0.05 ثانية لكل 1000 رمز من الطلب
+    server, base_url, _ = start_fake_gemini(rpm=10 ** 9, latency=0.2, latency_per_1k_tokens=0.05)
+    full_times, full_sizes, rag_times, rag_sizes, search_times = [], [], [], [], []
+    for question in QUESTIONS:
+        elapsed, size = ask(base_url, text, question)
+        full_times.append(elapsed)
+        full_sizes.append(size)
+
+        start = time.perf_counter()
+        context = index.build_context(text, question, top_k=args.top_k, char_budget=args.budget)
+        search_times.append(time.perf_counter() - start)
+        elapsed, size = ask(base_url, context, question)
+        rag_times.append(elapsed + search_times[-1])
+        rag_sizes.append(size)
+    server.shutdown()
+
+    avg = lambda values: sum(values) / len(values)
+    print(f"{'':>14} | {'حجم الطلب (حرف)':>16} | {'الزمن (ث)':>10}")
+    print(f"{'الكتاب كاملاً':>14} | {avg(full_sizes):>16,.0f} | {avg(full_times):>10.2f}")
+    print(f"{'BM25 top-k':>14} | {avg(rag_sizes):>16,.0f} | {avg(rag_times):>10.2f}  (منها بحث: {avg(search_times) * 1000:.1f}ms)")
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+قياس زمن معالجة رسالة واحدة (من ناحية تخزين بيانات المستخدم) مع زيادة عدد المستخدمين:
+الطريقة القديمة (قراءة وإعادة كتابة users.json بالكامل) مقابل UserStore (SQLite + كاش).
+
+التشغيل:
+    python benchmarks/bench_user_store.py [عدد_المستخدمين ...]
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from user_store import UserStore
+
+MESSAGES = 200
+
+
+def make_user(i):
+    history = []
+    for turn in range(5):
+        history.append({"role": "user", "parts": [{"text": f"سؤال رقم {turn} من المستخدم {i}"}]})
+        history.append({"role": "model", "parts": [{"text": "إجابة طويلة نسبياً " * 40}]})
+    return {"state": "book_chat", "chat_history": history, "user_info": {"first_name": f"user{i}"}}
+
+
+def bench_legacy(path, n_users):
+    """نفس نمط handle_user_message القديم: تحميل كامل ثم حفظين كاملين لكل رسالة."""
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump({str(i): make_user(i) for i in range(n_users)}, f, indent=4, ensure_ascii=False)
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        chat_id = str(random.randrange(n_users))
+        with open(path, "r", encoding='utf-8') as f:
+            users = json.load(f)
+        users[chat_id]['last_query_time'] = time.time()
+        with open(path, "w", encoding='utf-8') as f:
+            json.dump(users, f, indent=4, ensure_ascii=False)
+        users[chat_id]['chat_history'] = users[chat_id]['chat_history'][-10:]
+        with open(path, "w", encoding='utf-8') as f:
+            json.dump(users, f, indent=4, ensure_ascii=False)
+    return (time.perf_counter() - start) / MESSAGES
+
+
+def bench_store(path, n_users):
+    store = UserStore(path, legacy_json_path=None)
+    for i in range(n_users):
+        store.save(str(i), make_user(i))
+    store.flush()
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        chat_id = str(random.randrange(n_users))
+        user_data = store.get(chat_id)
+        user_data['last_query_time'] = time.time()
+        store.save(chat_id, user_data)
+        user_data['chat_history'] = user_data['chat_history'][-10:]
+        store.save(chat_id, user_data)
+    store.flush()
+    elapsed = (time.perf_counter() - start) / MESSAGES
+    store.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000]
+    print(f"{'المستخدمين':>12} | {'users.json (ms)':>16} | {'UserStore (ms)':>15}")
+    print("-" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_users in sizes:
+            legacy = bench_legacy(os.path.join(tmp, f"users_{n_users}.json"), n_users)
+            store = bench_store(os.path.join(tmp, f"users_{n_users}.db"), n_users)
+            print(f"{n_users:>12} | {legacy * 1000:>16.2f} | {store * 1000:>15.3f}")
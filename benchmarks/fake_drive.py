@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+خادم Google Drive API (v3) وهمي محلي: مجلد كتب نصية مع files.list / files.get (بيانات أو alt=media)
+و changes.getStartPageToken / changes.list، بما يكفي لـ BookCatalog و load_book في main.py.
+يمكن حقن زمن استجابة ونسبة أخطاء 503 وسرعة تحميل محدودة.
+
+يُستخدم مع main.py عبر DRIVE_API_ENDPOINT=<base_url>/drive/v3/
+"""
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeDriveState:
+    def __init__(self, folder_id="folder", latency=0.0, error_rate=0.0, bandwidth=0):
+        self.folder_id = folder_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth  # بايت/ثانية لتحميل الملفات (0 = بدون حد)
+        self.lock = threading.Lock()
+        self.files = {}  # id -> {"meta": {...}, "content": bytes}
+        self.counters = defaultdict(int)
+
+    def add_book(self, file_id, name, text):
+        content = text.encode("utf-8")
+        with self.lock:
+            self.files[file_id] = {
+                "meta": {
+                    "id": file_id, "name": name, "mimeType": "text/plain",
+                    "md5Checksum": hashlib.md5(content).hexdigest(),
+                    "size": str(len(content)),
+                    "modifiedTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                    "parents": [self.folder_id], "trashed": False,
+                },
+                "content": content,
+            }
+
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _media(self, content):
+        """تحميل الملف مع دعم Range (MediaIoBaseDownload يحمّل على أجزاء)."""
+        start, end = 0, len(content) - 1
+        header = self.headers.get("Range", "")
+        if header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), end) if last else end
+        body = content[start:end + 1]
+        if self.state.bandwidth:
+            time.sleep(len(body) / self.state.bandwidth)
+        self.send_response(206 if header else 200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        if header:
+            self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(content)}")
+        self.end_headers()
+        self.wfile.write(body)
+        with self.state.lock:
+            self.state.counters["bytes"] += len(body)
+
+    def do_GET(self):
+        state = self.state
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path.split("/drive/v3/", 1)[-1].strip("/")
+        if state.latency:
+            time.sleep(state.latency)
+        with state.lock:
+            state.counters[path.split("/")[0] + (":media" if query.get("alt") == "media" else "")] += 1
+        if random.random() < state.error_rate:
+            with state.lock:
+                state.counters["5xx"] += 1
+            self._reply(503, {"error": {"code": 503, "message": "Backend Error"}})
+            return
+
+        if path == "changes/startPageToken":
+            self._reply(200, {"startPageToken": "1"})
+        elif path == "changes":
+            self._reply(200, {"changes": [], "newStartPageToken": query.get("pageToken", "1")})
+        elif path == "files":
+            with state.lock:
+                files = [f["meta"] for f in state.files.values()]
+            page_size = int(query.get("pageSize", 100))
+            offset = int(query.get("pageToken") or 0)
+            result = {"files": files[offset:offset + page_size]}
+            if offset + page_size < len(files):
+                result["nextPageToken"] = str(offset + page_size)
+            self._reply(200, result)
+        elif path.startswith("files/"):
+            with state.lock:
+                found = state.files.get(path.split("/", 1)[1])
+            if found is None:
+                self._reply(404, {"error": {"code": 404, "message": "File not found"}})
+            elif query.get("alt") == "media":
+                self._media(found["content"])
+            else:
+                self._reply(200, found["meta"])
+        else:
+            self._reply(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+
+
+def start_fake_drive(port=0, **state_kwargs):
+    """تشغيل الخادم في خيط خلفي. يرجع (server, base_url, state)؛ عنوان main.py هو base_url + '/drive/v3/'."""
+    state = FakeDriveState(**state_kwargs)
+    handler = type("BoundFakeDriveHandler", (FakeDriveHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", state
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+خادم Gemini وهمي محلي لاختبار جدولة المفاتيح ومحاكاة نفاد الحصة.
+
+كل مفتاح له حصة طلبات في نافذة زمنية متحركة؛ عند تجاوزها يرجع الخادم 429 كما يفعل Gemini.
+يمكن أيضاً حقن زمن استجابة ونسبة أخطاء 5xx، ونسبة طلبات عالقة (slow_rate) تتأخر slow_latency ثانية.
+يدعم أيضاً كاش السياق (cachedContents: إنشاء/تمديد/حذف) بحيث يكون كل كاش تابعاً للمفتاح الذي أنشأه،
+مع قيود API الحقيقي: أقل حجم min_cache_tokens رمزاً، والطلب على الكاش يجب أن يكون لنفس نموذجه.
+
+التشغيل المستقل:
+    python benchmarks/fake_gemini.py --port 8765 --rpm 15
+"""
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeGeminiState:
+    def __init__(self, rpm=15, window=60.0, latency=0.05, latency_jitter=0.0, error_rate=0.0, latency_per_1k_tokens=0.0,
+                 answer_chars=0, stream_chunks=8, stream_interval=0.05, responder=None, slow_rate=0.0, slow_latency=0.0,
+                 min_cache_tokens=32768):
+        self.rpm = rpm
+        self.window = window
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens  # لمحاكاة زيادة زمن المعالجة مع حجم الطلب
+        self.latency_jitter = latency_jitter
+        self.slow_rate = slow_rate  # نسبة الطلبات العالقة (ذيل زمن الاستجابة)
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.answer_chars = answer_chars  # طول الإجابة (0 = إجابة قصيرة تكرر بداية السؤال)
+        self.stream_chunks = stream_chunks  # عدد أجزاء الرد في streamGenerateContent
+        self.stream_interval = stream_interval  # الزمن بين كل جزء وآخر
+        self.min_cache_tokens = min_cache_tokens  # أقل حجم لـ cachedContent (32768 رمزاً في Gemini 1.5)
+        self.responder = responder  # دالة اختيارية responder(prompt) ترجع نص الإجابة (أو None للإجابة الافتراضية)
+        self.lock = threading.Lock()
+        self.calls = defaultdict(deque)  # key -> أوقات الطلبات المقبولة
+        self.counters = defaultdict(int)
+        self.caches = {}  # name -> {"key", "model", "tokens", "expires_at"}
+
+    def admit(self, key):
+        """هل يسمح للمفتاح بطلب جديد ضمن حصته؟"""
+        now = time.monotonic()
+        with self.lock:
+            calls = self.calls[key]
+            while calls and now - calls[0] > self.window:
+                calls.popleft()
+            if len(calls) >= self.rpm:
+                self.counters["429"] += 1
+                return False
+            calls.append(now)
+            self.counters["ok"] += 1
+            return True
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # يُضبط عند إنشاء الخادم
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        query = parse_qs(urlparse(self.path).query)
+        return json.loads(self.rfile.read(length) or b"{}"), query.get("key", [""])[0], query
+
+    def _cache_name(self):
+        path = urlparse(self.path).path
+        return path[len("/v1beta/"):] if path.startswith("/v1beta/cachedContents/") else None
+
+    def _find_cache(self, name, key):
+        """(status, cache): 404 إذا لم يوجد أو انتهى، 403 إذا كان تابعاً لمفتاح آخر."""
+        state = self.state
+        with state.lock:
+            cache = state.caches.get(name)
+            if cache is None or cache["expires_at"] <= time.monotonic():
+                state.caches.pop(name, None)
+                return 404, None
+            if cache["key"] != key:
+                return 403, None
+            return 200, cache
+
+    def _not_found(self, status):
+        self._reply(status, {"error": {"code": status, "status": "NOT_FOUND" if status == 404 else "PERMISSION_DENIED",
+                                       "message": "CachedContent not found (or permission denied)"}})
+
+    def do_PATCH(self):
+        request, key, _ = self._read_request()
+        status, cache = self._find_cache(self._cache_name(), key)
+        if cache is None:
+            self._not_found(status)
+            return
+        cache["expires_at"] = time.monotonic() + float(request.get("ttl", "300s").rstrip("s"))
+        self._reply(200, {"name": self._cache_name()})
+
+    def do_DELETE(self):
+        _, key, _ = self._read_request()
+        name = self._cache_name()
+        status, cache = self._find_cache(name, key)
+        if cache is None:
+            self._not_found(status)
+            return
+        with self.state.lock:
+            self.state.caches.pop(name, None)
+            self.state.counters["caches_deleted"] += 1
+        self._reply(200, {})
+
+    def _create_cache(self, request, key):
+        state = self.state
+        tokens = max(1, len(json.dumps(request.get("contents", []), ensure_ascii=False)) // 4)
+        if tokens < state.min_cache_tokens:
+            self._reply(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                        "message": f"Cached content is too small. total_token_count={tokens}, "
+                                                   f"min_total_token_count={state.min_cache_tokens}"}})
+            return
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        time.sleep(state.latency + state.latency_per_1k_tokens * tokens / 1000)  # معالجة النص مرة واحدة
+        with state.lock:
+            state.caches[name] = {"key": key, "model": request.get("model"), "tokens": tokens,
+                                  "expires_at": time.monotonic() + float(request.get("ttl", "300s").rstrip("s"))}
+            state.counters["caches_created"] += 1
+        self._reply(200, {"name": name, "model": request.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+
+    def do_POST(self):
+        request, key, _ = self._read_request()
+        state = self.state
+
+        if urlparse(self.path).path == "/v1beta/cachedContents":
+            self._create_cache(request, key)
+            return
+
+        if not state.admit(key):
+            self._reply(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Quota exceeded"}})
+            return
+
+        contents = request.get("contents", [])
+        prompt_tokens = max(1, len(json.dumps(contents, ensure_ascii=False)) // 4)
+        cached_tokens = 0
+        if request.get("cachedContent"):
+            status, cache = self._find_cache(request["cachedContent"], key)
+            if cache is None:
+                self._not_found(status)
+                return
+            model = "models/" + urlparse(self.path).path.split("/models/", 1)[-1].split(":")[0]
+            if cache["model"] != model:
+                self._reply(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                            "message": f"Model {model} does not match cached content model {cache['model']}"}})
+                return
+            cached_tokens = cache["tokens"]
+        with state.lock:
+            state.counters["prompt_tokens"] += prompt_tokens  # رموز الطلب التي عولجت فعلاً
+            state.counters["cached_tokens"] += cached_tokens
+        # الرموز المخزنة في الكاش لا تُعالج من جديد، فلا تزيد زمن الاستجابة
+        delay = (state.latency + random.random() * state.latency_jitter
+                 + state.latency_per_1k_tokens * prompt_tokens / 1000)
+        if random.random() < state.slow_rate:
+            with state.lock:
+                state.counters["slow"] += 1
+            delay += state.slow_latency
+        time.sleep(delay)
+        if random.random() < state.error_rate:
+            with state.lock:
+                state.counters["5xx"] += 1
+            self._reply(503, {"error": {"code": 503, "status": "UNAVAILABLE", "message": "Overloaded"}})
+            return
+
+        prompt = contents[-1]["parts"][0]["text"] if contents else ""
+        answer = f"إجابة تجريبية على: {prompt[:80]}"
+        if state.answer_chars:
+            answer = (answer + "\n" + "سطر من الإجابة التجريبية. " * (state.answer_chars // 25 + 1))[:state.answer_chars]
+        if state.responder:
+            answer = state.responder(prompt) or answer
+        usage = {
+            "promptTokenCount": prompt_tokens + cached_tokens,
+            "cachedContentTokenCount": cached_tokens,
+            "candidatesTokenCount": len(answer) // 4,
+            "totalTokenCount": prompt_tokens + cached_tokens + len(answer) // 4,
+        }
+        if ":streamGenerateContent" in self.path:
+            self._stream(answer, usage)
+            return
+        self._reply(200, {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}, "finishReason": "STOP"}],
+            "usageMetadata": usage,
+        })
+
+    def _stream(self, answer, usage):
+        """رد streamGenerateContent?alt=sse: أجزاء متتالية من الإجابة كأحداث data:."""
+        state = self.state
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        size = max(1, -(-len(answer) // state.stream_chunks))
+        chunks = [answer[i:i + size] for i in range(0, len(answer), size)]
+        for i, chunk in enumerate(chunks):
+            event = {"candidates": [{"content": {"role": "model", "parts": [{"text": chunk}]}}]}
+            if i == len(chunks) - 1:
+                event["candidates"][0]["finishReason"] = "STOP"
+                event["usageMetadata"] = usage
+            self.wfile.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\r\n\r\n")
+            self.wfile.flush()
+            if i < len(chunks) - 1:
+                time.sleep(state.stream_interval)
+        self.close_connection = True
+
+
+def start_fake_gemini(port=0, **state_kwargs):
+    """تشغيل الخادم في خيط خلفي. يرجع (server, base_url, state)."""
+    state = FakeGeminiState(**state_kwargs)
+    handler = type("BoundFakeGeminiHandler", (FakeGeminiHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="خادم Gemini وهمي")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rpm", type=int, default=15)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server, url, _ = start_fake_gemini(args.port, rpm=args.rpm, latency=args.latency, error_rate=args.error_rate)
+    print(f"Fake Gemini يعمل على {url} (اضغط Ctrl+C للإيقاف)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+خادم Bot API وهمي محلي: يقبل أي method ويرجع ok=true مع رسالة وهمية،
+ويسجل زمن وصول كل رسالة لكل محادثة لقياس زمن الرد.
+يمكن حقن زمن استجابة ونسبة أخطاء 429 (مع retry_after) لطلبات الإرسال والتعديل.
+"""
+import json
+import time
+import random
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+SEND_METHODS = ("sendMessage", "editMessageText", "deleteMessage")
+
+
+class FakeTelegramState:
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate  # نسبة طلبات الإرسال التي ترجع 429
+        self.retry_after = retry_after
+        self.lock = threading.Condition()
+        self.next_message_id = 1
+        self.calls = defaultdict(int)             # method -> عدد الاستدعاءات
+        self.sent = defaultdict(list)             # chat_id -> [(الوقت, method, النص)]
+        self.events = defaultdict(list)           # chat_id -> [(الوقت, method, params)]
+        self.rejected = 0
+
+    def record(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            chat_id = str(params.get("chat_id", ""))
+            now = time.monotonic()
+            self.sent[chat_id].append((now, method, params.get("text", "")))
+            self.events[chat_id].append((now, method, params))
+            self.lock.notify_all()
+        return message_id
+
+    def mark(self, chat_id):
+        """موضع آخر حدث في المحادثة (لانتظار الأحداث التالية فقط)."""
+        with self.lock:
+            return len(self.events[str(chat_id)])
+
+    def wait_for(self, chat_id, since, predicate, timeout=60):
+        """
+        انتظار أول حدث بعد الموضع since في المحادثة يحقق predicate(method, params).
+        يرجع (وقت الحدث, الموضع التالي) أو (None, since) عند انتهاء المهلة.
+        """
+        chat_id = str(chat_id)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            index = since
+            while True:
+                events = self.events[chat_id]
+                while index < len(events):
+                    at, method, params = events[index]
+                    index += 1
+                    if predicate(method, params):
+                        return at, index
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, index
+                self.lock.wait(remaining)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        # telebot يرسل المعاملات في رابط الطلب (query string)، وآخرون في الجسم (JSON أو form)
+        params = {k: v[0] for k, v in parse_qs(self.path.partition("?")[2]).items()}
+        if "json" in content_type and raw:
+            params.update(json.loads(raw))
+        elif raw:
+            params.update({k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()})
+        return params
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        # المسار بالشكل /bot<token>/<method>
+        method = self.path.partition("?")[0].rstrip("/").split("/")[-1]
+        params = self._params()
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if method in SEND_METHODS and random.random() < self.state.error_rate:
+            with self.state.lock:
+                self.state.rejected += 1
+            self._send(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after "
+                             f"{self.state.retry_after}", "parameters": {"retry_after": self.state.retry_after}})
+            return
+        message_id = self.state.record(method, params)
+        chat_id = params.get("chat_id", 0)
+        result = True
+        if method in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "u"}}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+        self._send(200, {"ok": True, "result": result})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+def start_fake_telegram(port=0, **state_kwargs):
+    """تشغيل الخادم في خيط خلفي. يرجع (server, base_url, state)."""
+    state = FakeTelegramState(**state_kwargs)
+    handler = type("BoundFakeTelegramHandler", (FakeTelegramHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", state
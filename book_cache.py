@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  كاش نصوص الكتب على مستويين: ذاكرة (LRU بحد أقصى بالبايت) + قرص (ملفات نصية)
+# ==============================================================================
+import os
+import sys
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class BookTextCache:
+    """
+    المستوى الأول: نصوص الكتب الأكثر استخداماً في الذاكرة، بحيث لا يتجاوز مجموعها memory_budget بايت.
+    المستوى الثاني: النص المستخرج محفوظ على القرص ويُقرأ منه عند الحاجة، فيبقى متاحاً بعد إعادة التشغيل.
+    الكتب الأكبر من memory_budget كلها لا تدخل الذاكرة وتُقرأ من القرص في كل مرة (oversize_reads في stats).
+    كل نسخة مفتاحها آي دي الملف في Drive + نسخته (md5Checksum أو modifiedTime)،
+    فإذا عُدّل الكتاب تتغير النسخة ويُعاد استخراج النص تلقائياً.
+    """
+
+    def __init__(self, cache_dir="book_cache", memory_budget=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self._memory = OrderedDict()  # (file_id, version) -> text
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(cache_dir, "index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()  # file_id -> آخر نسخة معروفة
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.oversize_reads = 0
+
+    # --------------------------------------------------------------------------
+    #  الواجهة العامة
+    # --------------------------------------------------------------------------
+    def latest_version(self, file_id):
+        """آخر نسخة محفوظة على القرص لهذا الكتاب (تُستخدم إذا لم تتوفر بيانات Drive)."""
+        with self._lock:
+            return self._index.get(file_id)
+
+    def get(self, file_id, version=None):
+        """إرجاع نص الكتاب من الذاكرة أو القرص، أو None إذا لم يكن محفوظاً بهذه النسخة."""
+        version = version or self.latest_version(file_id)
+        if not version:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        key = (file_id, version)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+        text = self._read_from_disk(file_id, version)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            if sys.getsizeof(text) > self.memory_budget:
+                self.oversize_reads += 1
+            self._remember(key, text)
+        return text
+
+    def put(self, file_id, version, text):
+        """حفظ النص المستخرج على القرص (وفي الذاكرة إن سمحت الميزانية)، وحذف النسخ القديمة لنفس الكتاب."""
+        version = version or "unversioned"
+        path = self._path(file_id, version)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)  # كتابة ذرية: لا يُقرأ ملف نصف مكتوب
+
+        with self._lock:
+            old_version = self._index.get(file_id)
+            self._index[file_id] = version
+            self._save_index()
+            for key in [k for k in self._memory if k[0] == file_id and k[1] != version]:
+                self._forget(key)
+            self._remember((file_id, version), text)
+
+        if old_version and old_version != version:
+            try:
+                os.remove(self._path(file_id, old_version))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget": self.memory_budget,
+                "disk_entries": len(self._index),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "oversize_reads": self.oversize_reads,
+            }
+
+    # --------------------------------------------------------------------------
+    #  دوال داخلية
+    # --------------------------------------------------------------------------
+    def _path(self, file_id, version):
+        digest = hashlib.sha1(str(version).encode('utf-8')).hexdigest()[:12]
+        safe_id = "".join(c for c in file_id if c.isalnum() or c in "-_")
+        return os.path.join(self.cache_dir, f"{safe_id}_{digest}.txt")
+
+    def _read_from_disk(self, file_id, version):
+        path = self._path(file_id, version)
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"تحذير: ملف الكاش {path} تالف وسيتم تجاهله: {e}")
+            return None
+
+    def _remember(self, key, text):
+        """إضافة نص لكاش الذاكرة مع إخراج الأقدم حتى نبقى ضمن الميزانية (القفل محجوز)."""
+        size = sys.getsizeof(text)
+        if key in self._memory:
+            self._forget(key)
+        if size > self.memory_budget:
+            return  # الكتاب أكبر من الميزانية كلها: يُقرأ من القرص في كل مرة
+        while self._memory and self._memory_bytes + size > self.memory_budget:
+            self._forget(next(iter(self._memory)))
+        self._memory[key] = text
+        self._memory_bytes += size
+
+    def _forget(self, key):
+        text = self._memory.pop(key)
+        self._memory_bytes -= sys.getsizeof(text)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
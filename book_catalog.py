@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  فهرس الكتب المشترك (Google Drive) مع مزامنة تدريجية عبر Changes API
+# ==============================================================================
+import time
+import threading
+
+BOOK_MIME_TYPES = ('application/pdf', 'text/plain')
+FILE_FIELDS = "id, name, mimeType, md5Checksum, modifiedTime, size, parents, trashed"
+
+
+class BookCatalog:
+    """
+    قائمة كتب مجلد Drive في الذاكرة، مشتركة بين كل المستخدمين (id -> بيانات الكتاب).
+
+    أول مزامنة (وكل full_sync_interval ثانية للاحتياط) تقرأ المجلد كاملاً صفحةً صفحة (nextPageToken)،
+    وبعدها يجلب خيط خلفي كل refresh_interval ثانية التغييرات فقط من Changes API بدءاً من آخر page token.
+    service_factory دالة ترجع عميل Drive صالحاً للخيط الحالي (أو None).
+    """
+
+    def __init__(self, service_factory, folder_id, refresh_interval=60, full_sync_interval=6 * 3600, page_size=100):
+        self.service_factory = service_factory
+        self.folder_id = folder_id
+        self.refresh_interval = refresh_interval
+        self.full_sync_interval = full_sync_interval
+        self.page_size = page_size
+        self._books = {}
+        self._sorted = []
+        self._page_token = None
+        self._last_full_sync = 0.0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # مزامنة واحدة في نفس الوقت
+        self._loaded = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.full_syncs = 0
+        self.delta_syncs = 0
+        self.changes_applied = 0
+        self.last_sync = None
+        self.last_error = None
+
+    # --------------------------------------------------------------------------
+    #  القراءة (بدون أي طلب لـ Drive بعد أول مزامنة)
+    # --------------------------------------------------------------------------
+    def books(self, wait=10):
+        """قائمة الكتب مرتبة بالاسم. قبل أول مزامنة تنتظرها حتى wait ثانية."""
+        if not self._loaded.is_set():
+            if self._thread is None:
+                self.refresh()
+            else:
+                self._loaded.wait(wait)
+        with self._lock:
+            return list(self._sorted)
+
+    def get(self, book_id):
+        """بيانات كتاب واحد (id, name, md5Checksum, modifiedTime, size) أو None."""
+        with self._lock:
+            return self._books.get(book_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._books)
+
+    # --------------------------------------------------------------------------
+    #  المزامنة
+    # --------------------------------------------------------------------------
+    def _is_book(self, file):
+        return (not file.get('trashed') and file.get('mimeType') in BOOK_MIME_TYPES
+                and self.folder_id in file.get('parents', []))
+
+    @staticmethod
+    def _entry(file):
+        return {k: file[k] for k in ('id', 'name', 'md5Checksum', 'modifiedTime', 'size') if k in file}
+
+    def _publish(self, books):
+        with self._lock:
+            self._books = books
+            self._sorted = sorted(books.values(), key=lambda b: b['name'])
+        self.last_sync = time.time()
+        self._loaded.set()
+
+    def _full_sync(self, service):
+        # الـ start token يُؤخذ قبل القراءة حتى لا تضيع التغييرات التي تحدث أثناءها
+        start_token = service.changes().getStartPageToken().execute()['startPageToken']
+        query = (f"'{self.folder_id}' in parents and ("
+                 + " or ".join(f"mimeType='{m}'" for m in BOOK_MIME_TYPES) + ") and trashed=false")
+        books, page_token = {}, None
+        while True:
+            results = service.files().list(
+                q=query, pageSize=self.page_size, pageToken=page_token,
+                fields=f"nextPageToken, files({FILE_FIELDS})"
+            ).execute()
+            for file in results.get('files', []):
+                books[file['id']] = self._entry(file)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        self._page_token = start_token
+        self._last_full_sync = time.monotonic()
+        self.full_syncs += 1
+        self._publish(books)
+
+    def _delta_sync(self, service):
+        with self._lock:
+            books = dict(self._books)
+        page_token, applied = self._page_token, 0
+        while page_token:
+            results = service.changes().list(
+                pageToken=page_token, pageSize=self.page_size, spaces='drive',
+                fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({FILE_FIELDS}))"
+            ).execute()
+            for change in results.get('changes', []):
+                file = change.get('file')
+                if change.get('removed') or not file or not self._is_book(file):
+                    applied += books.pop(change['fileId'], None) is not None
+                else:
+                    books[file['id']] = self._entry(file)
+                    applied += 1
+            if results.get('newStartPageToken'):
+                self._page_token = results['newStartPageToken']
+                break
+            page_token = results.get('nextPageToken')
+        self.delta_syncs += 1
+        self.changes_applied += applied
+        if applied or not self._loaded.is_set():
+            self._publish(books)
+        else:
+            self.last_sync = time.time()
+
+    def refresh(self):
+        """مزامنة واحدة: تدريجية إن أمكن، وإلا كاملة. ترجع True عند النجاح."""
+        with self._sync_lock:
+            service = self.service_factory()
+            if service is None:
+                return False
+            try:
+                if self._page_token is None or time.monotonic() - self._last_full_sync > self.full_sync_interval:
+                    self._full_sync(service)
+                else:
+                    self._delta_sync(service)
+                self.last_error = None
+                return True
+            except Exception as e:
+                # page token منتهي أو خطأ مؤقت: المزامنة التالية تكون كاملة
+                print(f"خطأ في مزامنة قائمة الكتب من Drive: {e}")
+                self.last_error = str(e)
+                self._page_token = None
+                return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """تشغيل المزامنة الدورية في خيط خلفي."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="book-catalog", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "books": len(self),
+            "full_syncs": self.full_syncs,
+            "delta_syncs": self.delta_syncs,
+            "changes_applied": self.changes_applied,
+            "last_sync_age": round(time.time() - self.last_sync) if self.last_sync else None,
+            "last_error": self.last_error,
+        }
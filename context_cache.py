@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  كاش سياق Gemini (cachedContents) لجلسات البحث في الكتب
+# ==============================================================================
+import math
+import time
+import asyncio
+import threading
+
+
+class _CachedContext:
+    def __init__(self, name, expires_at):
+        self.name = name
+        self.expires_at = expires_at
+        self.uses = 0
+
+
+class ContextCacheManager:
+    """
+    نص الكتاب يُرفع إلى Gemini مرة واحدة كـ cachedContent، والأسئلة التالية تشير إليه بالاسم بدلاً من
+    إعادة إرسال النص المرجعي مع كل سؤال. الكاش في Gemini تابع للمفتاح (المشروع) الذي أنشأه، لذلك
+    يُتتبع لكل (مفتاح, كتاب, نسخة) ويُشارك بين كل المستخدمين الذين يقرؤون نفس الكتاب.
+
+    مدة الصلاحية ttl تُمدد عند الاستخدام، والجلسات (المستخدمون داخل الكتاب) تُتتبع: عندما يغادر آخر مستخدم
+    الكتاب أو تمر idle_timeout ثانية بدون أسئلة تُحذف كل كاشات الكتاب.
+    الكتب الأقل من min_tokens رمزاً لا تُرفع (أقل حجم يقبله Gemini لـ cachedContents: 32768 رمزاً).
+    model اسم نموذج بنسخة محددة (مثل gemini-1.5-flash-001): API الكاش لا يقبل الأسماء بدون نسخة، وطلبات
+    generateContent التي تستخدم الكاش يجب أن تُرسل لنفس النموذج.
+
+    الكاش يُستخدم فقط إذا كانت كلفته طوال الجلسة أقل من الاسترجاع (بوحدة رمز إدخال عادي، cache_cost):
+    رفع الكتاب مرة، ثم expected_questions سؤالاً يُحاسب كل منها على رموز الكتاب كاملاً بسعر cached_price،
+    والتخزين storage_price لكل رمز في الساعة لمدة idle_timeout على الأقل؛ مقابل expected_questions سؤالاً
+    يُرسل مع كل منها retrieval_chars حرفاً بالسعر الكامل. الكتاب الأغلى لا يُرفع (retrieval_chars=None يلغي الشرط).
+    الرموز تُقدر من عدد الأحرف بـ estimator (TokenEstimator المُعاير من usageMetadata) أو 0.25 رمز لكل حرف.
+    كل الدوال async تعمل على حلقة engine؛ touch/leave آمنة من أي خيط.
+    """
+
+    def __init__(self, api_base, model, session_factory, ttl=900, idle_timeout=900,
+                 min_tokens=32768, failure_ttl=3600, system_instruction="", cached_price=0.25,
+                 storage_price=13.3, expected_questions=10, retrieval_chars=12000, estimator=None):
+        self.api_base = api_base
+        self.model = model
+        self.session_factory = session_factory  # دالة ترجع جلسة aiohttp المشتركة
+        self.ttl = ttl
+        self.idle_timeout = idle_timeout
+        self.min_tokens = min_tokens
+        self.failure_ttl = failure_ttl
+        self.system_instruction = system_instruction
+        self.cached_price = cached_price
+        self.storage_price = storage_price
+        self.expected_questions = expected_questions
+        self.retrieval_chars = retrieval_chars
+        self.estimator = estimator
+        self._caches = {}    # (api_key, book_id, version) -> _CachedContext
+        self._creating = {}  # (api_key, book_id, version) -> asyncio.Future
+        self._unsupported = {}  # (book_id, version) -> وقت انتهاء تجاهل الكتاب (حجم غير مناسب أو رفض API)
+        self._sessions = {}  # user_id -> (book_id, آخر نشاط)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.deleted = 0
+        self.failed = 0
+        self.too_small = 0
+        self.too_costly = 0
+
+    # --------------------------------------------------------------------------
+    #  الجلسات
+    # --------------------------------------------------------------------------
+    def touch(self, user_id, book_id):
+        """تسجيل نشاط المستخدم داخل الكتاب."""
+        with self._lock:
+            self._sessions[user_id] = (book_id, time.monotonic())
+
+    def leave(self, user_id):
+        """المستخدم غادر الكتاب. يرجع آي دي الكتاب إذا لم يعد فيه أحد (لحذف كاشاته)، وإلا None."""
+        with self._lock:
+            session = self._sessions.pop(user_id, None)
+            if session is None:
+                return None
+            book_id = session[0]
+            if any(b == book_id for b, _ in self._sessions.values()):
+                return None
+            return book_id
+
+    def _active_books(self):
+        now = time.monotonic()
+        with self._lock:
+            for user_id, (book_id, last_seen) in list(self._sessions.items()):
+                if now - last_seen > self.idle_timeout:
+                    del self._sessions[user_id]
+            return {book_id for book_id, _ in self._sessions.values()}
+
+    def tokens(self, chars):
+        tokens_per_char = self.estimator.tokens_per_char if self.estimator is not None else 0.25
+        return math.ceil(chars * tokens_per_char)
+
+    def cache_cost(self, tokens):
+        """كلفة كاش كتاب بـ tokens رمزاً طوال الجلسة: الرفع، وأسئلة expected_questions بسعر الكاش، والتخزين."""
+        return tokens * (1 + self.expected_questions * self.cached_price + self.storage_price * self.idle_timeout / 3600)
+
+    def retrieval_cost(self):
+        """كلفة إرسال أجزاء الاسترجاع (retrieval_chars حرفاً) مع expected_questions سؤالاً."""
+        return self.expected_questions * self.tokens(self.retrieval_chars)
+
+    def cheaper_than_retrieval(self, chars):
+        """هل كاش كتاب بطول chars حرفاً أرخص طوال الجلسة من إرسال أجزاء الاسترجاع مع كل سؤال؟"""
+        return self.retrieval_chars is None or self.cache_cost(self.tokens(chars)) <= self.retrieval_cost()
+
+    # --------------------------------------------------------------------------
+    #  طلبات cachedContents
+    # --------------------------------------------------------------------------
+    def _url(self, path, api_key, **params):
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        return f"{self.api_base}/v1beta/{path}?key={api_key}" + (f"&{query}" if query else "")
+
+    async def _create(self, api_key, book_id, text):
+        body = {
+            "model": f"models/{self.model}",
+            "displayName": f"book-{book_id}",
+            "contents": [{"role": "user", "parts": [{"text": text}]}],
+            "ttl": f"{self.ttl}s",
+        }
+        if self.system_instruction:
+            body["systemInstruction"] = {"parts": [{"text": self.system_instruction}]}
+        async with self.session_factory().post(self._url("cachedContents", api_key), json=body) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"HTTP {response.status}: {(await response.text())[:300]}")
+            return (await response.json())["name"]
+
+    async def _extend(self, api_key, cached):
+        try:
+            async with self.session_factory().patch(self._url(cached.name, api_key, updateMask="ttl"),
+                                                    json={"ttl": f"{self.ttl}s"}) as response:
+                if response.status < 400:
+                    cached.expires_at = time.monotonic() + self.ttl
+                    return True
+        except Exception as e:
+            print(f"فشل تمديد كاش السياق {cached.name}: {e!r}")
+        return False
+
+    async def _delete(self, api_key, name):
+        try:
+            async with self.session_factory().delete(self._url(name, api_key)) as response:
+                if response.status < 400 or response.status == 404:
+                    self.deleted += 1
+        except Exception as e:
+            print(f"فشل حذف كاش السياق {name}: {e!r}")
+
+    # --------------------------------------------------------------------------
+    #  الواجهة العامة
+    # --------------------------------------------------------------------------
+    async def get(self, api_key, book_id, version, load_text):
+        """
+        اسم الـ cachedContent لهذا الكتاب على هذا المفتاح (يُنشأ عند أول طلب)، أو None إذا لم يكن الكاش متاحاً
+        للكتاب (يُستخدم النص المرجعي العادي). load_text دالة متزامنة ترجع نص الكتاب.
+        """
+        book_key = (book_id, version)
+        if self._unsupported.get(book_key, 0) > time.monotonic():
+            return None
+        key = (api_key, book_id, version)
+        cached = self._caches.get(key)
+        if cached is not None:
+            remaining = cached.expires_at - time.monotonic()
+            if remaining > 30 and (remaining > self.ttl / 2 or await self._extend(api_key, cached)):
+                cached.uses += 1
+                self.reused += 1
+                return cached.name
+            self._caches.pop(key, None)
+
+        future = self._creating.get(key)
+        if future is not None:  # مستخدم آخر يرفع نفس الكتاب على نفس المفتاح الآن
+            return await asyncio.shield(future)
+
+        future = self._creating[key] = asyncio.get_running_loop().create_future()
+        name = None
+        try:
+            text = await asyncio.to_thread(load_text)
+            if not text or self.tokens(len(text)) < self.min_tokens:
+                self.too_small += 1
+                self._unsupported[book_key] = time.monotonic() + self.failure_ttl
+            elif not self.cheaper_than_retrieval(len(text)):
+                self.too_costly += 1
+                self._unsupported[book_key] = time.monotonic() + self.failure_ttl
+            else:
+                name = await self._create(api_key, book_id, text)
+                self._caches[key] = _CachedContext(name, time.monotonic() + self.ttl)
+                self.created += 1
+                print(f"تم إنشاء كاش سياق Gemini للكتاب {book_id}: {name}")
+        except Exception as e:
+            self.failed += 1
+            self._unsupported[book_key] = time.monotonic() + self.failure_ttl
+            print(f"فشل إنشاء كاش سياق Gemini للكتاب {book_id}: {e!r}. سيتم استخدام النص المرجعي العادي.")
+        finally:
+            del self._creating[key]
+            future.set_result(name)
+        return name
+
+    def invalidate(self, api_key, book_id, version):
+        """الكاش لم يعد موجوداً في Gemini (انتهى أو حُذف): يُنشأ من جديد عند الطلب التالي."""
+        self._caches.pop((api_key, book_id, version), None)
+
+    async def drop_book(self, book_id):
+        """حذف كل كاشات الكتاب من Gemini (على كل المفاتيح)."""
+        for key in [k for k in self._caches if k[1] == book_id]:
+            cached = self._caches.pop(key, None)
+            if cached is None:  # حُذف أثناء await سابق (sweep أو drop_book آخر أو invalidate)
+                continue
+            await self._delete(key[0], cached.name)
+
+    async def sweep(self):
+        """حذف كاشات الكتب التي لم يعد فيها مستخدمون نشطون، وتنظيف الكاشات المنتهية."""
+        active = self._active_books()
+        now = time.monotonic()
+        for key in list(self._caches):
+            if key[1] not in active:
+                await self.drop_book(key[1])
+            elif self._caches.get(key) and self._caches[key].expires_at <= now:
+                self._caches.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            sessions = len(self._sessions)
+        return {
+            "caches": len(self._caches),
+            "books": len({k[1] for k in self._caches}),
+            "sessions": sessions,
+            "created": self.created,
+            "reused": self.reused,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "too_small": self.too_small,
+            "too_costly": self.too_costly,
+        }
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  تحميل ملفات Drive على القرص مباشرة (أجزاء بحجم ثابت، استئناف، تحقق md5، حد للحجم)
+# ==============================================================================
+import os
+import time
+import fcntl
+import hashlib
+import threading
+
+
+class DriveDownloadError(Exception):
+    """فشل التحميل (انقطاع متكرر أو md5 لا يطابق)."""
+
+
+class DriveFileTooLarge(DriveDownloadError):
+    pass
+
+
+class DriveDownloader:
+    """
+    كل ملف يُكتب في directory باسم md5Checksum الخاص به (content-addressed): نفس المحتوى يُحمّل مرة واحدة
+    ويبقى صالحاً لأي نسخة أو كتاب بنفس المحتوى. التحميل يمر عبر ملف .part على أجزاء chunk_size بايت
+    (الذاكرة لا تحمل أكثر من جزء واحد مهما كبر الكتاب)، والانقطاع يُستأنف من آخر بايت مكتوب، سواء
+    داخل نفس الاستدعاء (retries) أو في التحميل التالي. الملف الناتج يُطابق مع md5 قبل اعتماده.
+
+    الملفات المكتملة تبقى على القرص حتى cache_bytes (الأقدم استخداماً يُحذف أولاً)، فإعادة استخراج نفس
+    الكتاب (مثلاً بعد حذف نصه من book_cache) لا تحتاج تحميلاً جديداً.
+    قفل fcntl على ملف .part يمنع عاملين (خيطين أو عمليتين) من تحميل نفس الملف معاً.
+    """
+
+    def __init__(self, directory="drive_cache", chunk_size=8 * 1024 * 1024, max_bytes=200 * 1024 * 1024,
+                 cache_bytes=1024 * 1024 * 1024, retries=3, min_age=600):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.cache_bytes = cache_bytes
+        self.retries = retries
+        self.min_age = min_age  # الملفات المستخدمة خلال آخر min_age ثانية لا تُحذف (قد يكون استخراجها جارياً)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.cache_hits = 0
+        self.resumed = 0
+        self.bytes_downloaded = 0
+        self.md5_mismatches = 0
+        self.rejected_too_large = 0
+
+    def path_for(self, name, suffix=""):
+        return os.path.join(self.directory, f"{name}{suffix}")
+
+    def download(self, name, fetch_range, size=None, md5=None, suffix=""):
+        """
+        مسار الملف على القرص بعد تحميله (أو مباشرة إذا كان محملاً من قبل).
+        name: اسم الملف في الكاش (md5Checksum إن وجد). fetch_range(start, end) ترجع بايتات [start, end].
+        size/md5: من بيانات الملف في Drive، للتحقق من الحجم قبل التحميل ومن المحتوى بعده.
+        """
+        if size is not None and self.max_bytes and size > self.max_bytes:
+            with self._lock:
+                self.rejected_too_large += 1
+            raise DriveFileTooLarge(f"حجم الملف {size} بايت أكبر من الحد ({self.max_bytes})")
+
+        path = self.path_for(name, suffix)
+        if self._touch(path):
+            return path
+
+        with open(f"{path}.part", "ab") as part:
+            fcntl.flock(part, fcntl.LOCK_EX)  # ينتظر أي تحميل جارٍ لنفس الملف
+            try:
+                if self._touch(path):  # اكتمل أثناء الانتظار
+                    if part.seek(0, os.SEEK_END) == 0:
+                        os.remove(f"{path}.part")  # ملف .part فارغ فُتح بعد اكتمال التحميل
+                    return path
+                self._fetch(part, fetch_range, size)
+                part.flush()
+                os.fsync(part.fileno())
+                if md5 and self._md5(f"{path}.part") != md5:
+                    with self._lock:
+                        self.md5_mismatches += 1
+                    part.truncate(0)  # المحتوى تالف: التحميل التالي يبدأ من الصفر
+                    raise DriveDownloadError("الملف المحمل لا يطابق md5Checksum")
+                os.replace(f"{path}.part", path)
+            finally:
+                fcntl.flock(part, fcntl.LOCK_UN)
+
+        with self._lock:
+            self.downloads += 1
+        self._evict(keep=path)
+        return path
+
+    def _fetch(self, part, fetch_range, size):
+        offset = part.seek(0, os.SEEK_END)
+        if offset:
+            with self._lock:
+                self.resumed += 1
+        failures = 0
+        while size is None or offset < size:
+            end = offset + self.chunk_size - 1
+            if size is not None:
+                end = min(end, size - 1)
+            try:
+                chunk = fetch_range(offset, end)
+            except Exception as e:
+                failures += 1
+                if failures > self.retries:
+                    raise DriveDownloadError(f"انقطع التحميل عند {offset} بايت: {e}") from e
+                with self._lock:
+                    self.resumed += 1
+                time.sleep(min(2 ** failures, 10))
+                continue  # نفس الجزء من نفس الموضع (ما كُتب قبله محفوظ في .part)
+            failures = 0
+            part.write(chunk)
+            with self._lock:
+                self.bytes_downloaded += len(chunk)
+            if self.max_bytes and offset + len(chunk) > self.max_bytes:
+                part.truncate(0)
+                with self._lock:
+                    self.rejected_too_large += 1
+                raise DriveFileTooLarge(f"الملف تجاوز الحد ({self.max_bytes} بايت) أثناء التحميل")
+            if len(chunk) < end - offset + 1:
+                offset += len(chunk)
+                break  # جزء ناقص = نهاية الملف (عندما لا يُعرف الحجم مسبقاً)
+            offset += len(chunk)
+        if size is not None and offset != size:
+            raise DriveDownloadError(f"اكتمل التحميل عند {offset} بايت من {size}")
+
+    def _md5(self, path):
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _touch(self, path):
+        """هل الملف محمل بالفعل؟ (ويُحدّث وقت استخدامه لترتيب الحذف)."""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self.cache_hits += 1
+        return True
+
+    def _evict(self, keep):
+        """حذف أقدم الملفات المكتملة حتى يصبح مجموعها ضمن cache_bytes."""
+        files = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".part") and entry.path != keep:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files) + os.path.getsize(keep)
+        for mtime, size, path in sorted(files):
+            if total <= self.cache_bytes or now - mtime < self.min_age:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "cache_hits": self.cache_hits,
+                "resumed": self.resumed,
+                "bytes_downloaded": self.bytes_downloaded,
+                "md5_mismatches": self.md5_mismatches,
+                "rejected_too_large": self.rejected_too_large,
+            }
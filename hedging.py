@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  مهلات متكيفة وطلبات احتياطية (Hedged Requests) لطلبات Gemini
+# ==============================================================================
+import asyncio
+import inspect
+import threading
+from collections import defaultdict, deque
+
+from key_pool import percentile
+
+
+class LatencyTracker:
+    """
+    آخر maxlen قياساً لكل مفتاح ونوع طلب ("response" = الرد الكامل، "first_chunk" = أول جزء من الرد المتدفق).
+    إذا لم يكن للمفتاح min_samples قياساً بعد تُستخدم قياسات كل المفاتيح معاً.
+    """
+
+    def __init__(self, maxlen=500, min_samples=20):
+        self.maxlen = maxlen
+        self.min_samples = min_samples
+        self._samples = defaultdict(lambda: deque(maxlen=self.maxlen))  # (key, kind) -> ثوانٍ
+        self._lock = threading.Lock()
+
+    def record(self, key, kind, seconds):
+        with self._lock:
+            self._samples[(key, kind)].append(seconds)
+
+    def _sorted(self, key, kind):
+        with self._lock:
+            own = list(self._samples.get((key, kind), ()))
+            if len(own) < self.min_samples:
+                own = [s for (k, t), samples in self._samples.items() if t == kind for s in samples]
+        return sorted(own) if len(own) >= self.min_samples else []
+
+    def percentile(self, key, kind, pct):
+        """النسبة المئوية pct لزمن المفتاح، أو None إذا لم تتوفر قياسات كافية."""
+        return percentile(self._sorted(key, kind), pct)
+
+    def timeout(self, key, kind, pct, multiplier, minimum, maximum):
+        """مهلة الطلب: النسبة pct من زمن المفتاح × multiplier بين minimum و maximum (maximum قبل توفر قياسات)."""
+        value = self.percentile(key, kind, pct)
+        if value is None:
+            return maximum
+        return min(maximum, max(minimum, value * multiplier))
+
+    def stats(self):
+        """p50/p95/p99 وعدد القياسات لكل نوع (كل المفاتيح معاً)."""
+        with self._lock:
+            kinds = defaultdict(list)
+            for (_, kind), samples in self._samples.items():
+                kinds[kind].extend(samples)
+        result = {}
+        for kind, samples in kinds.items():
+            samples.sort()
+            result[kind] = {"count": len(samples), "p50": percentile(samples, 50),
+                            "p95": percentile(samples, 95), "p99": percentile(samples, 99)}
+        return result
+
+
+class HedgeBudget:
+    """
+    رصيد الطلبات الاحتياطية: كل طلب أصلي يضيف ratio (حتى burst)، وكل طلب احتياطي يستهلك 1،
+    فلا تتجاوز الطلبات الاحتياطية على المدى الطويل نسبة ratio من الطلبات الأصلية (حصة المفاتيح الإضافية).
+    """
+
+    def __init__(self, ratio=0.1, burst=5):
+        self.ratio = ratio
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        """إعادة الرصيد إذا لم يُرسل الطلب الاحتياطي فعلاً (مثلاً لا يوجد مفتاح آخر متاح)."""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class HedgeRace:
+    """
+    سباق بين طلب أصلي وطلب احتياطي واحد على مفتاح آخر.
+    succeeded(result) تحدد النتيجة النهائية (نجاح أو خطأ لا فائدة من انتظار الطلب الآخر بعده)؛
+    أول نتيجة نهائية تفوز ويُلغى الطلب الآخر. الطلب المتدفق يستدعي claim() عند أول جزء من الرد
+    ليصبح هو الفائز قبل اكتماله (فلا يظهر للمستخدم ردان).
+    """
+
+    def __init__(self, succeeded):
+        self.succeeded = succeeded
+        self.hedge_fired = False
+        self.hedge_won = False
+        self._tasks = []
+        self._hedge_task = None
+        self._winner = None
+
+    def claim(self):
+        """يُستدعى من داخل الطلب: True إذا كان هو الفائز (ويُلغى الآخر)، False إذا سبقه الآخر."""
+        task = asyncio.current_task()
+        if self._winner is None:
+            self._winner = task
+            for other in self._tasks:
+                if other is not task:
+                    other.cancel()
+        return self._winner is task
+
+    async def run(self, primary, start_hedge, delay):
+        """
+        primary: coroutine الطلب الأصلي. start_hedge(): ترجع coroutine الطلب الاحتياطي أو None إذا لم يُسمح به
+        (ويمكن أن تكون async إذا احتاج حجز المفتاح انتظاراً).
+        delay: ثوانٍ قبل إطلاق الطلب الاحتياطي (None = بدون طلب احتياطي).
+        يرجع النتيجة الفائزة، أو نتيجة آخر طلب انتهى إذا فشل الاثنان.
+        """
+        loop = asyncio.get_running_loop()
+        hedge_at = None if delay is None else loop.time() + delay
+        pending = {self._start(primary)}
+        last = None
+        try:
+            while pending:
+                timeout = None if hedge_at is None else max(0.0, hedge_at - loop.time())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None  # الطلب الأصلي تأخر: محاولة واحدة فقط لإطلاق الطلب الاحتياطي
+                    coroutine = start_hedge()
+                    if inspect.iscoroutinefunction(start_hedge):
+                        coroutine = await coroutine
+                    if coroutine is not None:
+                        self.hedge_fired = True
+                        self._hedge_task = self._start(coroutine)
+                        pending.add(self._hedge_task)
+                    continue
+                for task in done:
+                    if task.cancelled():
+                        continue  # الخاسر بعد claim() من الطلب الآخر
+                    result = task.result()
+                    if self.succeeded(result):
+                        self.hedge_won = task is self._hedge_task
+                        return result
+                    last = result
+                if not pending:
+                    break
+                hedge_at = None  # الطلب الأصلي فشل بعد إطلاق الاحتياطي: ننتظر الاحتياطي فقط
+            return last
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _start(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.append(task)
+        return task
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  أدوات بناء قاعدة المعرفة على أقسام الكتاب كاملاً (Map-Reduce)
+# ==============================================================================
+import os
+import re
+import json
+import math
+import threading
+
+from fuzzywuzzy import fuzz
+
+from retrieval import split_into_chunks
+from kb_matcher import normalize_question
+
+
+def split_sections(text, section_chars=30000, max_sections=40):
+    """
+    تقسيم الكتاب إلى أقسام بحجم section_chars تقريباً (مع حدود الصفحات).
+    إذا كان الكتاب كبيراً جداً يُكبّر حجم القسم حتى لا يتجاوز العدد max_sections.
+    يرجع [(start, end, page_start, page_end), ...].
+    """
+    section_chars = max(section_chars, math.ceil(len(text) / max_sections))
+    return [tuple(chunk) for chunk in split_into_chunks(text, chunk_size=section_chars, overlap=0)]
+
+
+def parse_kb_response(gemini_response):
+    """استخلاص قائمة {standard_question, answer} من رد Gemini. ترفع ValueError إذا لم يكن الرد قائمة JSON صالحة."""
+    json_match = re.search(r'```json\n(.*?)\n```', gemini_response, re.DOTALL)
+    json_str = json_match.group(1) if json_match else gemini_response
+    generated_kb = json.loads(json_str)
+    if not isinstance(generated_kb, list):
+        raise ValueError("البيانات المستلمة ليست قائمة JSON.")
+    # فلترة أي إدخالات غير صالحة
+    return [entry for entry in generated_kb if isinstance(entry, dict) and "standard_question" in entry and "answer" in entry]
+
+
+class KBMerger:
+    """
+    دمج إدخالات الأقسام في قاعدة معرفة واحدة مع حذف المكرر: السؤال المطابق بعد التطبيع، أو السؤال شبه المطابق
+    (ratio >= threshold) بشرط أن تكون الإجابة شبه مطابقة أيضاً. الأسئلة المتقاربة لفظاً بإجابات مختلفة
+    (مثل خصائص الفلزات واللافلزات) تبقى كلها.
+    """
+
+    def __init__(self, entries=None, threshold=90, answer_chars=300):
+        self.threshold = threshold
+        self.answer_chars = answer_chars
+        self.entries = []
+        self._normalized = []  # (السؤال، بداية الإجابة) بعد التطبيع
+        self._questions = set()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+        self.add(entries or [])
+
+    def _is_duplicate(self, question, answer):
+        if question in self._questions:
+            return True
+        return any(fuzz.ratio(question, existing_question) >= self.threshold
+                   and fuzz.ratio(answer, existing_answer) >= self.threshold
+                   for existing_question, existing_answer in self._normalized)
+
+    def add(self, entries):
+        """إضافة إدخالات جديدة، يرجع عدد ما أُضيف فعلاً."""
+        added = 0
+        with self._lock:
+            for entry in entries:
+                question = normalize_question(entry['standard_question'])
+                answer = normalize_question(str(entry['answer'])[:self.answer_chars])
+                if not question or self._is_duplicate(question, answer):
+                    self.duplicates += 1
+                    continue
+                self.entries.append(entry)
+                self._normalized.append((question, answer))
+                self._questions.add(question)
+                added += 1
+        return added
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.entries)
+
+
+class KBBuildProgress:
+    """
+    تقدم بناء قاعدة المعرفة لكتاب، محفوظ في kb_<id>.progress.json بعد كل قسم،
+    حتى يستأنف البناء من حيث توقف إذا أُعيد تشغيل البوت أثناءه.
+    """
+
+    def __init__(self, book_id, version, total_sections):
+        self.path = f"kb_{book_id}.progress.json"
+        self.version = version
+        self.total_sections = total_sections
+        self.done = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, book_id):
+        """تحميل تقدم غير مكتمل إن وجد، وإلا None."""
+        path = f"kb_{book_id}.progress.json"
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        progress = cls(book_id, data.get("version"), data.get("total_sections", 0))
+        progress.done = set(data.get("done", []))
+        return progress
+
+    def is_complete(self):
+        return len(self.done) >= self.total_sections
+
+    def mark_done(self, section_index):
+        with self._lock:
+            self.done.add(section_index)
+            self._save()
+
+    def save(self):
+        """حفظ التقدم قبل أول قسم، حتى يبقى البناء معلقاً (ويُستأنف) حتى لو فشلت كل أقسامه."""
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"version": self.version, "total_sections": self.total_sections,
+                       "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        """حذف ملف التقدم بعد اكتمال البناء."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  مطابقة أسئلة قاعدة المعرفة بشكل متجه (NumPy) بدلاً من المقارنة واحداً واحداً
+# ==============================================================================
+import os
+import re
+import zlib
+import threading
+
+import numpy as np
+from fuzzywuzzy import fuzz, process
+
+from retrieval import normalize_arabic
+
+_WORD = re.compile(r'\w+')
+
+
+def normalize_question(text):
+    """تطبيع السؤال (نفس تطبيع الاسترجاع) ثم ترتيب كلماته كما يفعل token_sort_ratio."""
+    return " ".join(sorted(_WORD.findall(normalize_arabic(text))))
+
+
+def _bucket(feature, dim):
+    return zlib.crc32(feature.encode('utf-8')) % dim
+
+
+class KBMatcher:
+    """
+    مطابق مُجهز مسبقاً لقاعدة معرفة كتاب واحد.
+    كل سؤال في القاعدة ممثل بمتجه n-gram للحروف (cosine) ومتجه لمجموعة الكلمات (Jaccard) داخل مصفوفات NumPy،
+    فيُقيّم السؤال الجديد مقابل كل الإدخالات بعملية ضرب مصفوفات واحدة. أفضل top_k مرشحين فقط
+    يُعاد تقييمهم بـ fuzz.token_sort_ratio للحفاظ على نفس معنى حد التطابق (85%) المستخدم سابقاً.
+    إذا كانت أفضل درجة قريبة من الحد دون أن تبلغه (fallback_margin) تُقارن كل الأسئلة بـ token_sort_ratio
+    كالطريقة القديمة، حتى لا يضيع تطابق صحيح خارج المرشحين.
+    """
+
+    def __init__(self, entries, ngram=3, ngram_dim=512, token_dim=256):
+        self.entries = entries
+        self.questions = [entry['standard_question'] for entry in entries]
+        self.ngram = ngram
+        self.ngram_dim = ngram_dim
+        self.token_dim = token_dim
+        normalized = [normalize_question(q) for q in self.questions]
+        self.ngram_matrix = np.vstack([self._ngram_vector(q) for q in normalized]) if entries else np.zeros((0, ngram_dim), np.float32)
+        self.token_matrix = np.vstack([self._token_vector(q) for q in normalized]) if entries else np.zeros((0, token_dim), np.float32)
+        self.token_counts = self.token_matrix.sum(axis=1)
+        self.fallbacks = 0  # عدد مرات المقارنة الكاملة
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def nbytes(self):
+        """حجم المصفوفات في الذاكرة (لحساب ميزانية الذاكرة)."""
+        return self.ngram_matrix.nbytes + self.token_matrix.nbytes + self.token_counts.nbytes
+
+    # --------------------------------------------------------------------------
+    #  الحفظ والتحميل (حتى لا تُعاد بناء المصفوفات عند كل تحميل للقاعدة)
+    # --------------------------------------------------------------------------
+    def save(self, path, checksum):
+        """حفظ المصفوفات في ملف .npz مع checksum ملف القاعدة التي بُنيت منها."""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(tmp_path, ngram_matrix=self.ngram_matrix, token_matrix=self.token_matrix,
+                 meta=np.array([checksum, self.ngram, self.ngram_dim, self.token_dim], dtype=str))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, entries, checksum):
+        """تحميل مطابق محفوظ إذا كان مبنياً من نفس القاعدة (نفس checksum)، وإلا None."""
+        try:
+            with np.load(path) as data:
+                saved_checksum, ngram, ngram_dim, token_dim = data['meta'].tolist()
+                ngram, ngram_dim, token_dim = int(ngram), int(ngram_dim), int(token_dim)
+                if saved_checksum != checksum or len(data['ngram_matrix']) != len(entries):
+                    return None
+                matcher = cls.__new__(cls)
+                matcher.entries = entries
+                matcher.questions = [entry['standard_question'] for entry in entries]
+                matcher.ngram, matcher.ngram_dim, matcher.token_dim = ngram, ngram_dim, token_dim
+                matcher.ngram_matrix = data['ngram_matrix']
+                matcher.token_matrix = data['token_matrix']
+        except (OSError, ValueError, KeyError):
+            return None
+        matcher.token_counts = matcher.token_matrix.sum(axis=1)
+        matcher.fallbacks = 0
+        return matcher
+
+    # --------------------------------------------------------------------------
+    #  تمثيل النص كمتجهات
+    # --------------------------------------------------------------------------
+    def _ngram_vector(self, normalized):
+        vector = np.zeros(self.ngram_dim, np.float32)
+        padded = f" {normalized} "
+        for i in range(max(1, len(padded) - self.ngram + 1)):
+            vector[_bucket(padded[i:i + self.ngram], self.ngram_dim)] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _token_vector(self, normalized):
+        vector = np.zeros(self.token_dim, np.float32)
+        for token in set(normalized.split()):
+            vector[_bucket(token, self.token_dim)] = 1.0
+        return vector
+
+    # --------------------------------------------------------------------------
+    #  المطابقة
+    # --------------------------------------------------------------------------
+    def scores(self, query):
+        """درجة تقريبية (0 إلى 1) لكل إدخال في القاعدة دفعة واحدة."""
+        normalized = normalize_question(query)
+        cosine = self.ngram_matrix @ self._ngram_vector(normalized)
+        query_tokens = self._token_vector(normalized)
+        intersection = self.token_matrix @ query_tokens
+        union = self.token_counts + query_tokens.sum() - intersection
+        jaccard = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+        return 0.7 * cosine + 0.3 * jaccard
+
+    def top_k(self, query, k=40):
+        """أفضل k إدخالات كقائمة (رقم الإدخال, درجة token_sort_ratio) مرتبة تنازلياً."""
+        if not self.entries:
+            return []
+        approx = self.scores(query)
+        k = min(k, len(approx))
+        candidates = np.argpartition(-approx, k - 1)[:k]
+        ranked = [(int(i), fuzz.token_sort_ratio(query, self.questions[i])) for i in candidates]
+        # token_sort_ratio لا يهتم بترتيب الكلمات ("الفرق بين أ و ب" = "الفرق بين ب و أ")، فالتعادل يُحسم بـ ratio
+        ranked.sort(key=lambda item: (item[1], fuzz.ratio(query, self.questions[item[0]])), reverse=True)
+        return ranked
+
+    def match(self, query, threshold=85, k=40, fallback_margin=15):
+        """
+        أفضل إدخال إذا تجاوز حد التطابق: (رقم الإدخال, الدرجة, أفضل k للتسجيل)، وإلا None.
+        """
+        top = self.top_k(query, k)
+        if top and threshold - fallback_margin <= top[0][1] < threshold and len(self.questions) > k:
+            self.fallbacks += 1
+            best = process.extractOne(query, dict(enumerate(self.questions)), scorer=fuzz.token_sort_ratio)
+            if best and best[1] > top[0][1]:
+                top = [(best[2], best[1])] + top
+        if top and top[0][1] >= threshold:
+            return top[0][0], top[0][1], top
+        return None
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  قواعد المعرفة: فهرس صغير (manifest) + تحميل كسول عند أول استخدام + ميزانية للذاكرة
+# ==============================================================================
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from kb_matcher import KBMatcher
+from single_flight import SingleFlight
+
+_KB_FILE = re.compile(r'^kb_(.+)\.json$')
+
+
+class KBStore:
+    """
+    بدلاً من تحميل كل ملفات kb_<id>.json عند بدء التشغيل، يُحفظ ملف manifest صغير فيه لكل كتاب:
+    حجم الملف، عدد الإدخالات، checksum، ومسار فهرس المطابق (.npz).
+    القاعدة الكاملة ومطابقها يُحمّلان عند أول سؤال عن الكتاب فقط، والأقل استخداماً يُحذف من الذاكرة
+    إذا تجاوز المجموع memory_budget بايت. بدء التشغيل يقرأ الـ manifest فقط، ومطابقته مع الملفات
+    الموجودة فعلاً (reconcile) تتم في خيط خلفي. تحميل نفس الكتاب من عدة خيوط معاً يتم مرة واحدة (SingleFlight).
+    """
+
+    def __init__(self, directory=".", manifest_name="kb_manifest.json", memory_budget=128 * 1024 * 1024):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, manifest_name)
+        self.memory_budget = memory_budget
+        self._manifest = self._load_manifest()  # book_id -> {size, mtime, entries, checksum, matcher_index}
+        self._memory = OrderedDict()  # book_id -> (KBMatcher, حجمه التقريبي)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()  # book_id -> تحميل جارٍ
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    # --------------------------------------------------------------------------
+    #  المسارات والـ manifest
+    # --------------------------------------------------------------------------
+    def kb_path(self, book_id):
+        return os.path.join(self.directory, f"kb_{book_id}.json")
+
+    def matcher_index_path(self, book_id):
+        return os.path.join(self.directory, f"kb_{book_id}.matcher.npz")
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self):
+        """يُستدعى والقفل محجوز."""
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _describe(self, book_id, raw, entries):
+        stat = os.stat(self.kb_path(book_id))
+        return {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "entries": len(entries),
+            "checksum": hashlib.sha1(raw).hexdigest(),
+            "matcher_index": os.path.basename(self.matcher_index_path(book_id)),
+        }
+
+    def reconcile(self):
+        """
+        مطابقة الـ manifest مع ملفات kb_*.json الموجودة: يُقرأ فقط الملف الجديد أو الذي تغير حجمه/وقت تعديله
+        (مرة واحدة)، ويُحذف من الـ manifest ما لم يعد موجوداً. يرجع عدد الملفات التي أُعيدت فهرستها.
+        """
+        found = {}
+        for name in os.listdir(self.directory):
+            match = _KB_FILE.match(name)
+            if match and name != os.path.basename(self.manifest_path) and not name.endswith(".progress.json"):
+                found[match.group(1)] = name
+        with self._lock:
+            known = dict(self._manifest)
+        updated = {}
+        for book_id in found:
+            stat = os.stat(self.kb_path(book_id))
+            info = known.get(book_id)
+            if info and info["size"] == stat.st_size and info["mtime"] == stat.st_mtime:
+                continue
+            try:
+                raw, entries = self._read(book_id)
+            except (OSError, ValueError) as e:
+                print(f"تحذير: ملف قاعدة المعرفة للكتاب {book_id} تالف وسيتم تجاهله. الخطأ: {e}")
+                continue
+            updated[book_id] = self._describe(book_id, raw, entries)
+        removed = set(known) - set(found)
+        if updated or removed:
+            with self._lock:
+                self._manifest.update(updated)
+                for book_id in removed:
+                    self._manifest.pop(book_id, None)
+                self._save_manifest()
+        return len(updated)
+
+    def start(self):
+        """مطابقة الـ manifest في خيط خلفي حتى لا يتأخر بدء البوت."""
+        def run():
+            count = self.reconcile()
+            print(f"اكتملت فهرسة قواعد المعرفة: {len(self)} قاعدة ({count} ملف جديد أو معدل).")
+        threading.Thread(target=run, name="kb-manifest", daemon=True).start()
+
+    # --------------------------------------------------------------------------
+    #  القراءة والكتابة
+    # --------------------------------------------------------------------------
+    def _read(self, book_id):
+        with open(self.kb_path(book_id), "rb") as f:
+            raw = f.read()
+        entries = json.loads(raw)
+        if not isinstance(entries, list):
+            raise ValueError("قاعدة المعرفة ليست قائمة JSON.")
+        return raw, entries
+
+    def _remember(self, book_id, matcher):
+        """يُستدعى والقفل محجوز: إضافة المطابق للذاكرة وحذف الأقدم حتى نعود تحت الميزانية."""
+        size = matcher.nbytes + sum(len(e['standard_question']) + len(e['answer']) for e in matcher.entries) * 2
+        if book_id in self._memory:
+            self._memory_bytes -= self._memory.pop(book_id)[1]
+        self._memory[book_id] = (matcher, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_budget and len(self._memory) > 1:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, book_id):
+        """مطابق قاعدة المعرفة للكتاب (فيه .entries) محملاً عند الحاجة، أو None إذا لم توجد قاعدة."""
+        with self._lock:
+            if book_id in self._memory:
+                self._memory.move_to_end(book_id)
+                self.hits += 1
+                return self._memory[book_id][0]
+            info = self._manifest.get(book_id)
+        if info is not None and info["entries"] == 0:
+            return None
+        return self._loads.do(book_id, lambda: self._load(book_id, info))
+
+    def _load(self, book_id, info):
+        with self._lock:
+            if book_id in self._memory:  # اكتمل تحميل آخر قبل أن يبدأ هذا
+                return self._memory[book_id][0]
+        try:
+            raw, entries = self._read(book_id)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"تحذير: تعذر تحميل قاعدة المعرفة للكتاب {book_id}. الخطأ: {e}")
+            return None
+
+        checksum = hashlib.sha1(raw).hexdigest()
+        matcher = KBMatcher.load(self.matcher_index_path(book_id), entries, checksum)
+        if matcher is None:
+            matcher = KBMatcher(entries)
+            self._save_matcher(book_id, matcher, checksum)
+        with self._lock:
+            self.loads += 1
+            if info is None or info["checksum"] != checksum:
+                self._manifest[book_id] = self._describe(book_id, raw, entries)
+                self._save_manifest()
+            self._remember(book_id, matcher)
+        print(f"تم تحميل قاعدة المعرفة للكتاب {book_id} ({len(entries)} إدخال).")
+        return matcher
+
+    def _save_matcher(self, book_id, matcher, checksum):
+        """حفظ فهرس المطابق. الفشل لا يمنع استخدام المطابق المبني في الذاكرة (يُعاد بناؤه في التحميل التالي)."""
+        try:
+            matcher.save(self.matcher_index_path(book_id), checksum)
+        except (OSError, ValueError) as e:
+            print(f"تحذير: تعذر حفظ فهرس المطابق للكتاب {book_id}. الخطأ: {e}")
+
+    def entries(self, book_id):
+        matcher = self.get(book_id)
+        return list(matcher.entries) if matcher else []
+
+    def has_entries(self, book_id):
+        """هل للكتاب قاعدة معرفة غير فارغة؟ (من الـ manifest بدون تحميلها)"""
+        with self._lock:
+            if book_id in self._memory:
+                return len(self._memory[book_id][0]) > 0
+            info = self._manifest.get(book_id)
+        if info is None:
+            return bool(self.get(book_id))
+        return info["entries"] > 0
+
+    def put(self, book_id, entries):
+        """حفظ قاعدة المعرفة (كتابة ذرية) مع فهرس المطابق، وتحديث الـ manifest والذاكرة."""
+        raw = json.dumps(entries, indent=4, ensure_ascii=False).encode('utf-8')
+        path = self.kb_path(book_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        matcher = KBMatcher(entries)
+        self._save_matcher(book_id, matcher, hashlib.sha1(raw).hexdigest())
+        with self._lock:
+            self._manifest[book_id] = self._describe(book_id, raw, entries)
+            self._save_manifest()
+            self._remember(book_id, matcher)
+        return matcher
+
+    def __len__(self):
+        with self._lock:
+            return len(self._manifest)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "books": len(self._manifest),
+                "total_entries": sum(info["entries"] for info in self._manifest.values()),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  جدولة مفاتيح Gemini API حسب الحصة المتاحة (بدلاً من itertools.cycle)
+# ==============================================================================
+import time
+import asyncio
+import threading
+from collections import deque
+
+
+class KeyPoolExhausted(Exception):
+    """لم يتوفر أي مفتاح خلال مدة الانتظار المسموحة."""
+
+
+class TokenBucket:
+    """
+    دلو رموز (Token Bucket) لحصة محددة في نافذة زمنية (افتراضياً دقيقة).
+    السعة (الدفعة الفورية) جزء صغير من الحصة، ومعدل الملء هو الباقي موزعاً على النافذة،
+    بحيث لا يتجاوز مجموع أي نافذة متحركة الحصة الفعلية التي يفرضها Gemini.
+    """
+
+    def __init__(self, limit, window=60.0, burst_ratio=0.1):
+        burst = max(1.0, min(float(limit), limit * burst_ratio))
+        self.capacity = burst
+        self.rate = max(float(limit) - burst, 1.0) / window
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount):
+        """عدد الثواني حتى يتوفر amount من الرموز (بعد استدعاء refill)."""
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+
+class KeyState:
+    """حالة مفتاح واحد: الحصة المتبقية، فترة التبريد، والإحصائيات."""
+
+    def __init__(self, key, rpm, tpm, window):
+        self.key = key
+        self.requests_bucket = TokenBucket(rpm, window)
+        self.tokens_bucket = TokenBucket(tpm, window, burst_ratio=0.5)
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.total_requests = 0
+        self.outcomes = deque(maxlen=200)  # (الوقت, رمز الحالة) لحساب نسبة 429 الأخيرة
+        self.latencies = deque(maxlen=500)
+
+    @property
+    def label(self):
+        """اسم مختصر للمفتاح لا يكشف قيمته."""
+        return f"{self.key[:4]}…{self.key[-4:]}" if len(self.key) > 8 else "****"
+
+    def headroom(self, now):
+        """نسبة الحصة المتاحة (0 إلى 1) مع خصم بسيط للطلبات الجارية."""
+        self.requests_bucket.refill(now)
+        self.tokens_bucket.refill(now)
+        ratio = min(self.requests_bucket.tokens / self.requests_bucket.capacity,
+                    self.tokens_bucket.tokens / self.tokens_bucket.capacity)
+        return ratio - 0.01 * self.in_flight
+
+
+class KeyLease:
+    """مفتاح محجوز لطلب واحد، يجب إعادته عبر KeyPool.release."""
+
+    def __init__(self, state, estimated_tokens):
+        self.state = state
+        self.key = state.key
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+
+    @property
+    def label(self):
+        return self.state.label
+
+
+class KeyPool:
+    """
+    يوزع الطلبات على المفتاح صاحب أكبر حصة متاحة (طلبات/دقيقة و رموز/دقيقة).
+    المفتاح الذي يرجع 429 أو 5xx يدخل فترة تبريد، وعند نفاد كل المفاتيح ينتظر المستدعون
+    في طابور عادل (الأسبق فالأسبق) بدلاً من النوم العشوائي.
+    """
+
+    def __init__(self, keys, rpm=15, tpm=1000000, cooldown=30.0, server_error_cooldown=5.0, max_cooldown=300.0,
+                 window=60.0):
+        if not keys:
+            raise ValueError("يجب توفير مفتاح API واحد على الأقل.")
+        self.keys = [KeyState(key, rpm, tpm, window) for key in keys]
+        self.cooldown = cooldown
+        self.server_error_cooldown = server_error_cooldown
+        self.max_cooldown = max_cooldown
+        self._cond = threading.Condition()
+        self._waiters = deque()
+
+    # --------------------------------------------------------------------------
+    #  حجز وإعادة المفاتيح
+    # --------------------------------------------------------------------------
+    def acquire(self, estimated_tokens=1000, timeout=None):
+        """انتظار دور الطلب في الطابور ثم حجز أفضل مفتاح متاح."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        with self._cond:
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    wait = None
+                    if self._waiters[0] is ticket:
+                        state, wait = self._pick(estimated_tokens)
+                        if state is not None:
+                            self._waiters.popleft()
+                            self._cond.notify_all()  # إيقاظ الطلب التالي في الطابور
+                            return self._lease(state, estimated_tokens)
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise KeyPoolExhausted("انتهت مهلة انتظار مفتاح API متاح.")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    self._cond.notify_all()
+                raise
+
+    async def acquire_async(self, estimated_tokens=1000, timeout=None):
+        """
+        نسخة asyncio من acquire تشارك نفس الطابور العادل، لكنها تنتظر بـ asyncio.sleep
+        بدلاً من حجز خيط.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = object()
+        with self._cond:
+            self._waiters.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = 0.05  # من ليس في مقدمة الطابور يعيد المحاولة بعد فترة قصيرة
+                    if self._waiters[0] is ticket:
+                        state, wait = self._pick(estimated_tokens)
+                        if state is not None:
+                            self._waiters.popleft()
+                            self._cond.notify_all()
+                            return self._lease(state, estimated_tokens)
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise KeyPoolExhausted("انتهت مهلة انتظار مفتاح API متاح.")
+                    wait = min(wait, remaining)
+                await asyncio.sleep(wait)
+        except BaseException:
+            with self._cond:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    self._cond.notify_all()
+            raise
+
+    def try_acquire(self, estimated_tokens=1000, exclude=()):
+        """
+        حجز مفتاح متاح الآن (غير المفاتيح في exclude) بدون انتظار، أو None.
+        تُستخدم للطلبات الاحتياطية: لا تتخطى من ينتظر في الطابور ولا تنتظر حصة جديدة.
+        """
+        with self._cond:
+            if self._waiters:
+                return None
+            state, _ = self._pick(estimated_tokens, exclude)
+            return self._lease(state, estimated_tokens) if state is not None else None
+
+    async def try_acquire_async(self, estimated_tokens=1000, exclude=()):
+        """نفس try_acquire (بنفس واجهة SharedKeyPool، حيث الاستدعاء يمر عبر العملية الأمامية)."""
+        return self.try_acquire(estimated_tokens, exclude)
+
+    async def release_async(self, lease, status_code=None, failed=False, tokens_used=None, retry_after=None):
+        self.release(lease, status_code=status_code, failed=failed, tokens_used=tokens_used, retry_after=retry_after)
+
+    def release(self, lease, status_code=None, failed=False, tokens_used=None, retry_after=None):
+        """
+        إعادة المفتاح بعد انتهاء الطلب مع نتيجته:
+        429 أو 5xx أو فشل الاتصال يضع المفتاح في فترة تبريد.
+        """
+        now = time.monotonic()
+        with self._cond:
+            state = lease.state
+            state.in_flight -= 1
+            state.outcomes.append((now, status_code))
+            if not failed and status_code is not None and status_code < 400:
+                state.latencies.append(now - lease.started)
+
+            if tokens_used is not None:
+                # تصحيح التقدير المبدئي بالاستهلاك الفعلي من usageMetadata
+                state.tokens_bucket.refill(now)
+                state.tokens_bucket.consume(tokens_used - lease.estimated_tokens)
+
+            if status_code == 429:
+                state.consecutive_failures += 1
+                cooldown = retry_after or self.cooldown * (2 ** (state.consecutive_failures - 1))
+                state.cooldown_until = now + min(cooldown, self.max_cooldown)
+            elif failed or (status_code is not None and status_code >= 500):
+                state.consecutive_failures += 1
+                state.cooldown_until = now + self.server_error_cooldown
+            else:
+                state.consecutive_failures = 0
+            self._cond.notify_all()
+
+    # --------------------------------------------------------------------------
+    #  الإحصائيات
+    # --------------------------------------------------------------------------
+    def stats(self, window=300):
+        """إحصائيات كل مفتاح: الطلبات الجارية، نسبة 429 الأخيرة، ونسب زمن الاستجابة."""
+        now = time.monotonic()
+        result = []
+        with self._cond:
+            waiting = len(self._waiters)
+            for state in self.keys:
+                recent = [code for t, code in state.outcomes if now - t <= window]
+                latencies = sorted(state.latencies)
+                result.append({
+                    "key": state.label,
+                    "in_flight": state.in_flight,
+                    "waiting": waiting,
+                    "total_requests": state.total_requests,
+                    "recent_requests": len(recent),
+                    "rate_429": round(recent.count(429) / len(recent), 3) if recent else 0.0,
+                    "cooldown_remaining": round(max(0.0, state.cooldown_until - now), 1),
+                    "headroom": round(max(0.0, state.headroom(now)), 3),
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99),
+                })
+        return result
+
+    # --------------------------------------------------------------------------
+    #  دوال داخلية (تُستدعى والقفل محجوز)
+    # --------------------------------------------------------------------------
+    def _pick(self, estimated_tokens, exclude=()):
+        """اختيار المفتاح صاحب أكبر حصة متاحة، أو إرجاع أقل مدة انتظار حتى يتوفر مفتاح."""
+        now = time.monotonic()
+        best, best_headroom, min_wait = None, None, None
+        for state in self.keys:
+            if state.key in exclude:
+                continue
+            headroom = state.headroom(now)
+            wait = max(state.cooldown_until - now,
+                       state.requests_bucket.time_until(1),
+                       state.tokens_bucket.time_until(estimated_tokens))
+            if wait <= 0:
+                if best is None or headroom > best_headroom:
+                    best, best_headroom = state, headroom
+            elif min_wait is None or wait < min_wait:
+                min_wait = wait
+        return best, min_wait
+
+    def _lease(self, state, estimated_tokens):
+        estimated_tokens = min(estimated_tokens, state.tokens_bucket.capacity)
+        state.requests_bucket.consume(1)
+        state.tokens_bucket.consume(estimated_tokens)
+        state.in_flight += 1
+        state.total_requests += 1
+        return KeyLease(state, estimated_tokens)
+
+
+def percentile(sorted_values, pct):
+    """النسبة المئوية من قائمة مرتبة (بالثواني)، أو None إذا كانت فارغة."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 3)
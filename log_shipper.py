@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  إرسال اللوجات في الخلفية (طابور محدود + دمج الرسائل + احترام حدود المعدل)
+# ==============================================================================
+import time
+import queue
+import random
+import atexit
+import threading
+
+import requests
+
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+class LogShipper:
+    """
+    يستقبل رسائل اللوج من المعالجات (مجرد إضافة للطابور) ويرسلها خيط مستقل إلى بوت اللوجات.
+    الرسائل المتتالية تُدمج في رسالة واحدة حتى حد 4096 حرف، ويتم احترام حدود المعدل لمحادثة اللوجات.
+    عند الضغط الشديد يتم أخذ عينة فقط من اللوجات العادية، مع الاحتفاظ دائماً باللوجات المهمة (الأخطاء).
+    """
+
+    def __init__(self, bot_token, chat_id, max_queue=2000, min_interval=3.0, overload_ratio=0.8,
+                 overload_sample_rate=0.1, request_timeout=10, api_base="https://api.telegram.org"):
+        self.url = f"{api_base}/bot{bot_token}/sendMessage"
+        self.chat_id = chat_id
+        self.min_interval = min_interval  # محادثات المجموعات في تليجرام: ~20 رسالة في الدقيقة
+        self.overload_size = int(max_queue * overload_ratio)
+        self.overload_sample_rate = overload_sample_rate
+        self.request_timeout = request_timeout
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._session = requests.Session()  # اتصال واحد يعاد استخدامه (Keep-Alive)
+        self._pending = None  # رسالة مؤجلة لم تتسع في الدفعة السابقة
+        self._last_sent = 0.0
+        self._stop = threading.Event()
+        self.sent_messages = 0
+        self.sent_events = 0
+        self.dropped_events = 0
+        self.failed_events = 0  # دفعات فشل إرسالها (بعد استنفاد المحاولات) ولم تُرسل
+        self.sampled_out_events = 0
+
+        self._worker = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def submit(self, text, important=False):
+        """إضافة رسالة للطابور دون انتظار. لا ترفع أي استثناء."""
+        if self._stop.is_set():
+            return
+        if not important and self._queue.qsize() >= self.overload_size and random.random() > self.overload_sample_rate:
+            self.sampled_out_events += 1
+            return
+        try:
+            self._queue.put_nowait(text[:MAX_MESSAGE_LENGTH])
+        except queue.Full:
+            self.dropped_events += 1
+
+    def flush(self, timeout=15):
+        """انتظار إرسال كل ما في الطابور (يُستخدم عند الإيقاف)."""
+        deadline = time.monotonic() + timeout
+        while (self._queue.unfinished_tasks or self._pending) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def close(self, timeout=15):
+        """إرسال ما تبقى في الطابور ثم إيقاف الخيط."""
+        if self._stop.is_set():
+            return
+        self.flush(timeout)
+        self._stop.set()
+        self._worker.join(timeout=1)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "sent_messages": self.sent_messages,
+            "sent_events": self.sent_events,
+            "dropped_events": self.dropped_events,
+            "failed_events": self.failed_events,
+            "sampled_out_events": self.sampled_out_events,
+        }
+
+    # --------------------------------------------------------------------------
+    #  الخيط الخلفي
+    # --------------------------------------------------------------------------
+    def _next_batch(self):
+        """تجميع أكبر عدد من الرسائل في رسالة واحدة لا تتجاوز الحد الأقصى."""
+        if self._pending is not None:
+            first, self._pending = self._pending, None
+        else:
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                return None, 0
+
+        parts, length, count = [first], len(first), 1
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if length + len(SEPARATOR) + len(item) > MAX_MESSAGE_LENGTH:
+                self._pending = item  # تُرسل في الدفعة التالية
+                break
+            parts.append(item)
+            length += len(SEPARATOR) + len(item)
+            count += 1
+        return SEPARATOR.join(parts), count
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty() and self._pending is None):
+            text, count = self._next_batch()
+            if text is None:
+                continue
+            try:
+                self._send(text)
+                self.sent_messages += 1
+                self.sent_events += count
+            except Exception as e:
+                self.failed_events += count
+                print(f"❌ فشل إرسال اللوج، تم تجاهل {count} رسالة: {e}")
+            finally:
+                for _ in range(count):
+                    self._queue.task_done()
+
+    def _send(self, text):
+        params = {'chat_id': self.chat_id, 'text': text, 'parse_mode': 'Markdown', 'disable_web_page_preview': True}
+        for _ in range(3):
+            wait = self.min_interval - (time.monotonic() - self._last_sent)
+            if wait > 0:
+                time.sleep(wait)
+            response = self._session.post(self.url, json=params, timeout=self.request_timeout)
+            self._last_sent = time.monotonic()
+
+            if response.status_code == 429:  # تجاوز حد المعدل: ننتظر المدة التي يحددها تليجرام
+                retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+                time.sleep(retry_after)
+                continue
+            if response.status_code == 400 and 'parse_mode' in params:
+                # دمج عدة رسائل أو قصها قد يكسر تنسيق Markdown، نعيد الإرسال كنص عادي
+                params.pop('parse_mode')
+                continue
+            response.raise_for_status()
+            return
+        raise RuntimeError(f"تليجرام رفض الإرسال بعد 3 محاولات (آخر رد: {response.status_code})")
@@ -7,9 +7,14 @@ import os
 import json
 import re
 import time
-import io
-from threading import Lock
-from itertools import cycle
+import asyncio
+import secrets
+import signal
+import sys
+from threading import Lock, Thread, local
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 
 # تحميل المتغيرات من ملف .env (يجب أن يكون في نفس المجلد)
 from dotenv import load_dotenv
@@ -17,17 +22,37 @@ load_dotenv()
 
 # --- مكتبات أساسية للبوت والخدمات ---
 import telebot # مكتبة التليجرام
-import requests # لإجراء طلبات HTTP
-import fitz  # PyMuPDF لمعالجة ملفات PDF
+import aiohttp # طلبات HTTP غير متزامنة (Gemini)
 
 # --- مكتبات Google Drive API ---
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-
-# --- مكتبات المقارنة الذكية (Fuzzy Matching) ---
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
+from googleapiclient.errors import HttpError
+
+# --- وحدات المشروع ---
+from user_store import UserStore
+from ttl_cache import TTLCache
+from log_shipper import LogShipper
+from key_pool import KeyPool, KeyPoolExhausted, percentile
+from async_engine import AsyncEngine
+from stream_reply import StreamingReply, split_message
+from book_cache import BookTextCache
+from book_catalog import BookCatalog
+from drive_download import DriveDownloader, DriveDownloadError, DriveFileTooLarge
+from single_flight import SingleFlight, SingleFlightTimeout
+from answer_cache import AnswerCache
+from metrics import MetricsRegistry, MetricsServer
+from rate_limiter import RateLimiter, RateRule
+from send_queue import TelegramSendQueue, QueuedSender, BULK
+from context_cache import ContextCacheManager
+from hedging import LatencyTracker, HedgeBudget, HedgeRace
+from prompt_builder import TokenEstimator, PromptBuilder, contents_chars, fold_digest
+from workers import WorkerPool, SharedKeyPool, serve_key_pool, poll_updates, worker_environment, WORKER_UPDATE_PATH
+from retrieval import BookIndex, PAGE_SEPARATOR
+from pdf_extract import PDFExtractor, PDFExtractionError, PDFEncryptedError, PDFExtractionTimeout
+from kb_store import KBStore # قواعد المعرفة ومطابقها الذكي (Fuzzy Matching)، تُحمّل عند الحاجة
+from kb_builder import split_sections, parse_kb_response, KBMerger, KBBuildProgress
 
 # ==============================================================================
 #  الإعدادات والمتغيرات العامة (Constants)
@@ -51,134 +76,335 @@ if missing_vars:
     print(f"خطأ فادح: المتغيرات التالية مفقودة في ملف .env: {', '.join(missing_vars)}")
     raise ValueError("أحد متغيرات البيئة المطلوبة غير موجود!")
 
+# خادم Bot API بديل (Local Bot API Server أو خادم وهمي لاختبارات الحمل)، والافتراضي api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
 # ==============================================================================
 #  إنشاء كائن البوت الرئيسي (هذا هو المكان الصحيح)
 # ==============================================================================
 bot = telebot.TeleBot(BOT_TOKEN)
 # ==============================================================================
 
+# --- التشغيل على عدة عمليات (BOT_WORKERS > 1) ---
+# عملية أمامية تستقبل التحديثات (polling أو webhook) وتوزعها على BOT_WORKERS عمال حسب chat_id،
+# وتدير مفاتيح Gemini لكل العمال. كل عامل هو main.py نفسه مع BOT_WORKER_INDEX (يحدده الأمامي).
+BOT_WORKERS = max(1, int(os.getenv('BOT_WORKERS', '1')))
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '8600'))  # العامل i يستقبل على 127.0.0.1:(WORKER_BASE_PORT + i)
+WORKER_INDEX = int(os.environ['BOT_WORKER_INDEX']) if os.getenv('BOT_WORKER_INDEX') else None
+IS_WORKER = WORKER_INDEX is not None
+
+def worker_file(path):
+    """ملفات الحالة الخاصة بكل عملية (مثل rate_limits.json) تصبح rate_limits.w<i>.json لكل عامل."""
+    if not IS_WORKER or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{WORKER_INDEX}{ext}"
+
+# ==============================================================================
+#  مقاييس الأداء لكل مرحلة (تُعرض على /metrics محلياً وفي أمر /stats)
+# ==============================================================================
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))  # 0 لتعطيل نقطة /metrics (العامل i يستخدم METRICS_PORT + i)
+metrics = MetricsRegistry()
+book_content_seconds = metrics.histogram("bot_book_content_seconds", "زمن get_book_content حسب المصدر", ("source",))
+drive_download_seconds = metrics.histogram("bot_drive_download_seconds", "زمن تحميل ملف الكتاب من Google Drive")
+pdf_extract_seconds = metrics.histogram("bot_pdf_extract_seconds", "زمن استخراج نص PDF")
+kb_build_seconds = metrics.histogram("bot_kb_build_seconds", "زمن generate_kb_from_book")
+kb_build_sections = metrics.counter("bot_kb_build_sections_total", "أقسام الكتب المعالجة لتوليد KB", ("result",))
+kb_match_seconds = metrics.histogram("bot_kb_match_seconds", "زمن مطابقة السؤال مع قاعدة المعرفة")
+kb_lookups = metrics.counter("bot_kb_lookups_total", "نتائج البحث في قاعدة المعرفة", ("result",))
+gemini_key_wait_seconds = metrics.histogram("bot_gemini_key_wait_seconds", "انتظار مفتاح Gemini متاح لكل محاولة")
+gemini_attempt_seconds = metrics.histogram("bot_gemini_attempt_seconds", "زمن كل محاولة طلب Gemini", ("key", "outcome"))
+membership_check_seconds = metrics.histogram("bot_membership_check_seconds", "زمن طلب getChatMember (بدون إصابات الكاش)")
+telegram_queue_seconds = metrics.histogram("bot_telegram_queue_wait_seconds", "انتظار الرسالة في طابور الإرسال", ("method",))
+telegram_send_seconds = metrics.histogram("bot_telegram_send_seconds", "زمن طلب الإرسال إلى تليجرام", ("method", "outcome"))
+gemini_prompt_tokens = metrics.histogram("bot_gemini_prompt_tokens", "رموز الطلب المرسلة لكل طلب Gemini (من usageMetadata، بدون الكاش)",
+                                         buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000))
+gemini_hedges = metrics.counter("bot_gemini_hedges_total", "الطلبات الاحتياطية لـ Gemini: fired/won/lost/no_budget/no_key", ("result",))
+answers_total = metrics.counter("bot_answers_total", "الإجابات المرسلة حسب مصدرها", ("source",))
+
+def kb_hit_ratio():
+    """نسبة الأسئلة (في كتب لها KB) التي أُجيبت من قاعدة المعرفة."""
+    hits, misses = kb_lookups.value(result="hit"), kb_lookups.value(result="miss")
+    return hits / (hits + misses) if hits + misses else None
+
+def format_latency(histogram):
+    """p50/p95 وعدد القياسات لعرضها في /stats."""
+    count = sum(total for _, _, total in histogram.series().values())
+    if not count:
+        return "-"
+    return f"{histogram.quantile(0.5):.2f}/{histogram.quantile(0.95):.2f}s ({count})"
+
+def observe_telegram_send(method, queue_seconds, send_seconds, outcome):
+    telegram_queue_seconds.observe(queue_seconds, method=method)
+    telegram_send_seconds.observe(send_seconds, method=method, outcome=outcome)
+
+metrics.gauge("bot_kb_hit_ratio", "نسبة إجابات KB من أسئلة الكتب التي لها KB", kb_hit_ratio)
+metrics.gauge("bot_telegram_send_queue_depth", "الرسائل المنتظرة في طابور الإرسال", lambda: send_queue.stats()["queued"])
+metrics.gauge("bot_gemini_waiting_requests", "طلبات Gemini المنتظرة لمفتاح متاح", lambda: key_pool.stats()[0]["waiting"])
+
+# كل رسائل البوت الصادرة (إرسال/تعديل/حذف) تمر بطابور يطبق حدود تليجرام ويحترم retry_after عند خطأ 429
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))  # رسائل في الثانية لكل البوت
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1.0'))  # أقل فترة بين رسالتين لنفس المحادثة
+TELEGRAM_SEND_WORKERS = int(os.getenv('TELEGRAM_SEND_WORKERS', '16'))
+send_queue = TelegramSendQueue(global_rate=TELEGRAM_GLOBAL_RATE / BOT_WORKERS if IS_WORKER else TELEGRAM_GLOBAL_RATE,
+                               per_chat_interval=TELEGRAM_CHAT_INTERVAL,
+                               workers=TELEGRAM_SEND_WORKERS, observer=observe_telegram_send)
+tg = QueuedSender(bot, send_queue)
+
+# --- إعدادات التشغيل (Long Polling أو Webhook) ---
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling | webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # الرابط العام الذي يرسل إليه تليجرام (مثال: https://example.com/webhook)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '200'))
+engine = AsyncEngine(max_connections=HTTP_MAX_CONNECTIONS)  # حلقة asyncio لطلبات Gemini الطويلة
+
+
+# --- إعدادات إرسال اللوجات ---
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '2000'))
+LOG_MIN_INTERVAL = float(os.getenv('LOG_MIN_INTERVAL', '3'))  # أقل فترة بين رسالتين لمحادثة اللوجات
+log_shipper = LogShipper(LOG_BOT_TOKEN, LOG_CHAT_ID, max_queue=LOG_QUEUE_SIZE,
+                         min_interval=LOG_MIN_INTERVAL * BOT_WORKERS if IS_WORKER else LOG_MIN_INTERVAL,
+                         api_base=TELEGRAM_API_URL or "https://api.telegram.org")
 
 # --- إعدادات Gemini API ---
-API_KEYS = [key.strip() for key in API_KEYS_STRING.split(',')]
-api_key_cycler = cycle(API_KEYS) # لتبديل مفاتيح API وتوزيع الضغط
+API_KEYS = [key.strip() for key in API_KEYS_STRING.split(',') if key.strip()]
 MODEL = 'gemini-1.5-flash'
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com')
+# حصة كل مفتاح (حسب خطة Gemini) وفترات التبريد بعد الأخطاء
+GEMINI_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', '15'))
+GEMINI_KEY_TPM = int(os.getenv('GEMINI_KEY_TPM', '1000000'))
+GEMINI_429_COOLDOWN = float(os.getenv('GEMINI_429_COOLDOWN', '30'))
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'  # عرض رد Gemini تدريجياً أثناء توليده
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))  # أقل فترة بين تعديلين لنفس الرسالة
+CONTEXT_CACHE_ENABLED = os.getenv('CONTEXT_CACHE_ENABLED', '1') == '1'  # رفع نص الكتاب مرة واحدة كـ cachedContent
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', '900'))  # صلاحية الكاش في Gemini (تُمدد مع الاستخدام)
+CONTEXT_CACHE_IDLE = int(os.getenv('CONTEXT_CACHE_IDLE', '900'))  # حذف كاش الكتاب بعد هذه المدة بدون أسئلة
+CONTEXT_CACHE_MODEL = os.getenv('CONTEXT_CACHE_MODEL', 'gemini-1.5-flash-001')  # API الكاش يتطلب اسم نموذج بنسخة محددة
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('CONTEXT_CACHE_MIN_TOKENS', '32768'))  # أقل حجم يقبله Gemini لـ cachedContents
+CONTEXT_CACHE_PRICE_RATIO = float(os.getenv('CONTEXT_CACHE_PRICE_RATIO', '0.25'))  # سعر رمز الكاش نسبة لسعر رمز الإدخال
+CONTEXT_CACHE_STORAGE_PRICE = float(os.getenv('CONTEXT_CACHE_STORAGE_PRICE', '13.3'))  # تخزين رمز لساعة نسبة لسعر رمز الإدخال
+CONTEXT_CACHE_EXPECTED_QUESTIONS = int(os.getenv('CONTEXT_CACHE_EXPECTED_QUESTIONS', '10'))  # أسئلة متوقعة لكل كاش في الجلسة
+GEMINI_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', '60'))  # أقصى انتظار لمفتاح متاح
+# مهلة كل طلب = النسبة GEMINI_TIMEOUT_PERCENTILE من زمن المفتاح × GEMINI_TIMEOUT_MULTIPLIER (بين الحدين)
+GEMINI_TIMEOUT_PERCENTILE = float(os.getenv('GEMINI_TIMEOUT_PERCENTILE', '99'))
+GEMINI_TIMEOUT_MULTIPLIER = float(os.getenv('GEMINI_TIMEOUT_MULTIPLIER', '3'))
+GEMINI_TIMEOUT_MIN = float(os.getenv('GEMINI_TIMEOUT_MIN', '15'))
+GEMINI_TIMEOUT_MAX = float(os.getenv('GEMINI_TIMEOUT_MAX', '120'))  # تُستخدم أيضاً قبل توفر قياسات كافية
+# طلب احتياطي على مفتاح آخر إذا تأخر الرد أكثر من النسبة GEMINI_HEDGE_PERCENTILE من زمن المفتاح
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', '1') == '1'
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95'))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '1'))
+GEMINI_HEDGE_DEFAULT_DELAY = float(os.getenv('GEMINI_HEDGE_DEFAULT_DELAY', '10'))  # قبل توفر قياسات كافية
+GEMINI_HEDGE_BUDGET = float(os.getenv('GEMINI_HEDGE_BUDGET', '0.1'))  # أقصى نسبة طلبات احتياطية من الطلبات الأصلية
+GEMINI_HEDGE_BURST = float(os.getenv('GEMINI_HEDGE_BURST', '5'))
+gemini_latency = LatencyTracker()  # زمن الرد وأول جزء لكل مفتاح (للمهلات وتوقيت الطلب الاحتياطي)
+hedge_budget = HedgeBudget(GEMINI_HEDGE_BUDGET, GEMINI_HEDGE_BURST)
+if IS_WORKER: # حصص المفاتيح مشتركة بين العمال: الحجز يتم من KeyPool العملية الأمامية
+    key_pool_host, key_pool_port = os.environ['BOT_WORKER_KEY_POOL'].rsplit(':', 1)
+    key_pool = SharedKeyPool((key_pool_host, int(key_pool_port)), bytes.fromhex(os.environ['BOT_WORKER_AUTHKEY']))
+else:
+    key_pool = KeyPool(API_KEYS, rpm=GEMINI_KEY_RPM, tpm=GEMINI_KEY_TPM, cooldown=GEMINI_429_COOLDOWN) # لتوزيع الضغط على مفاتيح API
 
 # --- إعدادات Google Drive API ---
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 SERVICE_ACCOUNT_FILE = 'credentials.json' # يجب وضع ملف الصلاحيات هنا
+DRIVE_API_ENDPOINT = os.getenv('DRIVE_API_ENDPOINT', '')  # خادم Drive محلي للاختبار (بدون صلاحيات)، مثال: http://127.0.0.1:8000/drive/v3/
 DRIVE_FOLDER_ID = os.getenv('DRIVE_FOLDER_ID', '1767thuB9M0Zj9t1n1-lTsoFAhV68XF9r') # !<-- هام: استبدل بالآي دي الخاص بمجلدك
+CATALOG_REFRESH_SECONDS = int(os.getenv('CATALOG_REFRESH_SECONDS', '60'))  # كل كم ثانية تُجلب تغييرات المجلد
+BOOKS_PER_PAGE = int(os.getenv('BOOKS_PER_PAGE', '20'))  # عدد الكتب في كل صفحة من قائمة الكتب
+
+# --- إعدادات كاش نصوص الكتب ---
+BOOK_CACHE_DIR = os.getenv('BOOK_CACHE_DIR', 'book_cache')  # النصوص المستخرجة على القرص
+BOOK_CACHE_MEMORY_MB = int(os.getenv('BOOK_CACHE_MEMORY_MB', '256'))  # الحد الأقصى لنصوص الكتب في الذاكرة
+BOOK_LOAD_TIMEOUT = float(os.getenv('BOOK_LOAD_TIMEOUT', '600'))  # أقصى انتظار لتحميل كتاب يقوم به مستخدم آخر
+
+# --- إعدادات تحميل ملفات الكتب من Drive (على القرص مباشرة وليس في الذاكرة) ---
+DRIVE_DOWNLOAD_DIR = os.getenv('DRIVE_DOWNLOAD_DIR', 'drive_cache')  # ملفات الكتب الأصلية باسم md5 الخاص بها
+DRIVE_DOWNLOAD_CHUNK_MB = float(os.getenv('DRIVE_DOWNLOAD_CHUNK_MB', '8'))  # حجم كل جزء (أقصى ما يُحمل في الذاكرة)
+DRIVE_MAX_FILE_MB = float(os.getenv('DRIVE_MAX_FILE_MB', '200'))  # الكتب الأكبر تُرفض (0 = بدون حد)
+DRIVE_DOWNLOAD_CACHE_MB = float(os.getenv('DRIVE_DOWNLOAD_CACHE_MB', '1024'))  # أقصى حجم لملفات الكتب على القرص
+
+# --- إعدادات استخراج نص PDF ---
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', '0')) or os.cpu_count() or 1  # عدد العمليات (0 = عدد الأنوية)
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '2000'))  # الصفحات بعد هذا الحد لا تُستخرج
+PDF_EXTRACT_TIMEOUT = float(os.getenv('PDF_EXTRACT_TIMEOUT', '180'))  # أقصى زمن لاستخراج كتاب واحد
+
+# --- إعدادات الاسترجاع (إرسال أجزاء الكتاب المتعلقة بالسؤال فقط إلى Gemini) ---
+RETRIEVAL_CHUNK_SIZE = int(os.getenv('RETRIEVAL_CHUNK_SIZE', '1500'))  # حجم الجزء بالحروف
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv('RETRIEVAL_CHUNK_OVERLAP', '200'))
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '8'))
+RETRIEVAL_CHAR_BUDGET = int(os.getenv('RETRIEVAL_CHAR_BUDGET', '12000'))  # أقصى حجم للنص المرجعي في الطلب
+
+# --- ميزانية رموز الطلب (النص المرجعي + آخر المحاورات + ملخص ما سبقها) ---
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))  # أقصى رموز الطلب (تقديرياً) عدا الكاش
+PROMPT_HISTORY_RESERVE = int(os.getenv('PROMPT_HISTORY_RESERVE', '1000'))  # رموز محجوزة لسجل المحادثة قبل النص المرجعي
+PROMPT_DIGEST_TOKENS = int(os.getenv('PROMPT_DIGEST_TOKENS', '400'))  # أقصى رموز ملخص المحاورات القديمة في الطلب
+CHAT_HISTORY_MESSAGES = int(os.getenv('CHAT_HISTORY_MESSAGES', '20'))  # رسائل السجل المحفوظة كاملة (الأقدم تدخل الملخص)
+HISTORY_DIGEST_CHARS = int(os.getenv('HISTORY_DIGEST_CHARS', '1500'))  # أقصى حجم للملخص المحفوظ لكل مستخدم
+
+# --- إعدادات المطابقة مع قاعدة المعرفة ---
+KB_MATCH_THRESHOLD = int(os.getenv('KB_MATCH_THRESHOLD', '85'))  # نسبة التطابق المطلوبة للرد من KB
+KB_MEMORY_MB = int(os.getenv('KB_MEMORY_MB', '128'))  # الحد الأقصى لقواعد المعرفة المحملة في الذاكرة
+
+# --- إعدادات كاش الإجابات (الأسئلة المتكررة لا تُرسل إلى Gemini مرة أخرى) ---
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '5000'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(6 * 3600)))
+ANSWER_CACHE_FILE = os.getenv('ANSWER_CACHE_FILE', 'answer_cache.json')  # فارغ = بدون حفظ على القرص
+ANSWER_CACHE_HISTORY_TURNS = int(os.getenv('ANSWER_CACHE_HISTORY_TURNS', '1'))  # أسئلة المستخدم السابقة في مفتاح سؤال المتابعة (0 = لا يُخزن)
+
+# --- إعدادات توليد قاعدة المعرفة (على أقسام الكتاب كاملاً) ---
+KB_SECTION_CHARS = int(os.getenv('KB_SECTION_CHARS', '30000'))  # حجم القسم المرسل في كل طلب
+KB_MAX_SECTIONS = int(os.getenv('KB_MAX_SECTIONS', '40'))  # الكتب الأكبر تُقسم لأقسام أكبر بدلاً من زيادة العدد
+KB_BUILD_WORKERS = int(os.getenv('KB_BUILD_WORKERS', '4'))  # عدد الأقسام التي تُعالج بالتوازي
+KB_DEDUP_THRESHOLD = int(os.getenv('KB_DEDUP_THRESHOLD', '90'))  # تشابه السؤال والإجابة معاً الذي يُعتبر تكراراً
+KB_RESUME_MAX_ATTEMPTS = int(os.getenv('KB_RESUME_MAX_ATTEMPTS', '5'))  # محاولات استكمال البناء في الخلفية
+KB_RESUME_BACKOFF = float(os.getenv('KB_RESUME_BACKOFF', '60'))  # الفاصل بين المحاولات (ثوانٍ، يتضاعف)
 
 # --- إعدادات الاشتراك الإجباري ---
 YOUTUBE_CHANNEL_URL = os.getenv('YOUTUBE_CHANNEL_URL', 'https://www.youtube.com/@DowedarTech')
 TELEGRAM_CHANNEL_ID = os.getenv('TELEGRAM_CHANNEL_ID', '@dowedar_tech')
+MEMBER_STATUSES = ['creator', 'administrator', 'member']
+# مدة تخزين نتيجة التحقق من الاشتراك (بالثواني): للمشترك ولغير المشترك بشكل منفصل
+MEMBERSHIP_POSITIVE_TTL = int(os.getenv('MEMBERSHIP_POSITIVE_TTL', '600'))
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv('MEMBERSHIP_NEGATIVE_TTL', '30'))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '50000'))
+
+# --- المشرفون (لأوامر الإحصائيات) ---
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
 
 # --- إعدادات تحديد المعدل (Rate Limiting) ---
+# كل قاعدة بالشكل "limit/window[:burst]" (مثال: "4/60:2")، والقيمة الفارغة تعطلها.
+# COOLDOWN_SECONDS هي القاعدة الافتراضية لكل مستخدم (سؤال واحد كل N ثانية) ما لم تُحدد RATE_LIMIT_USER.
 COOLDOWN_SECONDS = int(os.getenv('COOLDOWN_SECONDS', '15'))
-
-# --- متغيرات عامة وقفل الملفات ---
-file_lock = Lock()  # لمنع التضارب عند قراءة/كتابة الملفات من عدة عمليات
-book_cache = {}  # لتخزين محتوى الكتب في الذاكرة لتسريع الوصول
-book_knowledge_bases = {}  # لتخزين قواعد المعرفة المولّدة للكتب في الذاكرة
+RATE_LIMIT_USER = os.getenv('RATE_LIMIT_USER') or (f"1/{COOLDOWN_SECONDS}" if COOLDOWN_SECONDS > 0 else "")
+RATE_LIMIT_GENERAL_CHAT = os.getenv('RATE_LIMIT_GENERAL_CHAT', '')  # لكل مستخدم في البحث العام فقط
+RATE_LIMIT_BOOK_CHAT = os.getenv('RATE_LIMIT_BOOK_CHAT', '')  # لكل مستخدم في البحث داخل الكتب فقط
+RATE_LIMIT_GLOBAL = os.getenv('RATE_LIMIT_GLOBAL', '')  # لكل أسئلة البوت معاً
+RATE_LIMIT_FILE = os.getenv('RATE_LIMIT_FILE', 'rate_limits.json')  # حفظ دوري للدلاء حتى لا تُصفّر عند إعادة التشغيل
+
+# --- إعدادات تخزين بيانات المستخدمين ---
+USERS_DB_FILE = os.getenv('USERS_DB_FILE', 'users.db')
+USERS_CACHE_SIZE = int(os.getenv('USERS_CACHE_SIZE', '2048'))
+
+# --- متغيرات عامة ---
+global_rate_rule = RateRule.parse("global", RATE_LIMIT_GLOBAL, scope="global")
+if global_rate_rule and IS_WORKER:
+    global_rate_rule.share(BOT_WORKERS)  # حدود المستخدم تبقى كاملة لأن كل مستخدم على عامل واحد
+rate_limiter = RateLimiter([
+    RateRule.parse("user", RATE_LIMIT_USER),
+    RateRule.parse("general_chat", RATE_LIMIT_GENERAL_CHAT, modes=["general_chat"]),
+    RateRule.parse("book_chat", RATE_LIMIT_BOOK_CHAT, modes=["book_chat"]),
+    global_rate_rule,
+], snapshot_path=worker_file(RATE_LIMIT_FILE))  # حدود الأسئلة لكل مستخدم/وضع/البوت كله
+user_store = UserStore(USERS_DB_FILE, cache_size=USERS_CACHE_SIZE, legacy_json_path="users.json")  # بيانات المستخدمين (SQLite)
+book_cache = BookTextCache(BOOK_CACHE_DIR, memory_budget=BOOK_CACHE_MEMORY_MB * 1024 * 1024)  # نصوص الكتب (ذاكرة + قرص)
+pdf_extractor = PDFExtractor(workers=PDF_EXTRACT_WORKERS, max_pages=PDF_MAX_PAGES, timeout=PDF_EXTRACT_TIMEOUT)  # استخراج نص PDF على عدة عمليات
+kb_store = KBStore(memory_budget=KB_MEMORY_MB * 1024 * 1024)  # قواعد المعرفة: manifest + تحميل كسول + ميزانية ذاكرة
+drive_downloader = DriveDownloader(DRIVE_DOWNLOAD_DIR, chunk_size=int(DRIVE_DOWNLOAD_CHUNK_MB * 1024 * 1024),
+                                   max_bytes=int(DRIVE_MAX_FILE_MB * 1024 * 1024),
+                                   cache_bytes=int(DRIVE_DOWNLOAD_CACHE_MB * 1024 * 1024))
+book_loads = SingleFlight()  # تحميل/توليد KB لنفس الكتاب مرة واحدة مهما تعدد الطالبون
+book_indexes = TTLCache(maxsize=50, default_ttl=6 * 3600)  # فهارس الاسترجاع للكتب المفتوحة حديثاً
+membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE)  # نتائج التحقق من الاشتراك في القناة
+token_estimator = TokenEstimator()  # يُعاير من usageMetadata لكل رد
+context_caches = ContextCacheManager(
+    GEMINI_API_BASE, CONTEXT_CACHE_MODEL, lambda: engine.session, ttl=CONTEXT_CACHE_TTL, idle_timeout=CONTEXT_CACHE_IDLE,
+    min_tokens=CONTEXT_CACHE_MIN_TOKENS, cached_price=CONTEXT_CACHE_PRICE_RATIO, storage_price=CONTEXT_CACHE_STORAGE_PRICE,
+    expected_questions=CONTEXT_CACHE_EXPECTED_QUESTIONS, retrieval_chars=RETRIEVAL_CHAR_BUDGET,  # الكاش فقط إذا كان أرخص من الاسترجاع
+    estimator=token_estimator,
+    system_instruction="أجب على أسئلة المستخدم بناءً على نص الكتاب المرفق فقط. إذا كانت الإجابة غير موجودة، قل 'الإجابة غير متوفرة في المصدر'."
+)  # كاش سياق Gemini لجلسات الكتب (مشترك بين المستخدمين)
+prompt_builder = PromptBuilder(token_estimator, budget=PROMPT_TOKEN_BUDGET, history_reserve=PROMPT_HISTORY_RESERVE,
+                               digest_tokens=PROMPT_DIGEST_TOKENS)
+ttft_samples = deque(maxlen=1000)  # زمن ظهور أول نص من رد Gemini للمستخدم (بالثواني)
+answer_cache = AnswerCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, persist_path=worker_file(ANSWER_CACHE_FILE) or None,
+                           history_turns=ANSWER_CACHE_HISTORY_TURNS)  # إجابات Gemini للأسئلة المتكررة
 
 # ==============================================================================
-#  دوال التعامل مع الملفات (users.json و قواعد المعرفة)
+#  دوال التعامل مع الملفات (قواعد المعرفة)
 # ==============================================================================
 
-def load_json_file(file_path, default_value):
-    """دالة عامة لتحميل ملف JSON مع معالجة الأخطاء."""
-    try:
-        with file_lock:
-            if os.path.exists(file_path):
-                with open(file_path, "r", encoding='utf-8') as f:
-                    return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"تحذير: لم يتم العثور على ملف {file_path} أو أنه تالف. سيتم استخدام القيمة الافتراضية. الخطأ: {e}")
-    except Exception as e:
-        print(f"خطأ غير متوقع عند تحميل {file_path}: {e}")
-    return default_value
-
-def save_json_file(file_path, data):
-    """دالة عامة لحفظ البيانات في ملف JSON."""
-    with file_lock:
-        try:
-            with open(file_path, "w", encoding='utf-8') as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
-        except Exception as e:
-            print(f"خطأ في حفظ الملف {file_path}: {e}")
-
-def load_users():
-    """تحميل بيانات المستخدمين من users.json."""
-    return load_json_file("users.json", {})
-
-def save_users(data):
-    """حفظ بيانات المستخدمين في users.json."""
-    save_json_file("users.json", data)
-
-def load_book_kb(book_id):
-    """تحميل قاعدة المعرفة لكتاب معين من ملف JSON الخاص به."""
-    kb_file_path = f"kb_{book_id}.json"
-    kb_data = load_json_file(kb_file_path, [])
-    book_knowledge_bases[book_id] = kb_data
-    if kb_data:
-        print(f"تم تحميل قاعدة المعرفة للكتاب {book_id} من الملف.")
-    else:
-        print(f"لا توجد قاعدة معرفة موجودة للكتاب {book_id}. سيتم توليدها عند الحاجة.")
-
 def save_book_kb(book_id, kb_data):
-    """حفظ قاعدة المعرفة لكتاب معين في ملف JSON."""
-    kb_file_path = f"kb_{book_id}.json"
-    save_json_file(kb_file_path, kb_data)
+    """حفظ قاعدة المعرفة لكتاب معين (ملف JSON + فهرس المطابق + manifest) وتحديثها في الذاكرة."""
+    kb_store.put(book_id, kb_data)
     print(f"تم حفظ قاعدة المعرفة للكتاب {book_id}.")
 
-def load_all_book_kbs():
-    """تحميل جميع قواعد المعرفة الموجودة في المجلد عند بدء تشغيل البوت."""
-    print("جاري تحميل قواعد المعرفة الموجودة مسبقاً...")
-    kb_files = [f for f in os.listdir('.') if f.startswith('kb_') and f.endswith('.json')]
-    for kb_file in kb_files:
-        book_id = kb_file.replace('kb_', '').replace('.json', '')
-        load_book_kb(book_id)
-    print("اكتمل تحميل قواعد المعرفة.")
+def book_index_path(book_id):
+    """مسار فهرس الاسترجاع الخاص بالكتاب (بجانب kb_<id>.json)."""
+    return f"index_{book_id}.json"
+
+def build_book_index(book_id, text, version):
+    """بناء فهرس الاسترجاع للكتاب وحفظه على القرص."""
+    index = BookIndex.build(text, version, chunk_size=RETRIEVAL_CHUNK_SIZE, overlap=RETRIEVAL_CHUNK_OVERLAP)
+    index.save(book_index_path(book_id))
+    book_indexes.set(book_id, index)
+    print(f"تم بناء فهرس الاسترجاع للكتاب {book_id} ({len(index.chunks)} جزء).")
+    return index
+
+def get_book_index(book_id, text, version=None):
+    """فهرس الكتاب من الذاكرة أو القرص، أو بناؤه إذا لم يكن موجوداً أو كان لنسخة قديمة من الكتاب."""
+    version = version or book_cache.latest_version(book_id)
+    found, index = book_indexes.get(book_id)
+    if found and index.version == version:
+        return index
+    index = BookIndex.load(book_index_path(book_id))
+    if index is not None and index.version == version:
+        book_indexes.set(book_id, index)
+        return index
+    return book_loads.do(("index", book_id, version), lambda: build_book_index(book_id, text, version))
 
 # ==============================================================================
 #  دوال Google Drive
 # ==============================================================================
 
+drive_credentials = None  # صلاحيات حساب الخدمة (تُحمّل مرة واحدة)
+drive_lock = Lock()
+drive_clients = local()  # عميل Drive لكل خيط، لأن httplib2 غير آمن للاستخدام من عدة خيوط
+
 def get_drive_service():
-    """إعداد وتجهيز خدمة Google Drive API."""
+    """خدمة Google Drive API طويلة العمر: تُنشأ مرة واحدة لكل خيط ثم يُعاد استخدامها."""
+    global drive_credentials
+    service = getattr(drive_clients, 'service', None)
+    if service is not None:
+        return service
     try:
-        creds = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        return build('drive', 'v3', credentials=creds)
+        if DRIVE_API_ENDPOINT:
+            drive_clients.service = build('drive', 'v3', credentials=AnonymousCredentials(), cache_discovery=False,
+                                          client_options={"api_endpoint": DRIVE_API_ENDPOINT})
+            return drive_clients.service
+        with drive_lock:
+            if drive_credentials is None:
+                drive_credentials = service_account.Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        drive_clients.service = build('drive', 'v3', credentials=drive_credentials, cache_discovery=False)
+        return drive_clients.service
     except Exception as e:
         print(f"خطأ في إعداد خدمة Google Drive: {e}")
         return None
 
-def list_books():
-    """جلب قائمة الكتب (PDF, TXT) من مجلد Google Drive المحدد."""
-    service = get_drive_service()
-    if not service: return []
-    try:
-        query = f"'{DRIVE_FOLDER_ID}' in parents and (mimeType='application/pdf' or mimeType='text/plain') and trashed=false"
-        results = service.files().list(q=query, fields="files(id, name)").execute()
-        return results.get('files', [])
-    except Exception as e:
-        print(f"خطأ في جلب قائمة الكتب: {e}")
-        return []
+# قائمة الكتب المشتركة: تُحدّث في الخلفية بالتغييرات فقط (Changes API) وتُعرض للمستخدمين فوراً
+book_catalog = BookCatalog(get_drive_service, DRIVE_FOLDER_ID, refresh_interval=CATALOG_REFRESH_SECONDS)
+
+BOOK_ERROR_PREFIXES = ("خطأ:", "عذراً،", "حدث خطأ أثناء محاولة الوصول للكتاب")
+
+def book_version(book_meta):
+    """نسخة الكتاب في Drive: md5Checksum إن وجد (ملفات PDF/TXT)، وإلا وقت آخر تعديل."""
+    return book_meta.get('md5Checksum') or book_meta.get('modifiedTime')
 
 # ==============================================================================
 #  الدوال الأساسية (Core Logic)
 # ==============================================================================
 
-def generate_kb_from_book(book_id, book_name, book_content, from_user):
-    """
-    تستخدم Gemini لتوليد قاعدة معرفة (KB) من نص الكتاب.
-    هذه هي الميزة الأساسية "Auto KB Generation".
-    """
-    print(f"⚠️ جاري توليد قاعدة المعرفة للكتاب '{book_name}' بواسطة Gemini...")
-    content_for_gemini = book_content[:30000] # نأخذ جزء من الكتاب لتجنب تجاوز حدود API
-
+def generate_section_kb(book_name, section_text, page_start, page_end, from_user):
+    """توليد أسئلة وأجوبة لقسم واحد من الكتاب. يرجع None إذا فشل تحليل الرد (ليُعاد القسم لاحقاً)."""
+    pages = f"الصفحة {page_start}" if page_start == page_end else f"الصفحات {page_start}-{page_end}"
     kb_generation_prompt = f"""
-أنت خبير في استخلاص المعلومات. بناءً على النص التالي من كتاب '{book_name}'، قم بتوليد قائمة من الأسئلة الشائعة وإجاباتها المختصرة.
+أنت خبير في استخلاص المعلومات. بناءً على النص التالي ({pages}) من كتاب '{book_name}'، قم بتوليد قائمة من الأسئلة الشائعة وإجاباتها المختصرة.
 صيغ الإجابات يجب أن تكون واضحة ومنظمة بتنسيق Markdown.
 الهدف هو إنشاء قاعدة معرفة للرد على المستخدمين.
 
@@ -190,92 +416,313 @@ def generate_kb_from_book(book_id, book_name, book_content, from_user):
 ]
 ```
 تأكد من أن الإجابات تستند فقط إلى النص المرفق. لا تقم بتضمين أي نص إضافي، فقط الـ JSON.
-يجب أن تحتوي القائمة على 5 إلى 20 سؤال وجواب.
+يجب أن تحتوي القائمة على 5 إلى 15 سؤال وجواب.
 --- بداية النص المرجعي ---
-{content_for_gemini}
+{section_text}
 --- نهاية النص المرجعي ---
 """
     gemini_response = send_to_gemini(from_user, kb_generation_prompt)
 
     try:
         # استخلاص وتنظيف الـ JSON من رد Gemini
-        json_match = re.search(r'```json\n(.*?)\n```', gemini_response, re.DOTALL)
-        json_str = json_match.group(1) if json_match else gemini_response
-        
-        generated_kb = json.loads(json_str)
-        
-        if isinstance(generated_kb, list):
-            # فلترة أي إدخالات غير صالحة
-            generated_kb = [entry for entry in generated_kb if "standard_question" in entry and "answer" in entry]
-            print(f"✅ تم توليد قاعدة معرفة تحتوي على {len(generated_kb)} إدخال للكتاب '{book_name}'.")
-            log_interaction(from_user, "💡 تم توليد KB جديدة", f"للكتاب: {book_name}\nعدد الإدخالات: {len(generated_kb)}")
-            return generated_kb
-        else:
-            raise ValueError("البيانات المستلمة ليست قائمة JSON.")
-            
+        return parse_kb_response(gemini_response)
     except (json.JSONDecodeError, ValueError, AttributeError) as e:
-        print(f"❌ فشل تحليل JSON من رد Gemini لـ KB الكتاب '{book_name}'. الخطأ: {e}. الرد: {gemini_response[:500]}...")
-        log_interaction(from_user, "❌ فشل توليد KB", f"للكتاب: {book_name}\nالرد غير صالح: `{gemini_response[:1000]}`")
-        return []
+        print(f"❌ فشل تحليل JSON من رد Gemini لـ KB الكتاب '{book_name}' ({pages}). الخطأ: {e}. الرد: {gemini_response[:500]}...")
+        log_interaction(from_user, "❌ فشل توليد KB", f"للكتاب: {book_name} ({pages})\nالرد غير صالح: `{gemini_response[:1000]}`")
+        return None
+
+def generate_kb_from_book(book_id, book_name, book_content, from_user, version=None, on_progress=None):
+    """
+    تستخدم Gemini لتوليد قاعدة معرفة (KB) من نص الكتاب كاملاً.
+    هذه هي الميزة الأساسية "Auto KB Generation".
+    الكتاب يُقسم لأقسام تُعالج بالتوازي (KB_BUILD_WORKERS) عبر key_pool، والنتائج تُدمج مع حذف الأسئلة المكررة
+    وتُحفظ في kb_<id>.json بعد كل قسم، فإذا توقف البوت يُستأنف البناء من الأقسام المتبقية فقط.
+    on_progress(done, total) تُستدعى بعد كل قسم.
+    """
+    build_started = time.perf_counter()
+    sections = split_sections(book_content, KB_SECTION_CHARS, KB_MAX_SECTIONS)
+    progress = KBBuildProgress.load(book_id)
+    if progress is not None and progress.version == version and progress.total_sections == len(sections):
+        merger = KBMerger(kb_store.entries(book_id), threshold=KB_DEDUP_THRESHOLD)
+        print(f"⚠️ استئناف توليد قاعدة المعرفة للكتاب '{book_name}' ({len(progress.done)}/{len(sections)} أقسام مكتملة)...")
+    else:
+        progress = KBBuildProgress(book_id, version, len(sections))
+        progress.save()
+        merger = KBMerger(threshold=KB_DEDUP_THRESHOLD)
+        print(f"⚠️ جاري توليد قاعدة المعرفة للكتاب '{book_name}' بواسطة Gemini ({len(sections)} أقسام)...")
+
+    pending = [i for i in range(len(sections)) if i not in progress.done]
+    failed_sections = 0
+    with ThreadPoolExecutor(max_workers=KB_BUILD_WORKERS) as executor:
+        futures = {}
+        for i in pending:
+            start, end, page_start, page_end = sections[i]
+            futures[executor.submit(generate_section_kb, book_name, book_content[start:end], page_start, page_end, from_user)] = i
+        for future in as_completed(futures):
+            entries = future.result()
+            if entries is None:
+                failed_sections += 1
+                kb_build_sections.inc(result="failed")
+                continue
+            kb_build_sections.inc(result="ok")
+            merger.add(entries)
+            # حفظ تدريجي: القاعدة الجزئية متاحة للمستخدمين وتبقى محفوظة إذا توقف البوت
+            partial_kb = merger.snapshot()
+            save_book_kb(book_id, partial_kb)
+            progress.mark_done(futures[future])
+            if on_progress:
+                on_progress(len(progress.done), len(sections))
+
+    generated_kb = merger.snapshot()
+    if progress.is_complete():
+        progress.finish()
+    kb_build_seconds.observe(time.perf_counter() - build_started)
+    print(f"✅ تم توليد قاعدة معرفة تحتوي على {len(generated_kb)} إدخال للكتاب '{book_name}'.")
+    log_interaction(from_user, "💡 تم توليد KB جديدة", (
+        f"للكتاب: {book_name}\nعدد الإدخالات: {len(generated_kb)}\n"
+        f"الأقسام: {len(progress.done)}/{len(sections)} (فشل: {failed_sections}) | أسئلة مكررة محذوفة: {merger.duplicates}"
+    ))
+    return generated_kb
+
+def kb_build_pending(book_id):
+    """هل يوجد بناء قاعدة معرفة لم يكتمل (مثلاً بسبب إعادة تشغيل البوت أثناءه)؟"""
+    progress = KBBuildProgress.load(book_id)
+    return progress is not None and not progress.is_complete()
+
+def ensure_book_kb(file_id, file_name, text, from_user, version=None):
+    """
+    توليد قاعدة المعرفة للكتاب عند أول تحميل مع إظهار التقدم للمستخدم.
+    كل بناء لنفس الكتاب (هنا أو في الاستئناف) يمر عبر book_loads بالمفتاح ("kb", file_id)، فلا يُبنى الكتاب مرتين معاً.
+    البناء المعلق (أقسام فشلت أو توقف البوت أثناءه) يُستكمل في الخلفية بدون انتظار المستخدم.
+    """
+    if kb_build_pending(file_id):
+        schedule_kb_resume(file_id, file_name, from_user, version)
+        return
+    if kb_store.has_entries(file_id):
+        return
+
+    def build():
+        status_msg = tg.send_message(from_user.id, f"⏳ لأول مرة، جاري تجهيز قاعدة المعرفة لكتاب '{file_name}'...")
+        last_update = [0.0]
+
+        def report_progress(done, total):
+            # تعديل الرسالة بحد أقصى مرة كل 3 ثوانٍ لتجنب حدود تليجرام
+            if done < total and time.time() - last_update[0] < 3:
+                return
+            last_update[0] = time.time()
+            try:
+                tg.edit_message_text(
+                    f"⏳ جاري تجهيز قاعدة المعرفة لكتاب '{file_name}': {done}/{total} أقسام ({done * 100 // total}%)...",
+                    status_msg.chat.id, status_msg.message_id, priority=BULK
+                )
+            except Exception as e:
+                print(f"فشل تحديث رسالة التقدم: {e}")
+
+        generated_kb = generate_kb_from_book(file_id, file_name, text, from_user, version, on_progress=report_progress)
+        save_book_kb(file_id, generated_kb)
+        if kb_build_pending(file_id):
+            tg.send_message(from_user.id, f"⚠️ تم تجهيز جزء من قاعدة المعرفة لكتاب '{file_name}'، وسيُستكمل الباقي في الخلفية. يمكنك الآن طرح أسئلتك!", wait=False)
+            schedule_kb_resume(file_id, file_name, from_user, version, delay=KB_RESUME_BACKOFF)
+        else:
+            tg.send_message(from_user.id, f"✅ تم تجهيز قاعدة المعرفة لكتاب '{file_name}'. يمكنك الآن طرح أسئلتك!", wait=False)
+        return True  # نفس معنى نتيجة resume في resume_book_kb (قد ينضم إليه استئناف كتابع)
+
+    try:
+        book_loads.do(("kb", file_id), build, timeout=BOOK_LOAD_TIMEOUT)
+    except SingleFlightTimeout:
+        pass  # البناء مستمر عند القائد، والنص نفسه جاهز
 
-def get_book_content(file_id, file_name, from_user):
+kb_resumes = {}  # file_id -> عدد محاولات الاستئناف في الخلفية (جارية أو استُنفدت في هذه العملية)
+kb_resumes_lock = Lock()
+
+def schedule_kb_resume(file_id, file_name, from_user, version=None, delay=0.0):
+    """بدء استكمال بناء KB معلق في خيط خلفي، مرة واحدة لكل كتاب في العملية."""
+    with kb_resumes_lock:
+        if file_id in kb_resumes:
+            return
+        kb_resumes[file_id] = 0
+    Thread(target=resume_book_kb, args=(file_id, file_name, from_user, version, delay),
+           name=f"kb-resume-{file_id}", daemon=True).start()
+
+def resume_book_kb(file_id, file_name, from_user, version, delay):
+    """
+    حتى KB_RESUME_MAX_ATTEMPTS محاولة لاستكمال الأقسام المتبقية، بفاصل يتضاعف من KB_RESUME_BACKOFF.
+    إذا استُنفدت المحاولات تبقى القاعدة الجزئية مستخدمة، ولا يُعاد البناء حتى إعادة تشغيل البوت.
+    """
+    def resume():
+        progress = KBBuildProgress.load(file_id)
+        target = version if version is not None or progress is None else progress.version  # نسخة البناء المعلق
+        text = book_cache.get(file_id, target)
+        if text is None:
+            return False  # النص لم يعد في الكاش (مثلاً نسخة أحدث من الكتاب)
+        save_book_kb(file_id, generate_kb_from_book(file_id, file_name, text, from_user, target))
+        return True
+
+    attempt = 0
+    while attempt < KB_RESUME_MAX_ATTEMPTS:
+        time.sleep(delay)
+        try:
+            if not book_loads.do(("kb", file_id), resume, timeout=BOOK_LOAD_TIMEOUT):
+                break
+        except SingleFlightTimeout:
+            delay = 0  # بناء آخر لنفس الكتاب ما زال جارياً: ننتظره مرة أخرى بدون احتساب محاولة
+            continue
+        except Exception as e:
+            print(f"فشل استئناف قاعدة المعرفة لكتاب '{file_name}': {e}")
+        if not kb_build_pending(file_id):
+            with kb_resumes_lock:
+                kb_resumes.pop(file_id, None)
+            print(f"✅ اكتمل بناء قاعدة المعرفة لكتاب '{file_name}' في الخلفية.")
+            return
+        attempt += 1
+        with kb_resumes_lock:
+            kb_resumes[file_id] = attempt
+        delay = KB_RESUME_BACKOFF * 2 ** attempt
+    print(f"❌ توقف استئناف قاعدة المعرفة لكتاب '{file_name}' بعد {attempt} محاولات، والقاعدة الجزئية مستخدمة.")
+    log_interaction(from_user, "❌ قاعدة معرفة غير مكتملة", f"للكتاب: {file_name}\nمحاولات الاستئناف: {attempt}")
+
+def get_book_content(file_id, file_name, from_user, version=None):
     """
     جلب محتوى الكتاب من الذاكرة المؤقتة (Cache) أو تحميله من Google Drive.
+    version هي نسخة الكتاب في Drive (انظر book_version)؛ إذا لم تُحدد تُستخدم آخر نسخة محفوظة على القرص.
     بعد التحميل، تقوم بتوليد قاعدة المعرفة (KB) إذا لم تكن موجودة.
     """
-    if file_id in book_cache:
-        print(f"جلب الكتاب '{file_name}' من الذاكرة المؤقتة (Cache).")
-        return book_cache[file_id]
-
+    with book_content_seconds.time(source="cache") as labels:
+        cached_text = book_cache.get(file_id, version)
+        if cached_text is not None:
+            print(f"جلب الكتاب '{file_name}' من الذاكرة المؤقتة (Cache).")
+            if kb_build_pending(file_id): # استئناف بناء KB توقف قبل اكتماله (في الخلفية)
+                schedule_kb_resume(file_id, file_name, from_user, version)
+            return cached_text
+
+        # إذا كان مستخدم آخر يحمّل نفس الكتاب الآن، ننتظر نتيجته بدلاً من تكرار التحميل وتوليد KB
+        labels["source"] = "drive"
+        try:
+            return book_loads.do(
+                (file_id, version),
+                lambda: load_book(file_id, file_name, from_user, version),
+                timeout=BOOK_LOAD_TIMEOUT
+            )
+        except SingleFlightTimeout:
+            labels["source"] = "timeout"
+            return f"عذراً، تجهيز كتاب '{file_name}' يستغرق وقتاً أطول من المعتاد. حاول مرة أخرى بعد قليل."
+
+def drive_range_fetcher(service, file_id):
+    """دالة fetch(start, end) ترجع بايتات [start, end] من ملف Drive (طلب Range لكل جزء)."""
+    def fetch(start, end):
+        request = service.files().get_media(fileId=file_id)
+        request.headers['range'] = f"bytes={start}-{end}"
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status == 416:  # البداية بعد نهاية الملف: لا مزيد من البيانات
+                return b""
+            raise
+    return fetch
+
+def fetch_book_text(file_id, file_name, version=None):
+    """
+    تحميل الكتاب من Google Drive واستخراج نصه وحفظه في الكاش مع فهرس الاسترجاع (بدون قاعدة المعرفة).
+    يرجع (النص أو رسالة خطأ، النسخة). تستخدمها load_book وأداة الفهرسة المسبقة preindex.py.
+    """
     service = get_drive_service()
-    if not service: return "خطأ: لا يمكن الاتصال بخدمة Google Drive."
+    if not service: return "خطأ: لا يمكن الاتصال بخدمة Google Drive.", version
 
     try:
-        request = service.files().get_media(fileId=file_id)
-        file_io = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_io, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-        file_io.seek(0)
-        
+        meta = book_catalog.get(file_id)
+        if meta is None or 'size' not in meta or (version is not None and book_version(meta) != version):
+            meta = service.files().get(fileId=file_id, fields="md5Checksum, modifiedTime, size").execute()
+        if version is None:
+            version = book_version(meta)
+
+        # الملف يُكتب على القرص جزءاً جزءاً (ويُستأنف إذا انقطع)، فلا يبقى الكتاب كاملاً في الذاكرة
+        md5 = meta.get('md5Checksum')
+        cache_name = md5 or re.sub(r'[^\w.-]', '_', f"{file_id}-{version}")
+        try:
+            with drive_download_seconds.time():
+                path = drive_downloader.download(cache_name, drive_range_fetcher(service, file_id),
+                                                 size=int(meta['size']) if meta.get('size') else None, md5=md5,
+                                                 suffix=os.path.splitext(file_name)[1].lower())
+        except DriveFileTooLarge:
+            return f"عذراً، كتاب '{file_name}' أكبر من الحجم المسموح ({DRIVE_MAX_FILE_MB:.0f} MB).", version
+        except DriveDownloadError as e:
+            print(f"فشل تحميل الكتاب '{file_name}': {e}")
+            return f"حدث خطأ أثناء تحميل الكتاب: {file_name}. حاول مرة أخرى بعد قليل.", version
+
         text = ""
         if file_name.lower().endswith('.pdf'):
-            with fitz.open(stream=file_io, filetype="pdf") as doc:
-                if doc.is_encrypted:
-                    return f"خطأ: الكتاب '{file_name}' مشفر ولا يمكن قراءته."
-                
-                text = "".join(page.get_text() for page in doc)
-                if not text.strip():
-                    return f"عذراً، كتاب '{file_name}' يحتوي على صور فقط أو لا يحتوي على نص قابل للاستخراج."
+            # PyMuPDF يفتح الملف المحمل من القرص مباشرة، ويقرأ كل صفحة عند استخراجها فقط
+            try:
+                with pdf_extract_seconds.time():
+                    text = pdf_extractor.extract_text(path, separator=PAGE_SEPARATOR) # الفاصل يحفظ حدود الصفحات للاسترجاع
+            except PDFEncryptedError:
+                return f"خطأ: الكتاب '{file_name}' مشفر ولا يمكن قراءته.", version
+            except PDFExtractionTimeout:
+                return f"عذراً، استخراج نص كتاب '{file_name}' استغرق وقتاً أطول من المسموح.", version
+            except PDFExtractionError as e:
+                print(f"فشل استخراج نص الكتاب '{file_name}': {e}")
+                return f"خطأ: تعذر قراءة ملف الكتاب '{file_name}'.", version
+            if not text.strip():
+                return f"عذراً، كتاب '{file_name}' يحتوي على صور فقط أو لا يحتوي على نص قابل للاستخراج.", version
 
         elif file_name.lower().endswith('.txt'):
-            text = file_io.read().decode('utf-8', errors='ignore')
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                text = f.read()
         
-        book_cache[file_id] = text
+        book_cache.put(file_id, version, text)
         print(f"تمت معالجة وتخزين الكتاب '{file_name}' في الكاش.")
+        build_book_index(file_id, text, version)
+        return text, version
+        
+    except Exception as e:
+        print(f"خطأ في جلب محتوى الكتاب '{file_name}': {e}")
+        return f"حدث خطأ أثناء محاولة الوصول للكتاب: {file_name}", version
 
+def load_book(file_id, file_name, from_user, version=None):
+    """
+    تحميل الكتاب واستخراج نصه (fetch_book_text)، ثم توليد قاعدة المعرفة إذا لم تكن موجودة.
+    لا تُستدعى مباشرة، بل عبر get_book_content (book_loads).
+    """
+    # قائد سابق ربما حمّل الكتاب بين فحص الكاش في get_book_content وبدء هذا التحميل
+    text = book_cache.get(file_id, version)
+    if text is None:
+        text, version = fetch_book_text(file_id, file_name, version)
+        if is_book_error(text):
+            return text
+    try:
         # بعد تحميل كتاب جديد، تحقق من وجود قاعدة المعرفة أو قم بتوليدها
-        if file_id not in book_knowledge_bases or not book_knowledge_bases.get(file_id):
-            bot.send_message(from_user.id, f"⏳ لأول مرة، جاري تجهيز قاعدة المعرفة لكتاب '{file_name}'. قد يستغرق هذا دقيقة...")
-            generated_kb = generate_kb_from_book(file_id, file_name, text, from_user)
-            book_knowledge_bases[file_id] = generated_kb
-            save_book_kb(file_id, generated_kb)
-            bot.send_message(from_user.id, f"✅ تم تجهيز قاعدة المعرفة لكتاب '{file_name}'. يمكنك الآن طرح أسئلتك!")
-        
+        ensure_book_kb(file_id, file_name, text, from_user, version)
         return text
-        
     except Exception as e:
         print(f"خطأ في جلب محتوى الكتاب '{file_name}': {e}")
         return f"حدث خطأ أثناء محاولة الوصول للكتاب: {file_name}"
 
+def is_book_error(content):
+    """هل النص المرجع من get_book_content رسالة خطأ وليس محتوى الكتاب؟"""
+    return content.startswith(BOOK_ERROR_PREFIXES)
+
+def get_book_context(book_id, book_name, question, from_user, version=None):
+    """
+    تجهيز النص المرجعي لسؤال عن كتاب: أفضل الأجزاء المتعلقة بالسؤال فقط (BM25) ضمن RETRIEVAL_CHAR_BUDGET،
+    بدلاً من إرسال الكتاب كاملاً. يرجع (أجزاء النص المرجعي مرتبة حسب الصلة, رسالة الخطأ أو None)؛
+    PromptBuilder يحذف الأقل صلة إذا لم تتسع الميزانية ويرسل الباقي بترتيب الكتاب.
+    """
+    content = get_book_content(book_id, book_name, from_user, version)
+    if is_book_error(content):
+        return "", content
+    index = get_book_index(book_id, content, version)
+    return index.context_parts(content, question, top_k=RETRIEVAL_TOP_K, char_budget=RETRIEVAL_CHAR_BUDGET), None
+
 def escape_markdown_v2(text: str) -> str:
     """نسخة أكثر أمانًا لتهريب أحرف الماركداون V2."""
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 def log_interaction(from_user, event_type, details=""):
-    """إرسال سجلات (logs) إلى قناة تليجرام خاصة لمراقبة أداء البوت."""
+    """
+    إرسال سجلات (logs) إلى قناة تليجرام خاصة لمراقبة أداء البوت.
+    الإرسال الفعلي يتم في الخلفية بواسطة log_shipper، هنا فقط نضيف الرسالة للطابور.
+    """
     try:
         user_info = (
             f"👤 *المستخدم:*\n"
@@ -288,112 +735,279 @@ def log_interaction(from_user, event_type, details=""):
         # قص الرسالة إذا كانت طويلة جداً
         if len(log_message) > 4096:
             log_message = log_message[:4090] + "\n..."
-            
-        url = f"https://api.telegram.org/bot{LOG_BOT_TOKEN}/sendMessage"
-        params = {'chat_id': LOG_CHAT_ID, 'text': log_message, 'parse_mode': 'Markdown', 'disable_web_page_preview': True}
-        requests.post(url, json=params, timeout=10)
+
+        log_shipper.submit(log_message, important=event_type.startswith(("❌", "⚠️")))
     except Exception as e:
         print(f"❌ فشل إرسال اللوج: {e}")
 
+# ردود الفشل (تُرسل للمستخدم لكن لا تُخزن في كاش الإجابات)
+GEMINI_BLOCKED_REPLY = "لم أتمكن من توليد رد. قد يكون المحتوى غير مناسب أو حدث خطأ ما. يرجى المحاولة مرة أخرى."
+GEMINI_CONNECTION_REPLY = "حدثت مشكلة في الاتصال بالخادم بعد عدة محاولات. يرجى المحاولة لاحقًا."
+GEMINI_UNEXPECTED_REPLY = "حدث خطأ غير متوقع. يرجى المحاولة مرة أخرى."
+GEMINI_BUSY_REPLY = "لقد واجه الخادم ضغطاً عالياً. يرجى المحاولة مرة أخرى بعد دقيقة."
+GEMINI_FAILURE_REPLIES = {GEMINI_BLOCKED_REPLY, GEMINI_CONNECTION_REPLY, GEMINI_UNEXPECTED_REPLY, GEMINI_BUSY_REPLY}
+GEMINI_INTERRUPTED_SUFFIX = "\n\n⚠️ انقطع الاتصال قبل اكتمال الرد."
+
+def is_cacheable_answer(answer):
+    """ردود الفشل والردود المنقطعة لا تُخزن في كاش الإجابات."""
+    return answer not in GEMINI_FAILURE_REPLIES and not answer.endswith(GEMINI_INTERRUPTED_SUFFIX)
+
 def send_to_gemini(from_user, prompt, chat_history=None, context=""):
+    """
+    نسخة متزامنة من send_to_gemini_async للاستخدام من الخيوط (مثل توليد قاعدة المعرفة).
+    """
+    return engine.run(send_to_gemini_async(from_user, prompt, chat_history, context))
+
+async def read_gemini_stream(response, on_text, partial):
+    """
+    قراءة رد streamGenerateContent (Server-Sent Events) واستدعاء on_text(النص حتى الآن) مع كل جزء.
+    يرجع رداً بنفس شكل generateContent (النص كاملاً + usageMetadata). partial['text'] يحفظ ما وصل حتى الآن.
+    """
+    result = {}
+    async for line in response.content:
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        chunk = json.loads(line[5:])
+        if 'usageMetadata' in chunk:
+            result['usageMetadata'] = chunk['usageMetadata']
+        if 'promptFeedback' in chunk:
+            result['promptFeedback'] = chunk['promptFeedback']
+        for candidate in chunk.get('candidates', [])[:1]:
+            text = "".join(part.get('text', '') for part in candidate.get('content', {}).get('parts', []))
+            if text:
+                partial['text'] += text
+                await on_text(partial['text'])
+            if candidate.get('finishReason'):
+                result['finishReason'] = candidate['finishReason']
+    if partial['text']:
+        result['candidates'] = [{"content": {"role": "model", "parts": [{"text": partial['text']}]}}]
+    return result
+
+def book_text_for_cache(book_id, version):
+    """نص الكتاب لرفعه كـ cachedContent مع علامة لكل صفحة (للاستشهاد بأرقام الصفحات)."""
+    text = book_cache.get(book_id, version)
+    if text is None:
+        return None
+    return "\n".join(f"[صفحة {i}]\n{page}" for i, page in enumerate(text.split(PAGE_SEPARATOR), start=1))
+
+async def send_to_gemini_async(from_user, prompt, chat_history=None, context="", on_text=None, book_ref=None, history_digest=""):
     """
     إرسال الطلب إلى Gemini API مع معالجة الأخطاء ومحاولات إعادة الإرسال.
+    تعمل على حلقة engine، فالانتظار لا يحجز أي خيط.
+    إذا مُررت on_text يُستخدم streamGenerateContent وتُستدعى await on_text(النص حتى الآن) أثناء وصول الرد.
+    book_ref = (book_id, version): يُستخدم كاش سياق الكتاب على المفتاح المختار بدلاً من context إن أمكن.
+    الطلب يُجمع ضمن PROMPT_TOKEN_BUDGET: المحاورات التي لا تتسع تُرسل مختصرة مع history_digest.
     """
     headers = {'Content-Type': 'application/json'}
-    final_prompt = prompt
-    if context:
-        final_prompt = (
-            f"أجب على السؤال التالي بناءً على النص المرفق فقط. إذا كانت الإجابة غير موجودة، قل 'الإجابة غير متوفرة في المصدر'.\n\n"
-            f"--- النص المرجعي ---\n{context}\n--- نهاية النص المرجعي ---\n\n"
-            f"السؤال: {prompt}"
-        )
+    built = prompt_builder.build(prompt, context, chat_history or (), history_digest)
+    data = {"contents": built.contents, "generationConfig": {"temperature": 0.7, "maxOutputTokens": 8192}}
+    # مع كاش السياق يُرسل السؤال وسجل المحادثة فقط، والكتاب يُشار إليه باسم الكاش (فيتسع لمحاورات أكثر)
+    cached_data = {"contents": prompt_builder.build(f"السؤال: {prompt}", "", chat_history or (), history_digest).contents,
+                   "generationConfig": data["generationConfig"]}
+    use_context_cache = CONTEXT_CACHE_ENABLED and book_ref is not None
+    estimated_tokens = built.estimated_tokens
+    stream = on_text is not None
+    latency_kind = "first_chunk" if stream else "response"
+
+    async def run_attempt(lease, race, attempt, cached_content=None):
+        """
+        محاولة واحدة على مفتاح محجوز (أصلية أو احتياطية). ترجع (النتيجة, القيمة):
+        ok/blocked/interrupted/unexpected نتائج نهائية، و retry/error تعني المحاولة بمفتاح آخر.
+        cached_content: اسم كاش سياق الكتاب على هذا المفتاح (يُجهز قبل بدء السباق).
+        """
+        # المهلة من زمن المفتاح الفعلي: الطلب العالق لا يحجز المستخدم المهلة الثابتة كاملة
+        request_timeout = gemini_latency.timeout(lease.label, latency_kind, GEMINI_TIMEOUT_PERCENTILE,
+                                                 GEMINI_TIMEOUT_MULTIPLIER, GEMINI_TIMEOUT_MIN,
+                                                 min(GEMINI_TIMEOUT_MAX, 60) if stream else GEMINI_TIMEOUT_MAX)
+        # الرد المتدفق قد يطول، فالمهلة على الانقطاع بين الأجزاء وليس على الرد كاملاً
+        timeout = aiohttp.ClientTimeout(total=300, sock_read=request_timeout) if stream else aiohttp.ClientTimeout(total=request_timeout)
+        partial = {"text": ""}
+        started = time.perf_counter()
+
+        async def forward_text(text):
+            # أول طلب يصل منه نص يفوز بالسباق، والطلب الآخر يُلغى
+            if not partial.get("claimed"):
+                if not race.claim():
+                    return
+                partial["claimed"] = True
+                gemini_latency.record(lease.label, "first_chunk", time.perf_counter() - started)
+            await on_text(text)
 
-    contents = chat_history or []
-    contents.append({"role": "user", "parts": [{"text": final_prompt}]})
-    data = {"contents": contents, "generationConfig": {"temperature": 0.7, "maxOutputTokens": 8192}}
-    
-    max_retries = 3
-    for attempt in range(max_retries):
+        status_code, failed, tokens_used, retry_after = None, False, None, None
         try:
-            current_api_key = next(api_key_cycler)
-            url = f'https://generativelanguage.googleapis.com/v1beta/models/{MODEL}:generateContent?key={current_api_key}'
-            
-            response = requests.post(url, headers=headers, json=data, timeout=120)
-            
-            if response.status_code == 429: # خطأ تجاوز المعدل
-                wait_time = (2 ** attempt) + 1
-                print(f"واجهنا خطأ 429 (Too Many Requests). سننتظر {wait_time} ثانية...")
-                log_interaction(from_user, "⚠️ ضغط على API", f"محاولة {attempt + 1} فشلت. سيتم الانتظار {wait_time} ثانية.")
-                time.sleep(wait_time)
-                continue
+            request_data = dict(cached_data, cachedContent=cached_content) if cached_content else data
 
-            response.raise_for_status() # إظهار الأخطاء الأخرى مثل 400 أو 500
+            method = 'streamGenerateContent?alt=sse&' if stream else 'generateContent?'
+            model = context_caches.model if cached_content else MODEL  # الطلب على الكاش يُرسل لنفس نموذج الكاش
+            url = f'{GEMINI_API_BASE}/v1beta/models/{model}:{method}key={lease.key}'
             
-            result = response.json()
+            async with engine.session.post(url, headers=headers, json=request_data, timeout=timeout) as response:
+                status_code = response.status
+                
+                if cached_content and response.status in (403, 404): # الكاش انتهى أو حُذف في Gemini: يُنشأ من جديد
+                    context_caches.invalidate(lease.key, book_ref[0], book_ref[1])
+                    return "retry", None
+
+                if response.status == 429: # خطأ تجاوز المعدل: المفتاح يدخل فترة تبريد ونجرب مفتاحاً آخر
+                    retry_header = response.headers.get('Retry-After', '')
+                    retry_after = float(retry_header) if retry_header.isdigit() else None
+                    print(f"واجهنا خطأ 429 (Too Many Requests) على المفتاح {lease.label}.")
+                    log_interaction(from_user, "⚠️ ضغط على API", f"محاولة {attempt + 1} فشلت (429) على المفتاح {lease.label}.")
+                    return "retry", None
+
+                response.raise_for_status() # إظهار الأخطاء الأخرى مثل 400 أو 500
+                
+                result = await read_gemini_stream(response, forward_text, partial) if stream else await response.json()
+            usage = result.get('usageMetadata', {})
+            tokens_used = usage.get('totalTokenCount')
+            if usage.get('promptTokenCount'):
+                # الرموز المرسلة فعلاً (رموز الكاش لا تُحسب)، وتُستخدم لمعايرة التقدير المحلي
+                sent_tokens = usage['promptTokenCount'] - usage.get('cachedContentTokenCount', 0)
+                gemini_prompt_tokens.observe(sent_tokens)
+                token_estimator.calibrate(contents_chars(request_data["contents"]), sent_tokens)
+            if not stream:
+                gemini_latency.record(lease.label, "response", time.perf_counter() - started)
             
             # التحقق من وجود رد صالح
             if 'candidates' in result and result['candidates'][0].get('content', {}).get('parts'):
-                return result['candidates'][0]['content']['parts'][0]['text']
+                return "ok", result['candidates'][0]['content']['parts'][0]['text']
             
             # إذا كان الرد فارغاً أو محظوراً
             log_interaction(from_user, "⚠️ تحذير من Gemini", f"الرد من API لم يكن بالتنسيق المتوقع أو تم حظره.\n{result}")
-            return "لم أتمكن من توليد رد. قد يكون المحتوى غير مناسب أو حدث خطأ ما. يرجى المحاولة مرة أخرى."
-
-        except requests.exceptions.RequestException as e:
-            print(f"خطأ في اتصال Gemini API: {e}")
-            log_interaction(from_user, "❌ خطأ في اتصال Gemini", f"تفاصيل الخطأ:\n{e}")
-            if attempt < max_retries - 1:
-                time.sleep((2 ** attempt) + 1)
-            else:
-                return "حدثت مشكلة في الاتصال بالخادم بعد عدة محاولات. يرجى المحاولة لاحقًا."
+            return "blocked", None
+
+        except asyncio.CancelledError:
+            status_code = None # خسر السباق أمام الطلب الآخر: لا يُحسب نجاحاً ولا فشلاً للمفتاح
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failed = status_code is None # خطأ اتصال أو انتهاء المهلة (وليس رد HTTP)
+            print(f"خطأ في اتصال Gemini API: {e!r}")
+            log_interaction(from_user, "❌ خطأ في اتصال Gemini", f"تفاصيل الخطأ:\n{e!r}")
+            if partial['text']: # جزء من الرد ظهر للمستخدم بالفعل: لا نعيد الطلب من البداية
+                return "interrupted", partial['text']
+            return "error", e
         except Exception as e:
             print(f"خطأ غير متوقع في Gemini: {e}")
             log_interaction(from_user, "❌ خطأ غير متوقع في Gemini", f"تفاصيل الخطأ:\n{e}")
-            return "حدث خطأ غير متوقع. يرجى المحاولة مرة أخرى."
+            return "unexpected", e
+        finally:
+            # مع العمال يمر الإعادة عبر العملية الأمامية (مجمع خيوط)، و shield يكملها حتى لو أُلغي الطلب مرة أخرى
+            await asyncio.shield(key_pool.release_async(lease, status_code=status_code, failed=failed,
+                                                        tokens_used=tokens_used, retry_after=retry_after))
+            gemini_attempt_seconds.observe(time.perf_counter() - started, key=lease.label,
+                                           outcome="error" if status_code is None else str(status_code))
+
+    max_retries = 3
+    for attempt in range(max_retries):
+        # انتظار دورنا في الطابور حتى يتوفر مفتاح لديه حصة كافية
+        wait_started = time.perf_counter()
+        try:
+            lease = await key_pool.acquire_async(estimated_tokens=estimated_tokens, timeout=GEMINI_QUEUE_TIMEOUT)
+        except KeyPoolExhausted:
+            log_interaction(from_user, "⚠️ ضغط على API", f"جميع المفاتيح مستنفدة، انتهت مهلة الانتظار ({GEMINI_QUEUE_TIMEOUT} ثانية).")
+            break
+        gemini_key_wait_seconds.observe(time.perf_counter() - wait_started)
+
+        # إنشاء كاش السياق (رفع الكتاب) قد يستغرق ثوانٍ، فيتم قبل السباق حتى لا يُحسب تأخراً للطلب الأصلي
+        cached_content = None
+        if use_context_cache:
+            try:
+                cached_content = await context_caches.get(lease.key, book_ref[0], book_ref[1],
+                                                          lambda: book_text_for_cache(book_ref[0], book_ref[1]))
+            except BaseException:
+                await asyncio.shield(key_pool.release_async(lease))
+                raise
+
+        race = HedgeRace(succeeded=lambda result: result[0] not in ("retry", "error"))
+
+        async def start_hedge(primary_key=lease.key, race=race, attempt=attempt):
+            # طلب احتياطي على مفتاح آخر إذا تأخر الأصلي، ضمن رصيد محدود ومن حصة متاحة الآن فقط
+            if not hedge_budget.try_spend():
+                gemini_hedges.inc(result="no_budget")
+                return None
+            hedge_lease = await key_pool.try_acquire_async(estimated_tokens, exclude={primary_key})
+            if hedge_lease is None:
+                hedge_budget.refund()
+                gemini_hedges.inc(result="no_key")
+                return None
+            gemini_hedges.inc(result="fired")
+            # كاش السياق تابع للمفتاح الأصلي، فالطلب الاحتياطي يرسل النص المرجعي نفسه
+            return run_attempt(hedge_lease, race, attempt)
+
+        hedge_delay = None
+        if GEMINI_HEDGE_ENABLED and len(API_KEYS) > 1:
+            hedge_budget.earn()
+            observed = gemini_latency.percentile(lease.label, latency_kind, GEMINI_HEDGE_PERCENTILE)
+            hedge_delay = max(GEMINI_HEDGE_MIN_DELAY, observed if observed is not None else GEMINI_HEDGE_DEFAULT_DELAY)
+        outcome, value = await race.run(run_attempt(lease, race, attempt, cached_content), start_hedge, hedge_delay)
+        if race.hedge_fired:
+            gemini_hedges.inc(result="won" if race.hedge_won else "lost")
+
+        if outcome == "ok":
+            return value
+        if outcome == "blocked":
+            return GEMINI_BLOCKED_REPLY
+        if outcome == "interrupted":
+            return value + GEMINI_INTERRUPTED_SUFFIX
+        if outcome == "unexpected":
+            return GEMINI_UNEXPECTED_REPLY
+        if outcome == "error" and attempt == max_retries - 1:
+            return GEMINI_CONNECTION_REPLY
             
-    return "لقد واجه الخادم ضغطاً عالياً. يرجى المحاولة مرة أخرى بعد دقيقة."
+    return GEMINI_BUSY_REPLY
 
 def send_long_message(chat_id, text, **kwargs):
-    """تقسيم الرسائل الطويلة جداً إلى أجزاء أصغر لإرسالها."""
-    MAX_LENGTH = 4096
-    if len(text) <= MAX_LENGTH:
-        bot.send_message(chat_id, text, **kwargs)
-        return
+    """
+    تقسيم الرسائل الطويلة جداً إلى أجزاء أصغر لإرسالها. الأجزاء تُجدول في طابور الإرسال (بترتيبها وبحدود
+    تليجرام) ويعود المعالج فوراً. يرجع قائمة Futures للأجزاء.
+    """
+    return [tg.send_message(chat_id, part, wait=False, **kwargs) for part in split_message(text) if part.strip()]
 
-    parts = []
-    while len(text) > 0:
-        if len(text) > MAX_LENGTH:
-            part = text[:MAX_LENGTH]
-            last_newline = part.rfind('\n')
-            if last_newline != -1:
-                parts.append(text[:last_newline])
-                text = text[last_newline+1:]
-            else:
-                parts.append(text[:MAX_LENGTH])
-                text = text[MAX_LENGTH:]
-        else:
-            parts.append(text)
-            break
-            
-    for part in parts:
-        if part.strip():
-            bot.send_message(chat_id, part, **kwargs)
-            time.sleep(0.5)
+def check_membership(user_id, force_refresh=False):
+    """
+    التحقق من اشتراك المستخدم في القناة المطلوبة.
+    النتيجة تُخزن في membership_cache لتجنب استدعاء Telegram مع كل رسالة،
+    و force_refresh يتجاوز الكاش (مثلاً عند ضغط زر "لقد اشتركت").
+    """
+    if force_refresh:
+        membership_cache.invalidate(user_id)
+    else:
+        found, is_member = membership_cache.get(user_id)
+        if found:
+            return is_member
 
-def check_membership(user_id):
-    """التحقق من اشتراك المستخدم في القناة المطلوبة."""
     try:
-        member = bot.get_chat_member(TELEGRAM_CHANNEL_ID, user_id)
-        return member.status in ['creator', 'administrator', 'member']
+        with membership_check_seconds.time():
+            member = bot.get_chat_member(TELEGRAM_CHANNEL_ID, user_id)
+        is_member = member.status in MEMBER_STATUSES
     except telebot.apihelper.ApiTelegramException as e:
-        if "user not found" in e.description:
-            return False # المستخدم ليس عضواً
-        print(f"خطأ أثناء التحقق من الاشتراك للمستخدم {user_id}: {e}")
-        return False # نفترض أنه غير مشترك في حالة حدوث خطأ
+        if "user not found" not in e.description:
+            print(f"خطأ أثناء التحقق من الاشتراك للمستخدم {user_id}: {e}")
+            return False # نفترض أنه غير مشترك في حالة حدوث خطأ (بدون تخزين النتيجة)
+        is_member = False # المستخدم ليس عضواً
     except Exception as e:
         print(f"خطأ عام أثناء التحقق من الاشتراك للمستخدم {user_id}: {e}")
         return False
 
+    cache_membership(user_id, is_member)
+    return is_member
+
+def cache_membership(user_id, is_member):
+    """تخزين حالة الاشتراك بمدة صلاحية مختلفة للمشترك وغير المشترك."""
+    ttl = MEMBERSHIP_POSITIVE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+    membership_cache.set(user_id, is_member, ttl=ttl)
+
+def is_required_channel(chat):
+    """هل هذه المحادثة هي قناة الاشتراك الإجباري؟ (TELEGRAM_CHANNEL_ID قد يكون @username أو آي دي رقمي)"""
+    if str(chat.id) == TELEGRAM_CHANNEL_ID:
+        return True
+    return bool(chat.username) and f"@{chat.username}".lower() == TELEGRAM_CHANNEL_ID.lower()
+
+def is_admin(user_id):
+    """هل المستخدم من المشرفين المحددين في ADMIN_IDS؟"""
+    return user_id in ADMIN_IDS
+
 # ==============================================================================
 #  واجهة المستخدم (UI) والرسائل
 # ==============================================================================
@@ -405,17 +1019,34 @@ def send_subscription_message(chat_id):
     btn_telegram = telebot.types.InlineKeyboardButton("اشترك في قناة التليجرام 🔵", url=f"https://t.me/{TELEGRAM_CHANNEL_ID.replace('@', '')}")
     btn_check = telebot.types.InlineKeyboardButton("✅ لقد اشتركت، تحقق الآن", callback_data="check_subscription")
     markup.add(btn_youtube, btn_telegram, btn_check)
-    bot.send_message(
+    tg.send_message(
         chat_id,
         "🛑 *عذراً، يجب عليك الاشتراك في القنوات التالية أولاً لاستخدام البوت:*\n\n"
         "هذا يساعدنا على الاستمرار وتقديم المزيد. شكراً لدعمك! 🙏",
         reply_markup=markup, 
-        parse_mode="Markdown"
+        parse_mode="Markdown",
+        wait=False
     )
 
+RATE_LIMIT_MODE_NAMES = {"general_chat": "البحث العام", "book_chat": "البحث في الكتب"}
+
+def rate_limit_help_lines():
+    """أسطر حدود الأسئلة لكل مستخدم في رسالة المساعدة، من القواعد المضبوطة فعلاً (بدون الحد العام للبوت)."""
+    lines = []
+    for rule in rate_limiter.rules:
+        if rule.scope != "user":
+            continue
+        if rule.modes is None:
+            lines.append(f"- يمكنك إرسال *{rule.describe()}*.")
+        else:
+            modes = " و".join(RATE_LIMIT_MODE_NAMES.get(mode, mode) for mode in sorted(rule.modes))
+            lines.append(f"- في {modes}: *{rule.describe()}*.")
+    return lines
+
 def send_help_message(chat_id):
     """إرسال رسالة المساعدة والإرشادات."""
-    help_text = """
+    limits = "\n".join(rate_limit_help_lines()) or "- لا يوجد حد لعدد الأسئلة حالياً."
+    help_text = f"""
 *🎯 معلومات البوت والإرشادات*
 
 مرحباً بك في بوت الدowedar التعليمي! هذا البوت يستخدم ذكاء جوجل الاصطناعي (Gemini) للإجابة على أسئلتك، بالإضافة إلى قواعد معرفية يتم توليدها تلقائياً من الكتب لتقديم إجابات سريعة ودقيقة.
@@ -423,7 +1054,7 @@ def send_help_message(chat_id):
 *📝 كيف تستخدم البوت؟*
 1.  اختر بين "بحث عام" أو "بحث في المصادر" (الكتب).
 2.  إذا اخترت البحث في كتاب، سيحاول البوت أولاً البحث في قاعدة المعرفة الذكية الخاصة بالكتاب.
-3.  إذا لم يجد إجابة، سيلجأ إلى Gemini للبحث في محتوى الكتاب كاملاً.
+3.  إذا لم يجد إجابة، سيلجأ إلى Gemini للبحث في أجزاء الكتاب الأكثر صلة بسؤالك.
 4.  اكتب سؤالك بشكل واضح.
 
 *⚙️ مميزات البوت:*
@@ -433,7 +1064,7 @@ def send_help_message(chat_id):
 - *دعم متعدد اللغات* وإجابات منسقة.
 
 *⏱️ حدود الاستخدام:*
-- يمكنك إرسال سؤال كل *15 ثانية*.
+{limits}
 - يتم تقسيم الإجابات الطويلة تلقائياً.
 
 *❓ أسئلة شائعة:*
@@ -443,12 +1074,11 @@ def send_help_message(chat_id):
 """
     markup = telebot.types.InlineKeyboardMarkup()
     markup.add(telebot.types.InlineKeyboardButton("⬅️ العودة إلى القائمة الرئيسية", callback_data="main_menu"))
-    bot.send_message(chat_id, help_text, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True)
+    tg.send_message(chat_id, help_text, parse_mode="Markdown", reply_markup=markup, disable_web_page_preview=True, wait=False)
 
 def show_main_menu(chat_id, message_id=None):
     """عرض القائمة الرئيسية للبوت."""
-    users = load_users()
-    user_data = users.get(str(chat_id), {})
+    user_data = user_store.get(chat_id) or {}
     # نحصل على اسم المستخدم من بياناته المسجلة
     user_name = user_data.get('user_info', {}).get('first_name', 'صديقي')
     
@@ -463,43 +1093,42 @@ def show_main_menu(chat_id, message_id=None):
 
     try:
         if message_id:
-            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode="Markdown")
+            tg.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode="Markdown")
         else:
-            bot.send_message(chat_id, text, reply_markup=markup, parse_mode="Markdown")
+            tg.send_message(chat_id, text, reply_markup=markup, parse_mode="Markdown", wait=False)
     except Exception as e:
         print(f"فشل في تعديل رسالة القائمة الرئيسية: {e}. سيتم إرسال رسالة جديدة.")
-        bot.send_message(chat_id, text, reply_markup=markup, parse_mode="Markdown")
-
-def show_book_list(chat_id, message_id=None):
-    """عرض قائمة الكتب المتاحة من Google Drive."""
-    initial_text = "⏳ جارٍ جلب قائمة الكتب..."
-    
-    try:
-        if message_id:
-            bot.edit_message_text(initial_text, chat_id, message_id, reply_markup=None)
-        else:
-            msg = bot.send_message(chat_id, initial_text)
-            message_id = msg.message_id
-    except Exception as e:
-        print(f"خطأ في إظهار رسالة التحميل لقائمة الكتب: {e}")
-        msg = bot.send_message(chat_id, initial_text)
-        message_id = msg.message_id
+        tg.send_message(chat_id, text, reply_markup=markup, parse_mode="Markdown", wait=False)
 
-    books = list_books()
+def show_book_list(chat_id, message_id=None, page=0):
+    """عرض قائمة الكتب المتاحة من فهرس الكتب المشترك (بدون طلب لـ Google Drive)، مقسمة لصفحات."""
+    books = book_catalog.books()
     if not books:
-        bot.edit_message_text("عذرًا، لم أجد كتبًا في المجلد المخصص حاليًا.", chat_id, message_id)
-        return
-
-    users = load_users()
-    user_data = users.get(str(chat_id), {})
-    user_data['available_books'] = books # تخزين الكتب مؤقتاً لتجنب استدعاء API مرة أخرى
-    save_users(users)
-
-    markup = telebot.types.InlineKeyboardMarkup(row_width=1)
-    for book in books:
-        markup.add(telebot.types.InlineKeyboardButton(book['name'], callback_data=f"book:{book['id']}"))
-    markup.add(telebot.types.InlineKeyboardButton("⬅️ العودة للقائمة الرئيسية", callback_data="main_menu"))
-    bot.edit_message_text("اختر الكتاب الذي تريد البحث فيه:", chat_id, message_id, reply_markup=markup)
+        text, markup = "عذرًا، لم أجد كتبًا في المجلد المخصص حاليًا.", None
+    else:
+        pages = (len(books) + BOOKS_PER_PAGE - 1) // BOOKS_PER_PAGE
+        page = max(0, min(page, pages - 1))
+        markup = telebot.types.InlineKeyboardMarkup(row_width=1)
+        for book in books[page * BOOKS_PER_PAGE:(page + 1) * BOOKS_PER_PAGE]:
+            markup.add(telebot.types.InlineKeyboardButton(book['name'], callback_data=f"book:{book['id']}"))
+        if pages > 1:
+            navigation = []
+            if page > 0:
+                navigation.append(telebot.types.InlineKeyboardButton("➡️ السابق", callback_data=f"books_page:{page - 1}"))
+            navigation.append(telebot.types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+            if page < pages - 1:
+                navigation.append(telebot.types.InlineKeyboardButton("التالي ⬅️", callback_data=f"books_page:{page + 1}"))
+            markup.row(*navigation)
+        markup.add(telebot.types.InlineKeyboardButton("⬅️ العودة للقائمة الرئيسية", callback_data="main_menu"))
+        text = "اختر الكتاب الذي تريد البحث فيه:"
+
+    if message_id:
+        try:
+            tg.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+            return
+        except Exception as e:
+            print(f"خطأ في تعديل رسالة قائمة الكتب: {e}. سيتم إرسال رسالة جديدة.")
+    tg.send_message(chat_id, text, reply_markup=markup, wait=False)
 
 # ==============================================================================
 #  معالجات رسائل التليجرام (Handlers)
@@ -514,13 +1143,13 @@ def handle_start(message):
     # محاولة حذف لوحة المفاتيح القديمة إن وجدت
     try:
         remove_markup = telebot.types.ReplyKeyboardRemove()
-        temp_msg = bot.send_message(chat_id, "...", reply_markup=remove_markup, disable_notification=True)
-        bot.delete_message(chat_id, temp_msg.message_id)
+        temp_msg = tg.send_message(chat_id, "...", reply_markup=remove_markup, disable_notification=True)
+        tg.delete_message(chat_id, temp_msg.message_id, wait=False)
     except Exception as e:
         print(f"لا يمكن إزالة لوحة المفاتيح: {e}")
 
     if check_membership(message.from_user.id):
-        users = load_users()
+        user_data = user_store.get(chat_id)
         
         # تسجيل المستخدم إذا كان جديدًا وتحديث بياناته
         user_info = {
@@ -528,19 +1157,114 @@ def handle_start(message):
             "last_name": message.from_user.last_name,
             "username": message.from_user.username,
         }
-        if chat_id not in users:
-            users[chat_id] = {"state": "main_menu", "chat_history": [], "user_info": user_info}
+        if user_data is None:
+            user_data = {"state": "main_menu", "chat_history": [], "user_info": user_info}
             log_interaction(message.from_user, "👤 تسجيل مستخدم جديد")
         else:
-            users[chat_id]['user_info'] = user_info # تحديث بيانات المستخدم
+            user_data['user_info'] = user_info # تحديث بيانات المستخدم
         
-        users[chat_id]['state'] = 'main_menu' # إعادة المستخدم للقائمة الرئيسية
-        save_users(users)
+        user_data['state'] = 'main_menu' # إعادة المستخدم للقائمة الرئيسية
+        leave_book_session(chat_id)
+        user_store.save(chat_id, user_data)
         show_main_menu(chat_id)
     else:
         send_subscription_message(chat_id)
         log_interaction(message.from_user, "🔐 فشل التحقق من الاشتراك", "تم إرسال رسالة الاشتراك.")
 
+@bot.message_handler(commands=['stats'])
+def handle_stats(message):
+    """أمر /stats للمشرفين فقط: عرض إحصائيات الكاش والأداء."""
+    if not is_admin(message.from_user.id):
+        return
+    m = membership_cache.stats()
+    stats_text = (
+        "📊 *إحصائيات البوت*\n\n"
+        + (f"🧵 العامل {WORKER_INDEX + 1} من {BOT_WORKERS} (الإحصائيات لهذا العامل فقط عدا مفاتيح Gemini)\n\n" if IS_WORKER else "") +
+        "*كاش الاشتراك:*\n"
+        f"- الحجم: {m['size']} / {m['maxsize']}\n"
+        f"- Hits: {m['hits']} | Misses: {m['misses']} | نسبة الإصابة: {m['hit_ratio'] * 100:.1f}%\n"
+        f"- Evictions: {m['evictions']}\n"
+        f"- TTL: {MEMBERSHIP_POSITIVE_TTL}s (مشترك) / {MEMBERSHIP_NEGATIVE_TTL}s (غير مشترك)\n\n"
+        "*مفاتيح Gemini:*\n"
+    )
+    key_stats = key_pool.stats()
+    for k in key_stats:
+        stats_text += (
+            f"- `{k['key']}`: جارية {k['in_flight']} | طلبات {k['recent_requests']} (آخر 5 دقائق) | "
+            f"429: {k['rate_429'] * 100:.0f}% | p50/p95/p99: {k['p50']}/{k['p95']}/{k['p99']}s"
+            + (f" | تبريد {k['cooldown_remaining']}s" if k['cooldown_remaining'] else "") + "\n"
+        )
+    stats_text += f"- في الانتظار: {key_stats[0]['waiting']}\n"
+    hedges = {key[0]: count for key, count in gemini_hedges.values().items()}
+    lat = gemini_latency.stats().get("first_chunk" if STREAM_RESPONSES else "response", {})
+    stats_text += (
+        f"- طلبات احتياطية: أُطلق {hedges.get('fired', 0)} | فاز {hedges.get('won', 0)} | خسر {hedges.get('lost', 0)} | "
+        f"بدون رصيد {hedges.get('no_budget', 0)} | بدون مفتاح {hedges.get('no_key', 0)}\n"
+        f"- زمن الرد المستخدم للمهلات p50/p95/p99: {lat.get('p50')}/{lat.get('p95')}/{lat.get('p99')}s ({lat.get('count', 0)})\n"
+    )
+    prompt_count = sum(total for _, _, total in gemini_prompt_tokens.series().values())
+    if prompt_count:
+        prompt_sum = sum(total for _, total, _ in gemini_prompt_tokens.series().values())
+        stats_text += (f"- رموز الطلب: متوسط {prompt_sum / prompt_count:.0f} | p95 {gemini_prompt_tokens.quantile(0.95):.0f} "
+                       f"({prompt_count} طلب) | رموز/حرف: {token_estimator.tokens_per_char:.3f}\n")
+    ttft = sorted(ttft_samples)
+    stats_text += f"- زمن ظهور أول نص (TTFT) p50/p95: {percentile(ttft, 50)}/{percentile(ttft, 95)}s ({len(ttft)} رد)\n\n"
+    b = book_cache.stats()
+    loads = book_loads.stats()
+    d = drive_downloader.stats()
+    c = book_catalog.stats()
+    kbs = kb_store.stats()
+    cc = context_caches.stats()
+    a = answer_cache.stats()
+    q = send_queue.stats()
+    rl = rate_limiter.stats()
+    hit_ratio = kb_hit_ratio()
+    stats_text += (
+        "*الكتب:*\n"
+        f"- كاش النصوص: {b['memory_entries']} في الذاكرة ({b['memory_bytes'] // (1024 * 1024)}/{b['memory_budget'] // (1024 * 1024)} MB) | {b['disk_entries']} على القرص\n"
+        f"- إصابات الذاكرة/القرص: {b['memory_hits']}/{b['disk_hits']} | Misses: {b['misses']}\n"
+        f"- تحميلات فعلية: {loads['executed']} | تحميلات مكررة تم تجنبها: {loads['deduplicated']} | "
+        f"جارية: {loads['in_flight']} | مهلة: {loads['timeouts']}\n"
+        f"- ملفات Drive: تحميلات {d['downloads']} ({d['bytes_downloaded'] // (1024 * 1024)} MB) | من القرص: {d['cache_hits']} | "
+        f"استئناف: {d['resumed']} | md5 خاطئ: {d['md5_mismatches']} | أكبر من الحد: {d['rejected_too_large']}\n"
+        f"- فهرس Drive: {c['books']} كتاب | مزامنات كاملة/تدريجية: {c['full_syncs']}/{c['delta_syncs']} | "
+        f"تغييرات: {c['changes_applied']} | آخر مزامنة منذ: {c['last_sync_age']}s\n"
+        f"- قواعد المعرفة: {kbs['books']} ({kbs['total_entries']} إدخال) | في الذاكرة: {kbs['memory_entries']} "
+        f"({kbs['memory_bytes'] // (1024 * 1024)}/{kbs['memory_budget'] // (1024 * 1024)} MB) | "
+        f"تحميلات: {kbs['loads']} | Evictions: {kbs['evictions']}\n\n"
+        "*كاش الإجابات:*\n"
+        f"- الحجم: {a['size']} / {a['maxsize']} | إصابات: {a['hits']} | مدمجة مع طلب جارٍ: {a['coalesced']}\n"
+        f"- طلبات Gemini: {a['gemini_calls']} | موفرة: {a['gemini_calls_saved']} ({a['saved_ratio'] * 100:.1f}%) | "
+        f"أسئلة متابعة: {a['follow_ups']} | غير مخزنة (تعتمد على السجل): {a['bypassed']}\n\n"
+        "*كاش سياق Gemini:*\n"
+        f"- كاشات نشطة: {cc['caches']} ({cc['books']} كتاب) | جلسات: {cc['sessions']}\n"
+        f"- أُنشئ: {cc['created']} | أُعيد استخدامه: {cc['reused']} | حُذف: {cc['deleted']} | فشل: {cc['failed']} | "
+        f"أصغر من حد API: {cc['too_small']} | أغلى من الاسترجاع: {cc['too_costly']}\n\n"
+        "*طابور رسائل تليجرام:*\n"
+        f"- في الانتظار: {q['queued']} ({q['chats']} محادثة) | قيد الإرسال: {q['in_flight']} | أعلى انتظار: {q['queued_peak']}\n"
+        f"- أُرسل: {q['sent']} | فشل: {q['failed']} | 429 (أُعيد بعد retry\\_after): {q['rate_limited']}\n\n"
+        "*تحديد المعدل:*\n"
+        f"- أسئلة مقبولة: {rl['allowed']} | دلاء نشطة: {rl['buckets']}\n"
+        f"- مرفوضة: " + (" | ".join(name.replace('_', '\\_') + f": {count}" for name, count in rl['rejected'].items()) or "-") + "\n\n"
+        "*زمن المراحل p50/p95 (عدد القياسات):*\n"
+        f"- محتوى الكتاب: {format_latency(book_content_seconds)} | تحميل Drive: {format_latency(drive_download_seconds)}\n"
+        f"- استخراج PDF: {format_latency(pdf_extract_seconds)} | توليد KB: {format_latency(kb_build_seconds)}\n"
+        f"- مطابقة KB: {format_latency(kb_match_seconds)} | نسبة إجابات KB: "
+        + (f"{hit_ratio * 100:.1f}%" if hit_ratio is not None else "-") + "\n"
+        f"- انتظار مفتاح Gemini: {format_latency(gemini_key_wait_seconds)} | محاولة Gemini: {format_latency(gemini_attempt_seconds)}\n"
+        f"- التحقق من الاشتراك: {format_latency(membership_check_seconds)}\n"
+        f"- انتظار طابور تليجرام: {format_latency(telegram_queue_seconds)} | إرسال تليجرام: {format_latency(telegram_send_seconds)}"
+    )
+    tg.send_message(message.chat.id, stats_text, parse_mode="Markdown", wait=False)
+
+@bot.chat_member_handler()
+def handle_chat_member_update(update):
+    """تحديث كاش الاشتراك فوراً عند انضمام أو مغادرة مستخدم لقناة الاشتراك (يتطلب أن يكون البوت مشرفاً في القناة)."""
+    if not is_required_channel(update.chat):
+        return
+    user_id = update.new_chat_member.user.id
+    cache_membership(user_id, update.new_chat_member.status in MEMBER_STATUSES)
+
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback_query(call):
     """معالج لجميع ضغطات الأزرار (Inline Keyboard)."""
@@ -552,8 +1276,8 @@ def handle_callback_query(call):
 
     # أولاً، تحقق من زر الاشتراك
     if action == 'check_subscription':
-        if check_membership(call.from_user.id):
-            bot.delete_message(chat_id, call.message.message_id)
+        if check_membership(call.from_user.id, force_refresh=True):
+            tg.delete_message(chat_id, call.message.message_id, wait=False)
             handle_start(call.message) 
         else:
             bot.answer_callback_query(call.id, "❌ لم تشترك بعد. يرجى الاشتراك ثم المحاولة.", show_alert=True)
@@ -564,73 +1288,82 @@ def handle_callback_query(call):
         send_subscription_message(chat_id)
         return
 
-    users = load_users()
-    if chat_id not in users: # حالة نادرة إذا تم حذف بيانات المستخدم
+    user_data = user_store.get(chat_id)
+    if user_data is None: # حالة نادرة إذا تم حذف بيانات المستخدم
         handle_start(call.message)
         return
-    user_data = users[chat_id]
+
+    # الخروج من الكتاب الحالي (أو الانتقال لكتاب آخر) ينهي جلسته في كاش السياق
+    if action in ('main_menu', 'general_chat', 'search_books') or action.startswith("book:"):
+        leave_book_session(chat_id)
 
     # توجيه المستخدم حسب الزر الذي ضغطه
     if action == 'main_menu':
         user_data['state'] = 'main_menu'
-        save_users(users)
+        user_store.save(chat_id, user_data)
         show_main_menu(chat_id, call.message.message_id)
     elif action == 'show_help':
-        bot.delete_message(chat_id, call.message.message_id)
+        tg.delete_message(chat_id, call.message.message_id, wait=False)
         send_help_message(chat_id)
     elif action == 'send_feedback':
         user_data['state'] = 'awaiting_feedback'
-        save_users(users)
-        bot.edit_message_text(
+        user_store.save(chat_id, user_data)
+        tg.edit_message_text(
             "✍️ من فضلك، اكتب الآن اقتراحك أو وصف المشكلة وسأقوم بإرسالها للمطور.",
-            chat_id, call.message.message_id
+            chat_id, call.message.message_id, wait=False
         )
     elif action == "general_chat":
         user_data['state'] = 'general_chat'
         user_data['chat_history'] = []
-        save_users(users)
-        bot.edit_message_text(
+        user_data.pop('history_digest', None)
+        user_store.save(chat_id, user_data)
+        tg.edit_message_text(
             "🤖 *تم تفعيل وضع البحث العام.*\n\nتفضل بسؤالك في أي موضوع.",
-            chat_id, call.message.message_id, parse_mode="Markdown"
+            chat_id, call.message.message_id, parse_mode="Markdown", wait=False
         )
     elif action == "search_books":
         user_data['state'] = 'choosing_book'
-        save_users(users)
+        user_store.save(chat_id, user_data)
         show_book_list(chat_id, call.message.message_id)
+    elif action.startswith("books_page:"):
+        show_book_list(chat_id, call.message.message_id, page=int(action.split(':', 1)[1]))
     elif action.startswith("book:"):
         try:
             _, book_id = action.split(':', 1)
-            # استرجاع اسم الكتاب من البيانات المخزنة مؤقتاً
-            available_books = user_data.get('available_books', [])
-            book_name = next((b['name'] for b in available_books if b['id'] == book_id), None)
+            # استرجاع بيانات الكتاب من فهرس الكتب المشترك
+            book = book_catalog.get(book_id)
+            book_name = book['name'] if book else None
             
             if not book_name:
-                bot.edit_message_text("حدث خطأ، لم أتمكن من العثور على الكتاب. حاول مرة أخرى.", chat_id, call.message.message_id)
+                tg.edit_message_text("حدث خطأ، لم أتمكن من العثور على الكتاب. حاول مرة أخرى.", chat_id, call.message.message_id, wait=False)
                 return
 
             user_data['state'] = 'book_chat'
             user_data['chat_history'] = []
+            user_data.pop('history_digest', None)
             user_data['selected_book_id'] = book_id
             user_data['selected_book_name'] = book_name
-            user_data.pop('available_books', None) # حذف قائمة الكتب المؤقتة
-            save_users(users)
+            user_data['selected_book_version'] = book_version(book)
+            user_data.pop('available_books', None) # حذف نسخة قائمة الكتب القديمة المخزنة لكل مستخدم
+            user_store.save(chat_id, user_data)
+            context_caches.touch(chat_id, book_id)
             
-            bot.delete_message(chat_id, call.message.message_id)
-            loading_msg = bot.send_message(chat_id, f"⏳ يتم الآن تحميل ومعالجة كتاب '{book_name}'...")
+            tg.delete_message(chat_id, call.message.message_id, wait=False)
+            loading_msg = tg.send_message(chat_id, f"⏳ يتم الآن تحميل ومعالجة كتاب '{book_name}'...")
             
             # تحميل الكتاب (وتوليد KB إذا لزم الأمر)
-            content = get_book_content(book_id, book_name, call.from_user)
-            bot.delete_message(chat_id, loading_msg.message_id)
+            content = get_book_content(book_id, book_name, call.from_user, user_data['selected_book_version'])
+            tg.delete_message(chat_id, loading_msg.message_id, wait=False)
 
             reply_markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
             reply_markup.add(telebot.types.KeyboardButton("⬅️ العودة إلى قائمة الكتب"))
 
-            if "خطأ:" in content or "عذراً،" in content:
-                bot.send_message(chat_id, content, reply_markup=reply_markup)
+            if is_book_error(content):
+                tg.send_message(chat_id, content, reply_markup=reply_markup, wait=False)
             else:
-                bot.send_message(chat_id, f"✅ تم تحميل كتاب '{book_name}'.\nيمكنك الآن طرح أسئلتك حول محتواه.", reply_markup=reply_markup)
+                tg.send_message(chat_id, f"✅ تم تحميل كتاب '{book_name}'.\nيمكنك الآن طرح أسئلتك حول محتواه.", reply_markup=reply_markup, wait=False)
         except Exception as e:
-            bot.send_message(chat_id, f"حدث خطأ في معالجة اختيارك: {e}")
+            tg.send_message(chat_id, f"حدث خطأ في معالجة اختيارك: {e}", wait=False)
             log_interaction(call.from_user, "❌ خطأ في اختيار الكتاب", f"الخطأ: {e}")
 
 @bot.message_handler(func=lambda m: True)
@@ -642,113 +1375,284 @@ def handle_user_message(message):
         send_subscription_message(chat_id)
         return
         
-    users = load_users()
-    if chat_id not in users:
+    user_data = user_store.get(chat_id)
+    if user_data is None:
         handle_start(message)
         return
-    user_data = users[chat_id]
     user_state = user_data.get('state')
 
     # التعامل مع رسالة العودة لقائمة الكتب
     if message.text == "⬅️ العودة إلى قائمة الكتب":
         log_interaction(message.from_user, "⬅️ العودة لقائمة الكتب")
+        leave_book_session(chat_id)
         user_data['state'] = 'choosing_book'
-        save_users(users)
+        user_store.save(chat_id, user_data)
         remove_markup = telebot.types.ReplyKeyboardRemove()
-        bot.send_message(chat_id, "جاري العودة لقائمة الكتب...", reply_markup=remove_markup, disable_notification=True)
+        tg.send_message(chat_id, "جاري العودة لقائمة الكتب...", reply_markup=remove_markup, disable_notification=True, wait=False)
         show_book_list(chat_id)
         return
 
     # التعامل مع رسالة الاقتراح
     if user_state == 'awaiting_feedback':
         log_interaction(message.from_user, "📝 اقتراح/مشكلة جديدة", f"الرسالة: {message.text}")
-        bot.send_message(chat_id, "✅ شكرًا لك! تم استلام رسالتك وسيتم مراجعتها.")
+        tg.send_message(chat_id, "✅ شكرًا لك! تم استلام رسالتك وسيتم مراجعتها.", wait=False)
         user_data['state'] = 'main_menu'
-        save_users(users)
+        user_store.save(chat_id, user_data)
         show_main_menu(chat_id)
         return
 
     # التعامل مع رسائل الأسئلة (بحث عام أو في كتاب)
     if user_state in ['general_chat', 'book_chat']:
-        current_time = time.time()
-        last_query_time = user_data.get('last_query_time', 0)
-        
-        # تطبيق فترة الانتظار (Cooldown)
-        if current_time - last_query_time < COOLDOWN_SECONDS:
-            remaining = round(COOLDOWN_SECONDS - (current_time - last_query_time))
-            bot.send_message(chat_id, f"⏳ الرجاء الانتظار {remaining} ثانية قبل طرح سؤال جديد.")
+        received_at = time.monotonic()
+
+        # تطبيق حدود المعدل (فحص واستهلاك ذري في الذاكرة، بدون كتابة لبيانات المستخدم)
+        allowed, wait, rule = rate_limiter.acquire(chat_id, user_state)
+        if not allowed:
+            remaining = RateLimiter.wait_seconds(wait)
+            if rule.scope == "global":
+                tg.send_message(chat_id, f"⏳ البوت مشغول حالياً بكثرة الأسئلة، الرجاء المحاولة بعد {remaining} ثانية.", wait=False)
+            else:
+                tg.send_message(chat_id, f"⏳ الرجاء الانتظار {remaining} ثانية قبل طرح سؤال جديد.", wait=False)
             return
-        
-        user_data['last_query_time'] = current_time
-        save_users(users)
-        
-        processing_msg = bot.send_message(chat_id, "⏳ جارِ معالجة طلبك...")
+
+        processing_msg = tg.send_message(chat_id, "⏳ جارِ معالجة طلبك...")
         
         gemini_context = "" 
         found_in_kb = False # لتحديد مصدر الإجابة
         response_text = ""
+        chat_history = user_data.get("chat_history", [])
+        book_id = user_data.get('selected_book_id') if user_state == 'book_chat' else None
+        cache_key = answer_cache.make_key(user_state, message.text, chat_history,
+                                          book_id=book_id, book_version=user_data.get('selected_book_version') if book_id else None)
 
         # --- منطق البحث الذكي ---
+        cached_answer = answer_cache.lookup(cache_key)
+        if cached_answer is not None:
+            # 0. نفس السؤال سُئل من قبل (من أي مستخدم): الإجابة من كاش الإجابات بدون طلب Gemini
+            tg.delete_message(chat_id, processing_msg.message_id, wait=False)
+            send_long_message(chat_id, cached_answer, parse_mode="Markdown")
+            answers_total.inc(source="answer_cache")
+            append_chat_history(chat_id, message.text, cached_answer)
+            a = answer_cache.stats()
+            log_interaction(message.from_user, "💬 إجابة من كاش الإجابات", (
+                f"❓ *السؤال:*\n{message.text}\n\n"
+                f"طلبات Gemini الموفرة: {a['gemini_calls_saved']} ({a['saved_ratio'] * 100:.0f}%)"
+            ))
+            return
+
         if user_state == 'book_chat':
-            book_id = user_data.get('selected_book_id')
             book_name = user_data.get('selected_book_name', 'غير محدد')
-            current_book_kb = book_knowledge_bases.get(book_id, [])
+            context_caches.touch(chat_id, book_id)
+            matcher = kb_store.get(book_id)
+            if not matcher:
+                kb_lookups.inc(result="no_kb")
             
             # 1. البحث في قاعدة المعرفة المحلية (Fuzzy Matching)
-            if current_book_kb: 
-                kb_questions = [entry['standard_question'] for entry in current_book_kb]
-                best_match = process.extractOne(message.text, kb_questions, scorer=fuzz.token_sort_ratio)
+            if matcher: 
+                with kb_match_seconds.time():
+                    best_match = matcher.match(message.text, threshold=KB_MATCH_THRESHOLD) # نسبة تطابق 85% أو أكثر
+                kb_lookups.inc(result="hit" if best_match else "miss")
                 
-                if best_match and best_match[1] >= 85: # نسبة تطابق 85% أو أكثر
-                    matched_question_text = best_match[0]
-                    response_text = next((e['answer'] for e in current_book_kb if e['standard_question'] == matched_question_text), None)
+                if best_match:
+                    entry_index, score, top_matches = best_match
+                    response_text = matcher.entries[entry_index]['answer']
                     found_in_kb = True
-                    log_interaction(message.from_user, f"💬 إجابة من KB", f"للسؤال: `{message.text}`\nالكتاب: {book_name}\nالتطابق: {best_match[1]}%")
+                    candidates = "\n".join(f"- {matcher.questions[i]} ({s}%)" for i, s in top_matches)
+                    log_interaction(message.from_user, f"💬 إجابة من KB", f"للسؤال: `{message.text}`\nالكتاب: {book_name}\nالتطابق: {score}%\n\nأفضل المرشحين:\n{candidates}")
             
-            # 2. إذا لم يتم العثور على إجابة، جهز البحث الكامل عبر Gemini
+            # 2. إذا لم يتم العثور على إجابة، جهز أجزاء الكتاب المتعلقة بالسؤال وأرسلها إلى Gemini
             if not found_in_kb:
-                gemini_context = get_book_content(book_id, book_name, message.from_user)
-                if "خطأ:" in gemini_context or "عذراً،" in gemini_context:
-                    bot.delete_message(chat_id=chat_id, message_id=processing_msg.message_id)
-                    bot.send_message(chat_id, gemini_context)
+                gemini_context, book_error = get_book_context(book_id, book_name, message.text, message.from_user, user_data.get('selected_book_version'))
+                if book_error:
+                    tg.delete_message(chat_id, processing_msg.message_id, wait=False)
+                    tg.send_message(chat_id, book_error, wait=False)
                     return
 
-        # --- إرسال الطلب واستقبال الرد ---
-        if not found_in_kb:
-            response_text = send_to_gemini(message.from_user, message.text, user_data.get("chat_history", []), gemini_context)
-            log_source = "Gemini (كتاب)" if user_state == 'book_chat' else "Gemini (عام)"
-            log_interaction(message.from_user, f"💬 إجابة من {log_source}", f"❓ *السؤال:*\n{message.text}\n\n🤖 *الرد:*\n{response_text[:500]}...")
-        
-        # إرسال الرد النهائي للمستخدم
-        bot.delete_message(chat_id, processing_msg.message_id)
-        send_long_message(chat_id, response_text, parse_mode="Markdown")
-        
-        # تحديث سجل المحادثة فقط إذا كانت الإجابة من Gemini
-        if not found_in_kb:
-            history = user_data.get("chat_history", [])
-            history.append({"role": "user", "parts": [{"text": message.text}]})
-            history.append({"role": "model", "parts": [{"text": response_text}]})
-            user_data["chat_history"] = history[-10:] # الاحتفاظ بآخر 5 محاورات
-            save_users(users)
+        # --- إرسال الرد ---
+        if found_in_kb:
+            tg.delete_message(chat_id, processing_msg.message_id, wait=False)
+            send_long_message(chat_id, response_text, parse_mode="Markdown")
+            answers_total.inc(source="kb")
+        else:
+            # طلب Gemini قد يستغرق دقيقة أو أكثر، لذلك يُنفذ على حلقة engine ويعود المعالج فوراً
+            engine.submit(answer_with_gemini(message, user_state, chat_history, gemini_context, processing_msg, cache_key, received_at,
+                                             (book_id, user_data.get('selected_book_version')) if book_id else None,
+                                             user_data.get("history_digest", "")))
     else:
         # إذا كان المستخدم في حالة غير معروفة، أعده للقائمة الرئيسية
         show_main_menu(chat_id)
 
+def append_chat_history(chat_id, question, answer):
+    """إضافة سؤال وإجابته لسجل محادثة المستخدم (نقرأ أحدث نسخة من بياناته لأنها قد تغيرت أثناء الانتظار)."""
+    user_data = user_store.get(chat_id)
+    if user_data is not None:
+        history = user_data.get("chat_history", [])
+        history.append({"role": "user", "parts": [{"text": question}]})
+        history.append({"role": "model", "parts": [{"text": answer}]})
+        overflow = len(history) - CHAT_HISTORY_MESSAGES
+        if overflow > 0:
+            # المحاورات الأقدم لا تُحذف بل تُختصر في ملخص متراكم يُرسل مع الطلبات التالية
+            overflow += overflow % 2
+            user_data["history_digest"] = fold_digest(user_data.get("history_digest", ""), history[:overflow],
+                                                      HISTORY_DIGEST_CHARS)
+            history = history[overflow:]
+        user_data["chat_history"] = history
+        user_store.save(chat_id, user_data)
+
+async def answer_with_gemini(message, user_state, chat_history, gemini_context, processing_msg, cache_key=None, received_at=None, book_ref=None,
+                             history_digest=""):
+    """
+    إكمال معالجة السؤال على حلقة engine: طلب Gemini، إرسال الرد، ثم تحديث سجل المحادثة.
+    إذا كان نفس السؤال قيد التنفيذ لمستخدم آخر يُنتظر رده بدلاً من طلب جديد (answer_cache).
+    مع STREAM_RESPONSES تُعدل رسالة "جارِ المعالجة" تدريجياً أثناء وصول الرد.
+    """
+    chat_id = str(message.chat.id)
+    try:
+        reply = None
+        if STREAM_RESPONSES:
+            reply = StreamingReply(tg, chat_id, processing_msg.message_id, edit_interval=STREAM_EDIT_INTERVAL, started_at=received_at)
+        response_text, source = await answer_cache.get_or_compute(
+            cache_key,
+            lambda: send_to_gemini_async(message.from_user, message.text, list(chat_history), gemini_context,
+                                         on_text=reply.update if reply else None, book_ref=book_ref,
+                                         history_digest=history_digest),
+            cacheable=is_cacheable_answer
+        )
+        log_source = "Gemini (كتاب)" if user_state == 'book_chat' else "Gemini (عام)"
+        if source == "coalesced":
+            log_source += " - مشترك مع طلب مطابق جارٍ"
+        log_interaction(message.from_user, f"💬 إجابة من {log_source}", f"❓ *السؤال:*\n{message.text}\n\n🤖 *الرد:*\n{response_text[:500]}...")
+
+        # الرد يمر بطابور الإرسال؛ تعديلات الرد التدريجي تُنتظر كـ Future على الحلقة (لا تحجز خيطاً ولا توقف قراءة الرد)
+        if reply:
+            await reply.finish(response_text)
+            if source == "gemini" and reply.first_visible_after is not None:
+                ttft_samples.append(reply.first_visible_after)
+        else:
+            tg.delete_message(chat_id, processing_msg.message_id, wait=False)
+            send_long_message(chat_id, response_text, parse_mode="Markdown")
+
+        answers_total.inc(source="answer_cache" if source == "cache" else source)
+
+        # تحديث سجل المحادثة
+        append_chat_history(chat_id, message.text, response_text)
+    except Exception as e:
+        print(f"خطأ في إكمال الرد للمستخدم {chat_id}: {e}")
+        log_interaction(message.from_user, "❌ خطأ في إرسال الرد", f"الخطأ: {e}")
+
+def leave_book_session(chat_id):
+    """المستخدم غادر الكتاب: إذا كان آخر من يقرؤه تُحذف كاشات سياقه من Gemini."""
+    book_id = context_caches.leave(chat_id)
+    if book_id:
+        engine.submit(context_caches.drop_book(book_id))
+
+async def context_cache_sweeper(interval=60):
+    """حذف كاشات سياق الكتب التي لم يُسأل عنها منذ CONTEXT_CACHE_IDLE ثانية."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await context_caches.sweep()
+        except Exception as e:  # خطأ في دورة واحدة لا يوقف الحذف نهائياً
+            print(f"خطأ في تنظيف كاشات السياق: {e!r}")
+
+def process_webhook_update(update_json):
+    """تسليم تحديث وصل عبر Webhook لمعالجات telebot (يتم تنفيذها في مجمع خيوط البوت)."""
+    update = telebot.types.Update.de_json(update_json)
+    if update:
+        bot.process_new_updates([update])
+
+# ==============================================================================
+#  التشغيل على عدة عمليات (العملية الأمامية)
+# ==============================================================================
+def run_front():
+    """
+    العملية الأمامية (BOT_WORKERS > 1): تستقبل التحديثات وتوجه كل تحديث لعامل محادثته بدون معالجته،
+    وتخدم KeyPool المشترك للعمال. العمال يعاد تشغيلهم تلقائياً إذا توقفوا.
+    """
+    authkey = os.urandom(16)
+    worker_secret = secrets.token_hex(16)
+    key_pool_host, key_pool_port = serve_key_pool(key_pool, authkey)
+    env = dict(worker_environment(), BOT_WORKER_KEY_POOL=f"{key_pool_host}:{key_pool_port}",
+               BOT_WORKER_AUTHKEY=authkey.hex(), BOT_WORKER_SECRET=worker_secret)
+    workers = WorkerPool(BOT_WORKERS, os.path.abspath(__file__), WORKER_BASE_PORT, worker_secret, env)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # حتى يُوقف العمال معه عند إيقافه بـ SIGTERM
+    workers.start()
+    try:
+        if BOT_MODE == 'webhook':
+            if not WEBHOOK_URL:
+                raise ValueError("يجب تحديد WEBHOOK_URL عند استخدام BOT_MODE=webhook")
+            engine.start_webhook(workers.route, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                                 path=urlparse(WEBHOOK_URL).path or '/', secret_token=WEBHOOK_SECRET)
+            bot.remove_webhook()
+            bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                            allowed_updates=telebot.util.update_types, drop_pending_updates=True)
+            print(f"⏳ العملية الأمامية تستقبل التحديثات (Webhook على المنفذ {WEBHOOK_PORT}) وتوزعها على {BOT_WORKERS} عمال...")
+            while True:
+                time.sleep(3600)
+        else:
+            bot.remove_webhook()
+            print(f"⏳ العملية الأمامية تستقبل التحديثات (Polling) وتوزعها على {BOT_WORKERS} عمال...")
+            poll_updates(lambda offset: telebot.apihelper.get_updates(
+                BOT_TOKEN, offset=offset, limit=100, timeout=40, long_polling_timeout=30,
+                allowed_updates=telebot.util.update_types), workers.route)
+    except KeyboardInterrupt:
+        print("تم إيقاف البوت.")
+    finally:
+        workers.stop()
+
 # ==============================================================================
 #  نقطة انطلاق البوت
 # ==============================================================================
 if __name__ == "__main__":
     
-    print(f"🚀 [Dowedar Bot] - بدء تشغيل البوت...")
+    print(f"🚀 [Dowedar Bot] - بدء تشغيل البوت..." + (f" (العامل {WORKER_INDEX})" if IS_WORKER else ""))
     print(f"Timestamp: {time.strftime('%Y-%m-%d %H:%M:%S')}")
     print("-" * 30)
     print("✅ تم تحميل المتغيرات البيئية بنجاح.")
+
+    if BOT_WORKERS > 1 and not IS_WORKER:
+        run_front()
+        raise SystemExit(0)
     
-    # تحميل جميع قواعد المعرفة الموجودة مسبقاً
-    load_all_book_kbs()
+    # فهرسة قواعد المعرفة في الخلفية (القواعد نفسها تُحمّل عند أول سؤال عن الكتاب)
+    kb_store.start()
+    book_catalog.start()  # مزامنة قائمة الكتب من Drive في الخلفية
+    engine.submit(context_cache_sweeper())
+    if METRICS_PORT:
+        MetricsServer(metrics, METRICS_HOST, METRICS_PORT + (WORKER_INDEX or 0)).start()
     
     print("-" * 30)
-    print("⏳ البوت الآن قيد التشغيل وجاهز لاستقبال الرسائل...")
-    bot.infinity_polling(skip_pending=True)
+    if IS_WORKER:
+        # العامل يستقبل التحديثات من العملية الأمامية فقط (بدون setWebhook)
+        worker_port = int(os.environ['BOT_WORKER_PORT'])
+        engine.start_webhook(process_webhook_update, '127.0.0.1', worker_port, path=WORKER_UPDATE_PATH,
+                             secret_token=os.environ['BOT_WORKER_SECRET'])
+        print(f"⏳ العامل {WORKER_INDEX} جاهز لاستقبال التحديثات على المنفذ {worker_port}...")
+        front_pid = os.getppid()
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # إيقاف منظم (atexit يحفظ الحالة) عند إيقاف الأمامي له
+        try:
+            while os.getppid() == front_pid:  # إذا توقفت العملية الأمامية فجأة يتوقف العامل أيضاً
+                time.sleep(5)
+        except KeyboardInterrupt:
+            print("تم إيقاف العامل.")
+    elif BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise ValueError("يجب تحديد WEBHOOK_URL عند استخدام BOT_MODE=webhook")
+        engine.start_webhook(process_webhook_update, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                             path=urlparse(WEBHOOK_URL).path or '/', secret_token=WEBHOOK_SECRET)
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                        allowed_updates=telebot.util.update_types, drop_pending_updates=True)
+        print(f"⏳ البوت الآن قيد التشغيل (Webhook على المنفذ {WEBHOOK_PORT}) وجاهز لاستقبال الرسائل...")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            print("تم إيقاف البوت.")
+    else:
+        print("⏳ البوت الآن قيد التشغيل وجاهز لاستقبال الرسائل...")
+        bot.remove_webhook()
+        # chat_member لا يُرسل افتراضياً من Telegram، لذلك نطلبه صراحةً لتحديث كاش الاشتراك
+        bot.infinity_polling(skip_pending=True, allowed_updates=telebot.util.update_types)
 
     
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  مقاييس الأداء (عدادات + Histograms) ونقطة /metrics بصيغة Prometheus
+# ==============================================================================
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# حدود Histograms الافتراضية بالثواني: من مطابقة KB (أجزاء من الثانية) حتى تحميل وتوليد الكتب (دقائق)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"التسميات المتوقعة {labelnames}، والمُمررة {sorted(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def bucket_quantile(q, buckets, cumulative, total):
+    """النسبة المئوية q من أعداد تراكمية لكل حد (مثل histogram_quantile)، أو None إذا لم توجد قياسات."""
+    if not total:
+        return None
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in zip(buckets, cumulative):
+        if count >= rank:
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return buckets[-1]  # القيمة أكبر من آخر حد
+
+
+class Counter:
+    """عداد تراكمي لكل مجموعة تسميات (labels)."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def values(self):
+        """{قيم التسميات: العدد} لكل المجموعات."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        for key, value in self.values().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """توزيع زمني (أو أي قيمة) على حدود ثابتة، بنفس معنى Histogram في Prometheus."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # قيم التسميات -> [عدد كل حد..., المجموع, العدد الكلي]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """قياس زمن تنفيذ الكتلة. يمكن تعديل التسميات داخلها (labels["outcome"] = ...) قبل التسجيل."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def series(self):
+        """{قيم التسميات: (أعداد تراكمية لكل حد، المجموع، العدد)}."""
+        with self._lock:
+            snapshot = {key: list(series) for key, series in self._series.items()}
+        result = {}
+        for key, series in snapshot.items():
+            cumulative, running = [], 0
+            for count in series[:len(self.buckets)]:
+                running += count
+                cumulative.append(running)
+            result[key] = (cumulative, series[-2], series[-1])
+        return result
+
+    def quantile(self, q, key=None):
+        """
+        تقدير النسبة المئوية q (0..1) من الحدود بالاستيفاء الخطي (مثل histogram_quantile).
+        key = قيم التسميات لمجموعة واحدة، أو None لدمج كل المجموعات. يرجع None إذا لم توجد قياسات.
+        """
+        series = self.series()
+        if key is not None:
+            series = {key: series[key]} if key in series else {}
+        if not series:
+            return None
+        cumulative = [sum(values[0][i] for values in series.values()) for i in range(len(self.buckets))]
+        return bucket_quantile(q, self.buckets, cumulative, sum(values[2] for values in series.values()))
+
+    def render(self):
+        for key, (cumulative, total_sum, count) in self.series().items():
+            for bound, bucket_count in zip(self.buckets, cumulative):
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {bucket_count}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total_sum)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Gauge:
+    """قيمة لحظية تُقرأ عند الطلب من دالة (مثل طول طابور أو نسبة إصابة). الدالة ترجع رقماً أو None."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"فشل قراءة المقياس {self.name}: {e}")
+            return
+        if value is not None:
+            yield f"{self.name} {_format_value(value)}"
+
+
+class MetricsRegistry:
+    """كل مقاييس البوت، وتحويلها لصيغة نص Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"المقياس {metric.name} مسجل من قبل")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, fn):
+        return self._register(Gauge(name, help_text, fn))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """خادم HTTP محلي صغير يعرض registry على المسار /metrics (في خيط خلفي)."""
+
+    def __init__(self, registry, host="127.0.0.1", port=9464):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # بدون طباعة سطر لكل طلب
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f"📈 مقاييس الأداء متاحة على http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
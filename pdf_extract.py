@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  استخراج نص ملفات PDF بالتوازي على عدة عمليات (عمليات مستقلة لكل كتاب)
+# ==============================================================================
+import os
+import sys
+import time
+import queue
+import pickle
+import struct
+import threading
+import subprocess
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+import fitz  # PyMuPDF لمعالجة ملفات PDF
+
+
+class PDFExtractionError(Exception):
+    """فشل استخراج نص الكتاب (مشفر، تجاوز المهلة، أو ملف تالف)."""
+
+
+class PDFEncryptedError(PDFExtractionError):
+    pass
+
+
+class PDFExtractionTimeout(PDFExtractionError):
+    pass
+
+
+def _worker_main(path, output_fd):
+    """
+    عملية الاستخراج (python pdf_extract.py <path> <fd>): تفتح الملف مرة واحدة، وتقرأ من stdin أسطر "start end"
+    وتكتب لكل سطر نص الصفحات [start, end) (pickle مسبوق بطوله) في output_fd حتى ينتهي stdin.
+    النتائج لا تمر عبر stdout لأن fitz قد يطبع عليه تحذيرات.
+    """
+    output = os.fdopen(output_fd, "wb")
+    with fitz.open(path) as doc:
+        for line in sys.stdin:
+            start, end = map(int, line.split())
+            data = pickle.dumps([doc[i].get_text() for i in range(start, end)])
+            output.write(struct.pack(">Q", len(data)) + data)
+            output.flush()
+
+
+class _ExtractionJob:
+    """عمليات استخراج كتاب واحد: انتهاء مهلته أو فشله يوقف عملياته هو فقط."""
+
+    def __init__(self, path, deadline):
+        self.path = path
+        self.deadline = deadline
+        self.cancelled = False
+        self.error = None  # سبب إيقاف الكتاب (إن وُجد)، يُرفع لكل نطاقاته بدلاً من خطأ توقف عملياته
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def spawn(self):
+        """عملية جديدة للكتاب وملف قراءة نتائجها، أو None إذا أُلغي الاستخراج."""
+        with self._lock:
+            if self.cancelled:
+                return None
+            read_fd, write_fd = os.pipe()
+            try:
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.path, str(write_fd)],
+                                           stdin=subprocess.PIPE, pass_fds=(write_fd,))
+            except BaseException:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            self._processes.append(process)
+            return process, os.fdopen(read_fd, "rb")
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            processes = list(self._processes)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+
+class PDFExtractor:
+    """
+    مستخرج نص PDF يوزع نطاقات الصفحات على عدة عمليات، فلا يحجز الاستخراج الـ GIL
+    عن باقي المستخدمين. الصفحات تُرجع بالترتيب (iter_pages)، ولكل كتاب مهلة قصوى وحد أقصى لعدد الصفحات.
+    الكتب الصغيرة (أقل من parallel_min_pages) تُستخرج مباشرة لأن كلفة التوزيع أكبر من الفائدة.
+
+    كل كتاب يستخرج بعملياته الخاصة (حتى workers عملية، والحد مشترك بين كل الكتب): الصفحة العالقة أو العملية
+    المتوقفة لا تؤثر إلا على كتابها. العمليات تُشغل كبرنامج مستقل (subprocess يشغل هذا الملف، ولا يستورد إلا fitz)،
+    فلا تُنسخ خيوط البوت وأقفاله كما في fork، ولا يُعاد تنفيذ main.py كما في spawn/forkserver.
+    """
+
+    def __init__(self, workers=None, max_pages=2000, timeout=180, parallel_min_pages=40, batches_per_worker=4):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.parallel_min_pages = parallel_min_pages
+        self.batches_per_worker = batches_per_worker
+        self._slots = threading.BoundedSemaphore(self.workers)  # عمليات الاستخراج الجارية لكل الكتب معاً
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    def _serve(self, job, pending, futures):
+        """خيط يشغل عملية واحدة للكتاب ويغذيها بنطاقات الصفحات من pending حتى تنتهي."""
+        if not self._slots.acquire(timeout=max(0.0, job.deadline - time.monotonic())):
+            return  # iter_pages ترفع PDFExtractionTimeout عند انتهاء المهلة
+        try:
+            try:
+                spawned = job.spawn()
+            except Exception as e:  # EMFILE/ENOMEM من Popen: الخطأ الحقيقي بدلاً من انتظار المهلة كاملة
+                self._fail_pending(job, pending, futures, PDFExtractionError(f"تعذر تشغيل عملية الاستخراج: {e!r}"))
+                return
+            if spawned is None:
+                return
+            process, results = spawned
+            with process, results:
+                while not job.cancelled:
+                    try:
+                        start, end = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    future = futures[start]
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        process.stdin.write(f"{start} {end}\n".encode())
+                        process.stdin.flush()
+                        header = results.read(8)
+                        if len(header) < 8:
+                            raise EOFError(f"رمز الخروج {process.wait()}")
+                        future.set_result(pickle.loads(results.read(struct.unpack(">Q", header)[0])))
+                    except Exception as e:
+                        future.set_exception(job.error or PDFExtractionError(f"توقفت عملية الاستخراج بشكل غير متوقع: {e!r}"))
+                        job.cancel()
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _fail_pending(job, pending, futures, error):
+        """إنهاء الكتاب بـ error: النطاقات التي لم تأخذها أي عملية تفشل، وعمليات الكتاب تتوقف (فتفشل نطاقاتها)."""
+        job.error = error
+        job.cancel()
+        while True:
+            try:
+                start, _ = pending.get_nowait()
+            except queue.Empty:
+                break
+            if futures[start].set_running_or_notify_cancel():
+                futures[start].set_exception(error)
+
+    def _ranges(self, page_count):
+        batches = min(page_count, self.workers * self.batches_per_worker)
+        size = -(-page_count // batches)
+        return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+    def iter_pages(self, path):
+        """
+        نص صفحات الكتاب بالترتيب كمولد (رقم الصفحة يبدأ من 1, النص)، مع الالتزام بـ max_pages و timeout.
+        ترفع PDFEncryptedError أو PDFExtractionTimeout أو PDFExtractionError.
+        """
+        deadline = time.monotonic() + self.timeout
+        try:
+            with fitz.open(path) as doc:
+                if doc.is_encrypted:
+                    raise PDFEncryptedError("الملف مشفر")
+                page_count = min(doc.page_count, self.max_pages)
+                if doc.page_count > self.max_pages:
+                    print(f"⚠️ الكتاب يحتوي على {doc.page_count} صفحة، سيتم استخراج أول {self.max_pages} فقط.")
+                if page_count < self.parallel_min_pages or self.workers < 2:
+                    for i in range(page_count):
+                        if time.monotonic() > deadline:
+                            raise PDFExtractionTimeout(f"تجاوز الاستخراج المهلة ({self.timeout} ثانية)")
+                        yield i + 1, doc[i].get_text()
+                    return
+        except (RuntimeError, ValueError) as e:  # fitz يرفع RuntimeError للملفات التالفة
+            raise PDFExtractionError(str(e)) from e
+
+        job = _ExtractionJob(path, deadline)
+        pending = queue.Queue()
+        futures = []
+        for start, end in self._ranges(page_count):
+            futures.append((start, Future()))
+            pending.put((start, end))
+        with self._lock:
+            self._jobs.add(job)
+        for _ in range(min(self.workers, len(futures))):
+            threading.Thread(target=self._serve, args=(job, pending, dict(futures)), name="pdf-extract", daemon=True).start()
+        try:
+            for start, future in futures:
+                pages = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                for offset, text in enumerate(pages):
+                    yield start + offset + 1, text
+        except FutureTimeout:
+            raise PDFExtractionTimeout(f"تجاوز الاستخراج المهلة ({self.timeout} ثانية)")
+        finally:
+            job.cancel()  # عمليات هذا الكتاب فقط (وفي الاستخراج المكتمل تكون قد انتهت بالفعل)
+            for _, future in futures:
+                future.cancel()
+            with self._lock:
+                self._jobs.discard(job)
+
+    def extract_text(self, path, separator="\f"):
+        """نص الكتاب كاملاً، الصفحات مفصولة بـ separator (حدود الصفحات تُستخدم للاستشهاد بأرقامها)."""
+        return separator.join(text for _, text in self.iter_pages(path))
+
+    def close(self):
+        """إيقاف كل عمليات الاستخراج الجارية."""
+        with self._lock:
+            jobs = list(self._jobs)
+        for job in jobs:
+            job.cancel()
+
+
+if __name__ == "__main__":
+    _worker_main(sys.argv[1], int(sys.argv[2]))
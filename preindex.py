@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+فهرسة مكتبة Drive مسبقاً (بدون تليجرام): تحميل كل كتاب جديد أو معدّل واستخراج نصه وبناء فهرس الاسترجاع
+وقاعدة المعرفة، حتى لا يدفع أول مستخدم للكتاب ثمن كل ذلك أثناء انتظاره.
+
+التشغيل (بنفس ملف .env الخاص بالبوت، ومن نفس المجلد حتى تُكتب الملفات حيث يقرأها البوت):
+    python preindex.py [--download-workers 4] [--kb-workers 2] [--only ID ...] [--force] [--report preindex_report.json]
+
+- مرحلتان متوازيتان بحدود منفصلة: تحميل/استخراج (download-workers) ثم توليد KB (kb-workers)،
+  وكل كتاب ينتقل للمرحلة الثانية بمجرد جاهزية نصه.
+- الاستئناف: النصوص المستخرجة (book_cache) وقواعد المعرفة المكتملة لا تُعاد، والبناء غير المكتمل
+  يُستأنف من الأقسام المتبقية (KBBuildProgress). نسخة الكتاب التي بُنيت منها كل قاعدة تُحفظ في
+  preindex_state.json، فإذا تغير الكتاب في Drive تُبنى قاعدته من جديد.
+- في النهاية يُكتب تقرير JSON بحالة كل كتاب وأزمنة المراحل.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import main as bot
+
+STATE_PATH = "preindex_state.json"
+
+# مستخدم وهمي لسجلات log_interaction واستدعاءات Gemini (لا تُرسل له رسائل)
+PREINDEX_USER = SimpleNamespace(id=0, first_name="preindex", last_name=None, username=None)
+
+
+class PreindexState:
+    """book_id -> نسخة الكتاب التي بُنيت منها قاعدة المعرفة المكتملة (كتابة ذرية بعد كل كتاب)."""
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                self._kb_versions = json.load(f).get("kb_versions", {})
+        except (OSError, ValueError):
+            self._kb_versions = {}
+
+    def kb_version(self, book_id):
+        with self._lock:
+            return self._kb_versions.get(book_id)
+
+    def set_kb_version(self, book_id, version):
+        with self._lock:
+            self._kb_versions[book_id] = version
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump({"kb_versions": self._kb_versions}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class Preindexer:
+    def __init__(self, books, state, download_workers=4, kb_workers=2, force=False):
+        self.books = books
+        self.state = state
+        self.force = force
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="preindex-download")
+        self.kb_pool = ThreadPoolExecutor(max_workers=kb_workers, thread_name_prefix="preindex-kb")
+        self.results = {}  # book_id -> تفاصيل الكتاب في التقرير
+        self._lock = threading.Lock()
+        self._finished = 0
+        self._all_done = threading.Event()
+
+    # --------------------------------------------------------------------------
+    #  تحديد العمل المطلوب لكل كتاب
+    # --------------------------------------------------------------------------
+    def text_ready(self, book_id, version):
+        return not self.force and bot.book_cache.latest_version(book_id) == version
+
+    def kb_ready(self, book_id, version):
+        """
+        قاعدة مكتملة لنفس النسخة. القواعد التي بناها البوت قبل وجود هذه الأداة ليس لها نسخة مسجلة
+        فتُعتبر جاهزة (استخدم --force لإعادة بنائها).
+        """
+        if self.force or bot.kb_build_pending(book_id) or not bot.kb_store.has_entries(book_id):
+            return False
+        return self.state.kb_version(book_id) in (None, version)
+
+    # --------------------------------------------------------------------------
+    #  المراحل
+    # --------------------------------------------------------------------------
+    def run(self):
+        if not self.books:
+            return self.results
+        for book in self.books:
+            version = bot.book_version(book)
+            self.results[book['id']] = {"id": book['id'], "name": book['name'], "version": version,
+                                        "text": None, "kb": None, "entries": None, "error": None,
+                                        "download_seconds": None, "kb_seconds": None}
+            if self.text_ready(book['id'], version) and self.kb_ready(book['id'], version):
+                self._finish(book['id'], text="cached", kb="ready")
+            else:
+                self.download_pool.submit(self._guard, self._text_stage, book, version)
+        self._all_done.wait()
+        self.download_pool.shutdown()
+        self.kb_pool.shutdown()
+        return self.results
+
+    def _guard(self, stage, book, version, *args):
+        """أي خطأ غير متوقع في مرحلة يُسجل للكتاب ولا يوقف بقية المكتبة."""
+        try:
+            stage(book, version, *args)
+        except Exception as e:
+            print(f"❌ خطأ غير متوقع في فهرسة الكتاب '{book['name']}': {e}")
+            self._finish(book['id'], error=str(e))
+
+    def _text_stage(self, book, version):
+        book_id, name = book['id'], book['name']
+        text = bot.book_cache.get(book_id, version) if self.text_ready(book_id, version) else None
+        if text is not None:
+            bot.get_book_index(book_id, text, version)  # يُبنى فقط إذا كان مفقوداً
+            self._update(book_id, text="cached")
+        else:
+            started = time.perf_counter()
+            text, version = bot.fetch_book_text(book_id, name, version)
+            self._update(book_id, download_seconds=round(time.perf_counter() - started, 3))
+            if bot.is_book_error(text):
+                self._finish(book_id, text="failed", kb="skipped", error=text)
+                return
+            self._update(book_id, text="downloaded", version=version)
+
+        if self.kb_ready(book_id, version):
+            self._finish(book_id, kb="ready")
+        else:
+            self.kb_pool.submit(self._guard, self._kb_stage, book, version, text)
+
+    def _kb_stage(self, book, version, text):
+        book_id, name = book['id'], book['name']
+        if self.state.kb_version(book_id) not in (None, version) and not bot.kb_build_pending(book_id):
+            print(f"الكتاب '{name}' تغير في Drive، ستُبنى قاعدة معرفته من جديد.")
+        started = time.perf_counter()
+        generated_kb = bot.generate_kb_from_book(book_id, name, text, PREINDEX_USER, version)
+        bot.save_book_kb(book_id, generated_kb)
+        seconds = round(time.perf_counter() - started, 3)
+        if bot.kb_build_pending(book_id):
+            # بعض الأقسام فشلت: القاعدة الجزئية محفوظة والتشغيل التالي يكمل الأقسام المتبقية
+            self._finish(book_id, kb="partial", entries=len(generated_kb), kb_seconds=seconds,
+                         error="لم تكتمل كل الأقسام، أعد التشغيل لاستكمالها")
+            return
+        self.state.set_kb_version(book_id, version)
+        self._finish(book_id, kb="built", entries=len(generated_kb), kb_seconds=seconds)
+
+    # --------------------------------------------------------------------------
+    #  التقدم
+    # --------------------------------------------------------------------------
+    def _update(self, book_id, **fields):
+        with self._lock:
+            self.results[book_id].update(fields)
+
+    def _finish(self, book_id, **fields):
+        with self._lock:
+            result = self.results[book_id]
+            result.update(fields)
+            self._finished += 1
+            finished, total = self._finished, len(self.books)
+        icon = "❌" if result["error"] and result["kb"] != "partial" else ("⚠️" if result["kb"] == "partial" else "✅")
+        print(f"[{finished}/{total}] {icon} {result['name']}: النص={result['text'] or '-'} | KB={result['kb'] or '-'}"
+              + (f" ({result['entries']} إدخال)" if result['entries'] is not None else "")
+              + (f" | {result['error']}" if result['error'] else ""))
+        if finished == total:
+            self._all_done.set()
+
+    def cancel(self):
+        """إلغاء الكتب التي لم تبدأ بعد (الكتب الجارية تكمل مرحلتها الحالية وتُحفظ)."""
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
+        self.kb_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def summarize(results, started_at, seconds):
+    books = list(results.values())
+
+    def count(field, value):
+        return sum(1 for b in books if b[field] == value)
+
+    return {
+        "started_at": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at)),
+        "seconds": round(seconds, 1),
+        "totals": {
+            "books": len(books),
+            "text_downloaded": count("text", "downloaded"),
+            "text_cached": count("text", "cached"),
+            "text_failed": count("text", "failed"),
+            "kb_built": count("kb", "built"),
+            "kb_ready": count("kb", "ready"),
+            "kb_partial": count("kb", "partial"),
+            "errors": sum(1 for b in books if b["error"]),
+            "download_seconds": round(sum(b["download_seconds"] or 0 for b in books), 1),
+            "kb_seconds": round(sum(b["kb_seconds"] or 0 for b in books), 1),
+        },
+        "books": sorted(books, key=lambda b: b["name"]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="فهرسة كل كتب مجلد Drive مسبقاً (نص + فهرس استرجاع + قاعدة معرفة).")
+    parser.add_argument("--download-workers", type=int, default=4, help="عدد الكتب التي تُحمّل وتُستخرج معاً")
+    parser.add_argument("--kb-workers", type=int, default=2,
+                        help="عدد الكتب التي تُولد قواعدها معاً (كل كتاب يستخدم KB_BUILD_WORKERS قسماً بالتوازي)")
+    parser.add_argument("--only", nargs="+", metavar="BOOK_ID", help="فهرسة هذه الكتب فقط")
+    parser.add_argument("--force", action="store_true", help="إعادة التحميل والبناء حتى للكتب الجاهزة")
+    parser.add_argument("--report", default="preindex_report.json", help="مسار تقرير JSON")
+    args = parser.parse_args(argv)
+
+    started_at = time.time()
+    bot.kb_store.reconcile()  # قواعد المعرفة الموجودة على القرص (بما فيها ما بناه البوت)
+    if not bot.book_catalog.refresh():
+        print(f"❌ تعذر جلب قائمة الكتب من Drive: {bot.book_catalog.last_error}")
+        return 1
+    books = bot.book_catalog.books()
+    if args.only:
+        books = [book for book in books if book['id'] in set(args.only)]
+    print(f"📚 {len(books)} كتاب في المكتبة. بدء الفهرسة المسبقة...")
+
+    preindexer = Preindexer(books, PreindexState(), args.download_workers, args.kb_workers, args.force)
+    try:
+        results = preindexer.run()
+    except KeyboardInterrupt:
+        # ما اكتمل محفوظ على القرص، والتشغيل التالي يكمل الباقي
+        print("تم الإيقاف. أعد تشغيل الأداة لاستكمال الفهرسة.")
+        preindexer.cancel()
+        results = preindexer.results
+
+    report = summarize(results, started_at, time.time() - started_at)
+    tmp_path = f"{args.report}.tmp"
+    with open(tmp_path, "w", encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, args.report)
+
+    totals = report["totals"]
+    print("-" * 30)
+    print(f"✅ انتهت الفهرسة خلال {report['seconds']} ثانية: "
+          f"نصوص محملة {totals['text_downloaded']} | قواعد مبنية {totals['kb_built']} | "
+          f"جاهزة مسبقاً {totals['kb_ready']} | غير مكتملة {totals['kb_partial']} | أخطاء {totals['errors']}")
+    print(f"التقرير: {args.report}")
+    return 1 if totals["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
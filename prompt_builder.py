@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  تجميع الطلب ضمن ميزانية رموز: التعليمات، النص المرجعي، آخر المحاورات، وملخص ما سبقها
+# ==============================================================================
+import math
+import threading
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"  # الفاصل بين أجزاء النص المرجعي (BookIndex.build_context)
+
+
+def join_context(parts):
+    """نص مرجعي واحد من أجزاء [(ترتيبها في الكتاب, النص), ...] مرتبة حسب موقعها في الكتاب."""
+    return CONTEXT_SEPARATOR.join(text for _, text in sorted(parts))
+
+
+def contents_chars(contents):
+    """عدد أحرف النصوص في contents (ما يحسبه Gemini رموزاً، بدون بنية JSON)."""
+    return sum(len(part.get("text", "")) for message in contents for part in message.get("parts", []))
+
+
+class TokenEstimator:
+    """
+    تقدير محلي لعدد الرموز = عدد الأحرف × رموز لكل حرف. النسبة تبدأ من initial (4 أحرف ≈ رمز)
+    وتُعاير بمتوسط متحرك من promptTokenCount الذي يرجعه Gemini في usageMetadata لكل طلب
+    (نفس عدّاد countTokens، بدون طلب إضافي).
+    """
+
+    def __init__(self, initial=0.25, alpha=0.1, min_ratio=0.05, max_ratio=2.0):
+        self.tokens_per_char = initial
+        self.alpha = alpha
+        self.min_ratio = min_ratio
+        self.max_ratio = max_ratio
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def estimate(self, text):
+        return math.ceil(len(text) * self.tokens_per_char)
+
+    def estimate_contents(self, contents):
+        return math.ceil(contents_chars(contents) * self.tokens_per_char)
+
+    def calibrate(self, chars, actual_tokens):
+        """تحديث النسبة من طلب أُرسل فيه chars حرفاً وحسبه Gemini actual_tokens رمزاً."""
+        if not chars or not actual_tokens:
+            return
+        observed = min(self.max_ratio, max(self.min_ratio, actual_tokens / chars))
+        with self._lock:
+            # أول القياسات تأخذ وزناً أكبر حتى لا يبقى التقدير الأولي طويلاً
+            weight = max(self.alpha, 1.0 / (self.samples + 1))
+            self.tokens_per_char += weight * (observed - self.tokens_per_char)
+            self.samples += 1
+
+
+# ------------------------------------------------------------------------------
+#  ملخص المحاورات القديمة
+# ------------------------------------------------------------------------------
+def _first_sentence(text, max_chars):
+    text = " ".join(text.split())
+    for mark in (". ", "。", "؟ ", "! ", "\n"):
+        cut = text.find(mark)
+        if 0 < cut < max_chars:
+            return text[:cut + 1].strip()
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+
+def digest_lines(turns, question_chars=150, answer_chars=200):
+    """سطر مختصر لكل محاورة (سؤال المستخدم وبداية الرد) من رسائل user/model متتالية."""
+    lines = []
+    for i in range(0, len(turns) - 1, 2):
+        question = "".join(p.get("text", "") for p in turns[i].get("parts", []))
+        answer = "".join(p.get("text", "") for p in turns[i + 1].get("parts", []))
+        lines.append(f"- س: {_first_sentence(question, question_chars)} | ج: {_first_sentence(answer, answer_chars)}")
+    return lines
+
+
+def fold_digest(digest, turns, max_chars=1500):
+    """
+    إضافة المحاورات التي خرجت من السجل إلى الملخص المتراكم. إذا تجاوز max_chars تُحذف أقدم الأسطر
+    (الملخص نفسه يبقى بحجم ثابت مهما طالت المحادثة).
+    """
+    lines = [line for line in digest.split("\n") if line] + digest_lines(turns)
+    while lines and len("\n".join(lines)) > max_chars:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+# ------------------------------------------------------------------------------
+#  تجميع الطلب
+# ------------------------------------------------------------------------------
+class BuiltPrompt:
+    def __init__(self, contents, final_text, estimated_tokens, turns_sent, turns_digested, context_parts_dropped):
+        self.contents = contents                  # رسائل الطلب (السجل + السؤال)
+        self.final_text = final_text              # نص رسالة المستخدم الأخيرة
+        self.estimated_tokens = estimated_tokens
+        self.turns_sent = turns_sent              # رسائل السجل المرسلة كما هي
+        self.turns_digested = turns_digested      # رسائل السجل التي أُرسلت كأسطر في الملخص فقط
+        self.context_parts_dropped = context_parts_dropped
+
+
+class PromptBuilder:
+    """
+    يجمع الطلب ضمن budget رمز (تقديرياً) بالأولوية: تعليمات النص المرجعي والسؤال (دائماً)، ثم النص المرجعي
+    (مع حجز history_reserve رمز لآخر المحاورات)، ثم أحدث المحاورات كاملة، ثم ملخص المحاورات الأقدم
+    (حتى digest_tokens رمز). المحاورات التي لا تتسع كاملة تدخل الملخص بدلاً من أن تُحذف.
+    context نص واحد، أو أجزاء مرتبة حسب الصلة [(ترتيبها في الكتاب, النص), ...] (BookIndex.context_parts):
+    عندها يُحذف الأقل صلة أولاً، والباقي يُرسل بترتيب الكتاب.
+    """
+
+    def __init__(self, estimator, budget=6000, history_reserve=1000, digest_tokens=400):
+        self.estimator = estimator
+        self.budget = budget
+        self.history_reserve = history_reserve
+        self.digest_tokens = digest_tokens
+
+    @staticmethod
+    def question_text(prompt, context="", digest=""):
+        text = prompt
+        if context:
+            text = (
+                f"أجب على السؤال التالي بناءً على النص المرفق فقط. إذا كانت الإجابة غير موجودة، قل 'الإجابة غير متوفرة في المصدر'.\n\n"
+                f"--- النص المرجعي ---\n{context}\n--- نهاية النص المرجعي ---\n\n"
+                f"السؤال: {prompt}"
+            )
+        if digest:
+            text = f"ملخص ما سبق من المحادثة:\n{digest}\n\n{text}"
+        return text
+
+    def build(self, prompt, context="", history=(), digest=""):
+        estimate = self.estimator.estimate
+        history = list(history)
+        available = self.budget - estimate(self.question_text(prompt, "x" if context else ""))
+
+        # 1. النص المرجعي: تُحذف الأجزاء الأقل صلة (أو الأخيرة في النص الواحد) حتى يتسع (مع ترك مكان لآخر المحاورات)
+        if isinstance(context, str):
+            parts = list(enumerate(context.split(CONTEXT_SEPARATOR))) if context else []
+        else:
+            parts = list(context)
+        reserve = min(self.history_reserve, self.estimator.estimate_contents(history) + self.digest_tokens) if history or digest else 0
+        dropped = 0
+        while len(parts) > 1 and estimate(join_context(parts)) > available - reserve:
+            parts.pop()
+            dropped += 1
+        context = join_context(parts)
+        available -= estimate(context)
+
+        # 2. أحدث المحاورات كاملة (كل سؤال مع رده)، من الأحدث للأقدم
+        kept = len(history)
+        while kept >= 2:
+            pair_tokens = self.estimator.estimate_contents(history[kept - 2:kept])
+            if pair_tokens > available:
+                break
+            available -= pair_tokens
+            kept -= 2
+        recent, older = history[kept:], history[:kept]
+
+        # 3. الملخص: الملخص المتراكم + المحاورات التي لم تتسع، ضمن ما تبقى (بحد digest_tokens)
+        digest_budget = max(0, min(self.digest_tokens, available))
+        lines = [line for line in digest.split("\n") if line] + digest_lines(older)
+        while lines and estimate("\n".join(lines)) > digest_budget:
+            lines.pop(0)
+        final_text = self.question_text(prompt, context, "\n".join(lines))
+
+        contents = recent + [{"role": "user", "parts": [{"text": final_text}]}]
+        return BuiltPrompt(contents, final_text, self.estimator.estimate_contents(contents),
+                           len(recent), len(older), dropped)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  تحديد معدل الأسئلة (Token Buckets في الذاكرة لكل مستخدم/وضع/البوت كله)
+# ==============================================================================
+import os
+import json
+import math
+import time
+import atexit
+import threading
+
+
+class RateRule:
+    """
+    قاعدة تحديد معدل: limit طلب كل window ثانية، مع دفعة فورية burst (افتراضياً 1).
+    scope: "user" (دلو لكل مستخدم) أو "global" (دلو واحد للبوت كله).
+    modes: الأوضاع التي تُطبق عليها القاعدة (None = كل الأوضاع).
+    """
+
+    def __init__(self, name, limit, window, burst=1, scope="user", modes=None):
+        if limit <= 0 or window <= 0:
+            raise ValueError(f"قاعدة تحديد معدل غير صالحة: {name}")
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.rate = limit / window
+        self.capacity = float(max(1, burst))
+        self.scope = scope
+        self.modes = set(modes) if modes else None
+
+    @classmethod
+    def parse(cls, name, spec, scope="user", modes=None):
+        """
+        قراءة القاعدة من نص بالشكل "limit/window" أو "limit/window:burst" (مثال: "4/60:2").
+        النص الفارغ يعني أن القاعدة معطلة (يرجع None).
+        """
+        spec = (spec or "").strip()
+        if not spec:
+            return None
+        rate, _, burst = spec.partition(":")
+        limit, _, window = rate.partition("/")
+        return cls(name, float(limit), float(window or 1), int(burst or 1), scope=scope, modes=modes)
+
+    def share(self, parts):
+        """تقسيم القاعدة على parts عمليات (كل عامل يطبق نصيبه من الحد العام)."""
+        self.rate /= parts
+        self.capacity = max(1.0, self.capacity / parts)
+        return self
+
+    def describe(self):
+        """وصف القاعدة للمستخدم (مثال: "سؤال واحد كل 15 ثانية" أو "4 أسئلة كل دقيقة (حتى 2 متتالية)")."""
+        limit = f"{self.limit:g}"
+        count = "سؤال واحد" if limit == "1" else f"{limit} أسئلة"
+        if self.window == 60:
+            window = "دقيقة"
+        elif self.window > 60 and self.window % 60 == 0:
+            window = f"{self.window / 60:g} دقيقة"
+        else:
+            window = f"{self.window:g} ثانية"
+        text = f"{count} كل {window}"
+        if self.capacity > 1 and self.scope == "user":
+            text += f" (حتى {self.capacity:g} متتالية)"
+        return text
+
+    def applies_to(self, mode):
+        return self.modes is None or mode in self.modes
+
+    def bucket_key(self, user_id):
+        return self.name if self.scope == "global" else f"{self.name}|{user_id}"
+
+
+class RateLimiter:
+    """
+    كل القواعد المنطبقة على السؤال تُفحص وتُستهلك معاً تحت قفل واحد (check-and-consume ذري)،
+    فلا يمر سؤالان سريعان معاً، والرفض من قاعدة لا يستهلك من القواعد الأخرى.
+    الدلاء في الذاكرة بوقت حقيقي (time.time) وتُحفظ كل snapshot_interval ثانية في snapshot_path
+    حتى لا تُصفّر الحدود عند إعادة التشغيل. الدلو الممتلئ مساوٍ لعدم وجوده فيُحذف من الذاكرة.
+    """
+
+    def __init__(self, rules, snapshot_path=None, snapshot_interval=30):
+        self.rules = [rule for rule in rules if rule is not None]
+        self.snapshot_path = snapshot_path
+        self._buckets = {}  # bucket_key -> [الرموز, وقت آخر تحديث]
+        self._lock = threading.Lock()
+        self._changed = False
+        self.allowed = 0
+        self.rejected = {rule.name: 0 for rule in self.rules}
+        if snapshot_path:
+            self._load()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._snapshot_loop, args=(snapshot_interval,),
+                                            name="rate-limiter-snapshot", daemon=True)
+            self._thread.start()
+            atexit.register(self.save)
+
+    def _tokens(self, rule, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return rule.capacity
+        return min(rule.capacity, bucket[0] + (now - bucket[1]) * rule.rate)
+
+    def acquire(self, user_id, mode=None):
+        """
+        محاولة استهلاك طلب واحد من كل القواعد المنطبقة.
+        يرجع (True, 0, None) إذا سُمح بالطلب، أو (False, ثواني الانتظار, القاعدة الرافضة).
+        """
+        now = time.time()
+        with self._lock:
+            rules = [(rule, rule.bucket_key(user_id)) for rule in self.rules if rule.applies_to(mode)]
+            worst, worst_wait = None, 0.0
+            levels = []
+            for rule, key in rules:
+                tokens = self._tokens(rule, key, now)
+                levels.append(tokens)
+                if tokens < 1:
+                    wait = (1 - tokens) / rule.rate
+                    if wait > worst_wait:
+                        worst, worst_wait = rule, wait
+            if worst is not None:
+                self.rejected[worst.name] += 1
+                return False, worst_wait, worst
+            for (rule, key), tokens in zip(rules, levels):
+                self._buckets[key] = [tokens - 1, now]
+            self.allowed += 1
+            self._changed = True
+        return True, 0.0, None
+
+    @staticmethod
+    def wait_seconds(wait):
+        """ثواني الانتظار مقربة لأعلى لعرضها للمستخدم."""
+        return max(1, math.ceil(wait))
+
+    # --------------------------------------------------------------------------
+    #  الحفظ الدوري
+    # --------------------------------------------------------------------------
+    def _prune(self, now):
+        """حذف الدلاء التي امتلأت (لا فرق بينها وبين دلو جديد). يُستدعى والقفل محجوز."""
+        rules = {rule.name: rule for rule in self.rules}
+        for key, (tokens, updated) in list(self._buckets.items()):
+            rule = rules.get(key.split("|", 1)[0])
+            if rule is None or tokens + (now - updated) * rule.rate >= rule.capacity:
+                del self._buckets[key]
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._buckets = {key: list(bucket) for key, bucket in data.get("buckets", {}).items()}
+            self._prune(time.time())
+        print(f"تم تحميل {len(self._buckets)} دلو من حالة تحديد المعدل.")
+
+    def save(self):
+        """حفظ الدلاء غير الممتلئة (كتابة ذرية)."""
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            self._prune(time.time())
+            data = {"buckets": dict(self._buckets)}
+            self._changed = False
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _snapshot_loop(self, interval):
+        while not self._stop.wait(interval):
+            if self._changed:
+                try:
+                    self.save()
+                except Exception as e:
+                    print(f"فشل حفظ حالة تحديد المعدل: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buckets": len(self._buckets),
+                "allowed": self.allowed,
+                "rejected": dict(self.rejected),
+                "rules": [rule.name for rule in self.rules],
+            }
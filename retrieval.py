@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  فهرس استرجاع للكتب (BM25) مع تطبيع النص العربي
+# ==============================================================================
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+
+PAGE_SEPARATOR = "\f"  # يفصل بين الصفحات في النص المستخرج من PDF
+
+# التشكيل والتطويل
+_DIACRITICS = re.compile(r'[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')
+_ALEF = re.compile(r'[\u0622\u0623\u0625\u0671]')  # آ أ إ ٱ
+_TOKEN = re.compile(r'\w+')
+# سوابق شائعة تلتصق بالكلمة (و، ف، ب، ك، ل، ال) تُحذف بشرط أن يبقى جذر كافٍ
+# (3 أحرف بعد "ال" ومشتقاتها، و4 أحرف بعد الحرف المنفرد حتى لا تتحول "فهرس" إلى "هرس")
+PREFIXES = ("وبال", "وال", "فال", "بال", "كال", "لل", "ال", "و", "ف", "ب")
+STOP_WORDS = {
+    "في", "من", "علي", "الي", "عن", "ان", "او", "ما", "هل", "هو", "هي", "هذا", "هذه", "ذلك", "التي", "الذي",
+    "مع", "كان", "لا", "ثم", "كل", "بين", "قد", "و", "يا", "the", "of", "and", "to", "in", "is", "a", "what",
+}
+
+
+def normalize_arabic(text):
+    """تطبيع النص العربي: حذف التشكيل والتطويل، توحيد الألف، والياء/الألف المقصورة، والتاء المربوطة."""
+    text = _DIACRITICS.sub('', text)
+    text = _ALEF.sub('ا', text)
+    text = text.replace('ى', 'ي').replace('ة', 'ه')
+    return text.lower()
+
+
+def strip_prefix(token):
+    """تجذيع خفيف: حذف السابقة الأطول المطابقة مثل (وال، بال، و) من بداية الكلمة."""
+    for prefix in PREFIXES:
+        min_stem = 4 if len(prefix) == 1 else 3
+        if token.startswith(prefix) and len(token) - len(prefix) >= min_stem:
+            return token[len(prefix):]
+    return token
+
+
+def tokenize(text):
+    """تقسيم النص إلى كلمات مطبّعة مع حذف الكلمات الشائعة جداً والحروف المنفردة."""
+    tokens = []
+    for token in _TOKEN.findall(normalize_arabic(text)):
+        if len(token) > 1 and token not in STOP_WORDS:
+            tokens.append(strip_prefix(token))
+    return tokens
+
+
+class BookIndex:
+    """
+    فهرس BM25 لكتاب واحد. الكتاب يُقسم إلى أجزاء متداخلة مع حفظ أرقام الصفحات،
+    والفهرس يحفظ فقط مواضع الأجزاء في النص (وليس النص نفسه) لتقليل حجمه.
+    """
+
+    def __init__(self, version, chunks, postings, doc_lengths):
+        self.version = version
+        self.chunks = chunks            # [[start, end, page_start, page_end], ...]
+        self.postings = postings        # term -> [[chunk_idx, tf], ...]
+        self.doc_lengths = doc_lengths
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+
+    # --------------------------------------------------------------------------
+    #  البناء
+    # --------------------------------------------------------------------------
+    @classmethod
+    def build(cls, text, version=None, chunk_size=1500, overlap=200):
+        chunks = split_into_chunks(text, chunk_size, overlap)
+        postings = defaultdict(list)
+        doc_lengths = []
+        for idx, (start, end, _, _) in enumerate(chunks):
+            terms = Counter(tokenize(text[start:end]))
+            doc_lengths.append(sum(terms.values()))
+            for term, tf in terms.items():
+                postings[term].append([idx, tf])
+        return cls(version, chunks, dict(postings), doc_lengths)
+
+    # --------------------------------------------------------------------------
+    #  البحث
+    # --------------------------------------------------------------------------
+    def search(self, query, top_k=8, k1=1.5, b=0.75):
+        """إرجاع أفضل الأجزاء كقائمة (chunk_idx, score) مرتبة تنازلياً."""
+        n_docs = len(self.chunks)
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for idx, tf in postings:
+                norm = k1 * (1 - b + b * self.doc_lengths[idx] / (self.avg_length or 1))
+                scores[idx] += idf * tf * (k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    def context_parts(self, text, query, top_k=8, char_budget=12000):
+        """
+        أفضل الأجزاء ضمن char_budget حرف كقائمة [(رقم الجزء, نصه), ...] مرتبة حسب الصلة بالسؤال (الأفضل أولاً)،
+        حتى يحذف PromptBuilder الأقل صلة إذا لم تتسع الميزانية. رقم الجزء يعطي ترتيبه في الكتاب.
+        إذا لم يطابق السؤال أي جزء، نرسل بداية الكتاب (مفيد لأسئلة مثل الفهرس).
+        """
+        hits = [idx for idx, _ in self.search(query, top_k)] or list(range(len(self.chunks)))
+        parts, used = [], 0
+        for idx in hits:
+            start, end, page_start, page_end = self.chunks[idx]
+            if used + (end - start) > char_budget:
+                continue
+            used += end - start
+            pages = f"صفحة {page_start}" if page_start == page_end else f"صفحات {page_start}-{page_end}"
+            parts.append((idx, f"[{pages}]\n{text[start:end].replace(PAGE_SEPARATOR, chr(10)).strip()}"))
+        return parts
+
+    def build_context(self, text, query, top_k=8, char_budget=12000):
+        """تجميع نص مرجعي لا يتجاوز char_budget حرف من أفضل الأجزاء، مرتبة حسب موقعها في الكتاب."""
+        return "\n\n---\n\n".join(part for _, part in sorted(self.context_parts(text, query, top_k, char_budget)))
+
+    # --------------------------------------------------------------------------
+    #  الحفظ والتحميل
+    # --------------------------------------------------------------------------
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"version": self.version, "chunks": self.chunks, "postings": self.postings,
+                       "doc_lengths": self.doc_lengths}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """تحميل فهرس محفوظ، أو None إذا لم يكن موجوداً أو كان تالفاً."""
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data["version"], data["chunks"], data["postings"], data["doc_lengths"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def split_into_chunks(text, chunk_size=1500, overlap=200):
+    """
+    تقسيم النص إلى أجزاء متداخلة بحجم تقريبي chunk_size، مع القطع عند نهاية سطر أو فقرة قدر الإمكان.
+    يرجع [[start, end, page_start, page_end], ...] حيث أرقام الصفحات تبدأ من 1.
+    """
+    page_starts = [0] + [m.end() for m in re.finditer(PAGE_SEPARATOR, text)]
+
+    def page_of(offset):
+        lo, hi = 0, len(page_starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if page_starts[mid] <= offset:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo + 1
+
+    chunks, start, length = [], 0, len(text)
+    while start < length:
+        end = min(start + chunk_size, length)
+        if end < length:
+            # نفضل القطع عند فاصل صفحة أو سطر في النصف الثاني من الجزء
+            cut = max(text.rfind(PAGE_SEPARATOR, start + chunk_size // 2, end), text.rfind('\n', start + chunk_size // 2, end))
+            if cut > start:
+                end = cut + 1
+        if text[start:end].strip():
+            chunks.append([start, end, page_of(start), page_of(max(start, end - 1))])
+        if end >= length:
+            break
+        # الجزء التالي يبدأ قبل نهاية الحالي بمقدار overlap، من بداية سطر حتى لا نقطع كلمة
+        next_start = max(end - overlap, start + 1)
+        line_start = text.find('\n', next_start, end)
+        start = line_start + 1 if line_start != -1 else next_start
+    return chunks
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  طابور إرسال رسائل تليجرام (حد عام + حد لكل محادثة + احترام retry_after)
+# ==============================================================================
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from key_pool import TokenBucket
+
+INTERACTIVE = 0  # ردود مباشرة على المستخدم
+BULK = 1         # رسائل غير عاجلة (تقدم التجهيز، الإذاعات...)
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "priority", "paced", "seq", "future", "attempts", "submitted_at")
+
+    def __init__(self, fn, args, kwargs, priority, paced, seq):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.paced = paced
+        self.seq = seq
+        self.future = Future()
+        self.attempts = 0
+        self.submitted_at = time.monotonic()
+
+
+def _retry_after(error):
+    """مدة الانتظار من خطأ 429 لتليجرام (ApiTelegramException)، أو None إذا لم يكن 429."""
+    if getattr(error, "error_code", None) != 429:
+        return None
+    result = getattr(error, "result_json", None) or {}
+    return float(result.get("parameters", {}).get("retry_after", 1))
+
+
+class TelegramSendQueue:
+    """
+    كل طلبات الإرسال/التعديل/الحذف تمر من هنا:
+    - حد عام global_rate رسالة في الثانية (حد تليجرام ~30).
+    - حد لكل محادثة: رسالة كل per_chat_interval ثانية، والرسائل داخل نفس المحادثة تُرسل بالترتيب.
+    - خطأ 429 يعيد الرسالة لأول طابور المحادثة ويوقفها retry_after ثانية (حتى max_retries مرات).
+    - المحادثة التي أول رسالة فيها INTERACTIVE تسبق المحادثات التي أول رسالة فيها BULK.
+    - الطلبات غير المحسوبة (paced=False، مثل حذف رسالة) تحافظ على الترتيب لكن لا تستهلك من الحدين.
+    submit ترجع Future فوراً، والإرسال يتم في الخلفية على workers خيوط.
+    observer اختياري: observer(اسم الدالة, ثواني الانتظار في الطابور, ثواني الإرسال, النتيجة "ok"/"429"/"error")
+    يُستدعى بعد كل محاولة (للمقاييس).
+    """
+
+    def __init__(self, global_rate=30, per_chat_interval=1.0, workers=8, max_retries=3, observer=None):
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.observer = observer
+        self._bucket = TokenBucket(global_rate, window=1.0, burst_ratio=0.1)
+        self._chats = {}          # chat_id -> deque[_Job]
+        self._next_allowed = {}   # chat_id -> أقرب وقت لإرسال رسالة في المحادثة
+        self._blocked_until = {}  # chat_id -> نهاية Flood wait (retry_after) للمحادثة
+        self._busy = set()        # محادثات لها رسالة قيد الإرسال الآن
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="telegram-send")
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.queued_peak = 0
+        self._thread = threading.Thread(target=self._dispatch_loop, name="telegram-send-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, chat_id, fn, *args, priority=INTERACTIVE, paced=True, **kwargs):
+        """جدولة fn(*args, **kwargs) ضمن حدود المحادثة chat_id. يرجع concurrent.futures.Future."""
+        chat_id = str(chat_id)
+        with self._cond:
+            self._seq += 1
+            job = _Job(fn, args, kwargs, priority, paced, self._seq)
+            self._chats.setdefault(chat_id, deque()).append(job)
+            self.queued_peak = max(self.queued_peak, self._queued())
+            self._cond.notify()
+        return job.future
+
+    def _queued(self):
+        return sum(len(q) for q in self._chats.values())
+
+    def _pick(self, now):
+        """يُستدعى والقفل محجوز: (المحادثة الجاهزة الأولى بالإرسال, None) أو (None, ثواني حتى تجهز محادثة)."""
+        best, best_rank, wait = None, None, None
+        for chat_id, queue in self._chats.items():
+            if chat_id in self._busy or not queue:
+                continue
+            delay = self._blocked_until.get(chat_id, 0.0) - now
+            if queue[0].paced:
+                delay = max(delay, self._next_allowed.get(chat_id, 0.0) - now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            rank = (queue[0].priority, queue[0].seq)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = chat_id, rank
+        return best, wait
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    chat_id, wait = self._pick(now)
+                    if chat_id is not None:
+                        if not self._chats[chat_id][0].paced:
+                            break
+                        self._bucket.refill(now)
+                        wait = self._bucket.time_until(1)
+                        if wait <= 0:
+                            break
+                    self._cond.wait(wait)
+                job = self._chats[chat_id].popleft()
+                self._busy.add(chat_id)
+                if job.paced:
+                    self._bucket.consume(1)
+                    self._next_allowed[chat_id] = now + self.per_chat_interval
+            self._pool.submit(self._execute, chat_id, job)
+
+    def _execute(self, chat_id, job):
+        retry_after = None
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            retry_after = _retry_after(e)
+            outcome = "error" if retry_after is None else "429"
+            job.attempts += 1
+            if retry_after is None or job.attempts > self.max_retries:
+                with self._cond:
+                    self.failed += 1
+                job.future.set_exception(e)
+        else:
+            with self._cond:
+                self.sent += 1
+            job.future.set_result(result)
+        finally:
+            if self.observer:
+                self.observer(getattr(job.fn, "__name__", "call"), started - job.submitted_at, time.monotonic() - started, outcome)
+            with self._cond:
+                self._busy.discard(chat_id)
+                queue = self._chats.get(chat_id)
+                if retry_after is not None and not job.future.done():
+                    # Flood wait: نفس الرسالة تعود لأول الطابور والمحادثة تتوقف المدة المطلوبة
+                    self.rate_limited += 1
+                    self._blocked_until[chat_id] = time.monotonic() + retry_after
+                    queue.appendleft(job)
+                    print(f"⚠️ تليجرام طلب الانتظار {retry_after} ثانية للمحادثة {chat_id} (429).")
+                elif not queue:
+                    # تنظيف المحادثات المنتهية حتى لا تكبر القواميس مع عدد المستخدمين
+                    now = time.monotonic()
+                    self._chats.pop(chat_id, None)
+                    if self._next_allowed.get(chat_id, 0.0) <= now:
+                        self._next_allowed.pop(chat_id, None)
+                    if self._blocked_until.get(chat_id, 0.0) <= now:
+                        self._blocked_until.pop(chat_id, None)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self._queued(),
+                "chats": len(self._chats),
+                "in_flight": len(self._busy),
+                "sent": self.sent,
+                "failed": self.failed,
+                "rate_limited": self.rate_limited,
+                "queued_peak": self.queued_peak,
+            }
+
+
+def _log_failure(chat_id, fn, future):
+    """لا أحد ينتظر نتيجة الطلبات المرسلة بـ wait=False، فتُطبع أخطاؤها هنا حتى لا تضيع."""
+    error = future.exception()
+    if error is not None and "message is not modified" not in str(error):
+        print(f"فشل {fn.__name__} للمحادثة {chat_id}: {error}")
+
+
+class QueuedSender:
+    """
+    نفس واجهة bot لإرسال/تعديل/حذف الرسائل، لكن عبر TelegramSendQueue.
+    wait=True (الافتراضي) تنتظر النتيجة وترفع نفس أخطاء bot؛ wait=False ترجع Future فوراً.
+    """
+
+    def __init__(self, bot, queue):
+        self.bot = bot
+        self.queue = queue
+
+    def _call(self, chat_id, fn, args, kwargs, wait, priority, paced=True):
+        future = self.queue.submit(chat_id, fn, *args, priority=priority, paced=paced, **kwargs)
+        if wait:
+            return future.result()
+        future.add_done_callback(lambda f: _log_failure(chat_id, fn, f))
+        return future
+
+    def send_message(self, chat_id, text, wait=True, priority=INTERACTIVE, **kwargs):
+        return self._call(chat_id, self.bot.send_message, (chat_id, text), kwargs, wait, priority)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, wait=True, priority=INTERACTIVE, **kwargs):
+        return self._call(chat_id, self.bot.edit_message_text, (text, chat_id, message_id), kwargs, wait, priority)
+
+    def delete_message(self, chat_id, message_id, wait=True, priority=INTERACTIVE, **kwargs):
+        # الحذف لا يُحسب ضمن حدود الإرسال، لكنه يمر بالطابور ليبقى بترتيبه مع رسائل المحادثة
+        return self._call(chat_id, self.bot.delete_message, (chat_id, message_id), kwargs, wait, priority, paced=False)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  Single-Flight: تنفيذ عملية مكلفة مرة واحدة لكل مفتاح ومشاركة نتيجتها
+# ==============================================================================
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """انتهت مهلة انتظار عملية يقوم بها طلب آخر."""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    إذا طُلبت نفس العملية (نفس المفتاح) من عدة خيوط في نفس الوقت، ينفذها الخيط الأول فقط
+    وينتظر الباقون نتيجته (أو الاستثناء الذي حدث) بدلاً من تكرار العمل.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0       # عدد مرات التنفيذ الفعلي
+        self.deduplicated = 0   # عدد الطلبات التي شاركت نتيجة تنفيذ جارٍ بدلاً من تكراره
+        self.failed = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        """تنفيذ fn() أو انتظار التنفيذ الجاري لنفس المفتاح (حتى timeout ثانية للمنتظرين)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            if not call.done.wait(timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise SingleFlightTimeout(f"انتهت مهلة انتظار العملية الجارية للمفتاح {key}.")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "deduplicated": self.deduplicated,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+            }
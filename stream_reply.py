@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  عرض رد Gemini تدريجياً في تليجرام (تعديل الرسالة أثناء وصول النص)
+# ==============================================================================
+import time
+import asyncio
+
+MAX_MESSAGE_LENGTH = 4096  # الحد الأقصى لطول رسالة تليجرام
+
+
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    """
+    تقسيم النص لأجزاء لا يتجاوز كل منها max_length، عند آخر سطر جديد إن وجد.
+    تقسيم بداية النص لا يتغير عندما يطول النص، لذلك يصلح لتقسيم رد يصل تدريجياً.
+    """
+    parts = []
+    while len(text) > max_length:
+        part = text[:max_length]
+        last_newline = part.rfind('\n')
+        if last_newline != -1:
+            parts.append(text[:last_newline])
+            text = text[last_newline + 1:]
+        else:
+            parts.append(part)
+            text = text[max_length:]
+    parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """
+    رد يُكتب تدريجياً: update(النص حتى الآن) تعدل رسالة "جارِ المعالجة" بحد أقصى مرة كل edit_interval ثانية
+    (حدود تليجرام لتعديل الرسائل)، وعند تجاوز 4096 حرفاً يُثبت الجزء الأول وتبدأ رسالة جديدة.
+    أثناء الكتابة تُرسل الأجزاء كنص عادي (Markdown غير مكتمل يسبب خطأ 400)، و finish() تعيد
+    تنسيق كل الأجزاء بـ parse_mode. first_visible_after: زمن ظهور أول نص للمستخدم (بالثواني).
+    التعديلات تُرسل بـ wait=False في مهمة منفصلة تنتظر Future الطابور (asyncio.wrap_future)، و update لا تنتظرها:
+    قراءة رد Gemini لا تتوقف على تليجرام، ولا يُحجز خيط من executor الافتراضي لكل تعديل. إذا وصل نص جديد
+    أثناء تعديل جارٍ يُعرض أحدثه فقط بعد انتهائه (النصوص الوسيطة تُتجاوز).
+    """
+
+    def __init__(self, bot, chat_id, message_id, edit_interval=1.5, parse_mode="Markdown", started_at=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_ids = [message_id]
+        self.edit_interval = edit_interval
+        self.parse_mode = parse_mode
+        self.started_at = started_at or time.monotonic()
+        self.first_visible_after = None
+        self._shown = [None]  # النص المعروض حالياً في كل رسالة
+        self._last_edit = 0.0
+        self._latest = None  # أحدث نص وصل من update
+        self._task = None    # مهمة عرض التعديلات (_drain)
+
+    async def _show(self, index, text, parse_mode=None):
+        """عرض النص في الرسالة رقم index (إرسالها إن لم تكن موجودة). يرجع True إذا نجح."""
+        if not text.strip():
+            return False
+        if index < len(self.message_ids) and self._shown[index] == text and parse_mode is None:
+            return True
+        try:
+            if index < len(self.message_ids):
+                await asyncio.wrap_future(self.bot.edit_message_text(text, self.chat_id, self.message_ids[index],
+                                                                     wait=False, parse_mode=parse_mode))
+            else:
+                message = await asyncio.wrap_future(self.bot.send_message(self.chat_id, text, wait=False, parse_mode=parse_mode))
+                self.message_ids.append(message.message_id)
+                self._shown.append(None)
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return True
+            if parse_mode is not None:  # تنسيق Markdown غير صالح: عرض النص كما هو
+                return await self._show(index, text)
+            print(f"فشل تحديث الرد التدريجي: {e}")
+            return False
+        self._shown[index] = text
+        if self.first_visible_after is None:
+            self.first_visible_after = time.monotonic() - self.started_at
+        return True
+
+    def _due(self, text):
+        """هل يُعرض text الآن؟ (مرت edit_interval منذ آخر تعديل، أو امتلأت الرسالة الحالية)."""
+        return (time.monotonic() - self._last_edit >= self.edit_interval
+                or len(split_message(text)) > len(self.message_ids))
+
+    async def update(self, text):
+        """النص الكامل حتى الآن. لا تنتظر تليجرام: تبدأ مهمة العرض عند الحاجة أو تترك لها أحدث نص."""
+        self._latest = text
+        if (self._task is None or self._task.done()) and self._due(text):
+            self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        """عرض أحدث نص: الأجزاء المكتملة تُثبت، والجزء الأخير يُعدل. يتكرر ما دام نص أحدث قد حان عرضه."""
+        while True:
+            text = self._latest
+            self._last_edit = time.monotonic()
+            parts = split_message(text)
+            for index, part in enumerate(parts[:-1]):
+                if self._shown[index] != part:
+                    await self._show(index, part)
+            await self._show(len(parts) - 1, parts[-1])
+            if self._latest == text or not self._due(self._latest):
+                return
+
+    async def finish(self, text):
+        """عرض النص النهائي بتنسيقه في كل الرسائل."""
+        if self._task is not None:
+            await self._task  # آخر تعديل جارٍ ينتهي قبل التنسيق النهائي (حتى لا يصل بعده)
+        parts = [part for part in split_message(text) if part.strip()] or [text]
+        for index, part in enumerate(parts):
+            await self._show(index, part, parse_mode=self.parse_mode)
+        # إذا قصر النص النهائي عن المعروض (نادر)، تُحذف الرسائل الزائدة
+        for message_id in self.message_ids[len(parts):]:
+            try:
+                await asyncio.wrap_future(self.bot.delete_message(self.chat_id, message_id, wait=False))
+            except Exception as e:
+                print(f"فشل حذف رسالة زائدة: {e}")
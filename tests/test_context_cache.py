@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+شرط كلفة كاش السياق (ContextCacheManager.cheaper_than_retrieval) وحد API الأدنى.
+
+التشغيل:
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_cache import ContextCacheManager
+from prompt_builder import TokenEstimator
+
+
+def no_session():
+    raise AssertionError("لا يجب أن يُرفع الكتاب إلى Gemini")
+
+
+def manager(**kwargs):
+    return ContextCacheManager("http://gemini.invalid", "gemini-1.5-flash-001", no_session, **kwargs)
+
+
+class CostGateTest(unittest.TestCase):
+    def test_default_budget_keeps_retrieval(self):
+        # أقل كاش مقبول (32768 رمزاً × 0.25 لكل سؤال) أغلى من 12000 حرف (3000 رمز) مع كل سؤال
+        cache = manager()
+        self.assertFalse(cache.cheaper_than_retrieval(4 * 32768))
+        self.assertFalse(cache.cheaper_than_retrieval(2_000_000))
+
+    def test_large_retrieval_budget_caches(self):
+        # 35000 رمز × (1 + 10 × 0.25 + 13.3 × 0.25) = 238875 < 10 أسئلة × 50000 رمز
+        cache = manager(retrieval_chars=200_000)
+        self.assertTrue(cache.cheaper_than_retrieval(140_000))
+        self.assertFalse(manager(retrieval_chars=200_000, expected_questions=1).cheaper_than_retrieval(140_000))
+
+    def test_storage_cost_counts(self):
+        # 35000 رمز × (1 + 2 × 0.25 + 13.3 × ساعات التخزين) مقابل سؤالين × 100000 رمز
+        cheap = manager(retrieval_chars=400_000, expected_questions=2)
+        self.assertTrue(cheap.cheaper_than_retrieval(140_000))
+        self.assertFalse(manager(retrieval_chars=400_000, expected_questions=2, idle_timeout=4 * 3600)
+                         .cheaper_than_retrieval(140_000))
+
+    def test_no_retrieval_budget_always_caches(self):
+        self.assertTrue(manager(retrieval_chars=None).cheaper_than_retrieval(10 ** 8))
+
+    def test_tokens_follow_estimator(self):
+        estimator = TokenEstimator(initial=0.5)
+        self.assertEqual(manager(estimator=estimator).tokens(1000), 500)
+        self.assertEqual(manager().tokens(1000), 250)
+
+
+class GetTest(unittest.TestCase):
+    def test_small_book_is_not_uploaded(self):
+        cache = manager(retrieval_chars=None)
+        name = asyncio.run(cache.get("key", "book", "v1", lambda: "نص " * 1000))
+        self.assertIsNone(name)
+        self.assertEqual((cache.too_small, cache.failed), (1, 0))
+
+    def test_costly_book_is_not_uploaded(self):
+        cache = manager()
+        name = asyncio.run(cache.get("key", "book", "v1", lambda: "نص " * 100_000))
+        self.assertIsNone(name)
+        self.assertEqual((cache.too_costly, cache.failed), (1, 0))
+        # لا يُعاد التحقق (ولا تحميل النص) حتى failure_ttl
+        self.assertIsNone(asyncio.run(cache.get("key", "book", "v1", no_session)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  كاش محدود الحجم (LRU) مع مدة صلاحية (TTL) لكل عنصر
+# ==============================================================================
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    كاش آمن للاستخدام من عدة خيوط، لكل عنصر مدة صلاحية خاصة به.
+    عند امتلاء الكاش يتم إخراج العنصر الأقدم استخداماً (LRU).
+    """
+
+    def __init__(self, maxsize=10000, default_ttl=300):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """إرجاع (True, القيمة) إذا كان العنصر موجوداً وصالحاً، وإلا (False, None)."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        """تخزين قيمة مع مدة صلاحية (بالثواني)."""
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """حذف عنصر من الكاش لإجبار إعادة جلبه."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        """العناصر الصالحة كقائمة (المفتاح, الصلاحية المتبقية بالثواني, القيمة) من الأقدم للأحدث استخداماً."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, expires_at - now, value) for key, (expires_at, value) in self._data.items() if expires_at > now]
+
+    def stats(self):
+        """إحصائيات الكاش لضبط مدد الصلاحية."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  مخزن حالة المستخدمين (SQLite بوضع WAL + كاش كتابة مؤجلة في الذاكرة)
+# ==============================================================================
+import os
+import json
+import time
+import copy
+import sqlite3
+import atexit
+import threading
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    chat_id    TEXT PRIMARY KEY,
+    state      TEXT,
+    data       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_history (
+    chat_id TEXT NOT NULL,
+    seq     INTEGER NOT NULL,
+    role    TEXT NOT NULL,
+    parts   TEXT NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UserStore:
+    """
+    مستودع بيانات المستخدمين: قراءة وكتابة لكل مستخدم على حدة بدلاً من إعادة كتابة users.json بالكامل.
+    يحتفظ بالمستخدمين النشطين في كاش LRU، والتعديلات تُكتب للقاعدة على دفعات بواسطة خيط خلفي.
+    """
+
+    def __init__(self, db_path="users.db", cache_size=2048, flush_interval=2.0, legacy_json_path="users.json"):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()  # chat_id -> dict
+        self._dirty = {}  # chat_id -> رقم آخر نسخة لم تُحفظ بعد
+        self._version = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # كاتب واحد فقط للقاعدة في نفس اللحظة
+        self._local = threading.local()
+        self._stop = threading.Event()
+
+        self._connection().executescript(SCHEMA)
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="user-store-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    # --------------------------------------------------------------------------
+    #  الاتصال بالقاعدة (اتصال لكل خيط)
+    # --------------------------------------------------------------------------
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _connect(self, write=False):
+        return _Transaction(self._connection(), write)
+
+    # --------------------------------------------------------------------------
+    #  الواجهة العامة
+    # --------------------------------------------------------------------------
+    def get(self, chat_id):
+        """إرجاع نسخة من بيانات المستخدم، أو None إذا لم يكن مسجلاً."""
+        chat_id = str(chat_id)
+        with self._lock:
+            if chat_id in self._cache:
+                self._cache.move_to_end(chat_id)
+                return copy.deepcopy(self._cache[chat_id])
+
+        user_data = self._read_from_db(chat_id)
+        if user_data is None:
+            return None
+
+        with self._lock:
+            # قد يكون خيط آخر قد حفظ نسخة أحدث أثناء القراءة من القاعدة
+            if chat_id not in self._cache:
+                self._cache[chat_id] = user_data
+                self._evict_if_needed()
+            self._cache.move_to_end(chat_id)
+            return copy.deepcopy(self._cache[chat_id])
+
+    def exists(self, chat_id):
+        """هل المستخدم مسجل؟"""
+        return self.get(chat_id) is not None
+
+    def save(self, chat_id, user_data):
+        """تحديث بيانات المستخدم في الكاش، وتُكتب للقاعدة لاحقاً بواسطة الخيط الخلفي."""
+        chat_id = str(chat_id)
+        with self._lock:
+            self._cache[chat_id] = copy.deepcopy(user_data)
+            self._cache.move_to_end(chat_id)
+            self._version += 1
+            self._dirty[chat_id] = self._version
+            self._evict_if_needed()
+
+    def count(self):
+        """عدد المستخدمين المسجلين."""
+        self.flush()
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def flush(self):
+        """كتابة جميع التعديلات المعلقة إلى القاعدة في معاملة واحدة."""
+        with self._lock:
+            if not self._dirty:
+                return
+            versions = dict(self._dirty)
+            pending = {chat_id: copy.deepcopy(self._cache[chat_id]) for chat_id in versions}
+        try:
+            self._write_to_db(pending)
+        except Exception as e:
+            print(f"❌ خطأ في حفظ بيانات المستخدمين في القاعدة: {e}")
+            return
+        with self._lock:
+            # لا نعتبر المستخدم محفوظاً إذا تم تعديله مرة أخرى أثناء الكتابة
+            for chat_id, version in versions.items():
+                if self._dirty.get(chat_id) == version:
+                    del self._dirty[chat_id]
+
+    def close(self):
+        """إيقاف الخيط الخلفي وحفظ أي بيانات معلقة."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.flush()
+
+    # --------------------------------------------------------------------------
+    #  الترحيل من users.json (مرة واحدة فقط)
+    # --------------------------------------------------------------------------
+    def migrate_from_json(self, json_path):
+        """نقل بيانات users.json القديمة إلى القاعدة إذا لم يتم ذلك من قبل."""
+        with self._connect() as conn:
+            done = conn.execute("SELECT value FROM meta WHERE key = 'migrated_from_json'").fetchone()
+        if done or not os.path.exists(json_path):
+            return
+
+        try:
+            with open(json_path, "r", encoding='utf-8') as f:
+                legacy_users = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"تحذير: تعذر قراءة {json_path} للترحيل: {e}")
+            return
+
+        self._write_to_db({str(chat_id): data for chat_id, data in legacy_users.items()})
+        with self._connect(write=True) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                (time.strftime('%Y-%m-%d %H:%M:%S'),)
+            )
+        print(f"✅ تم ترحيل {len(legacy_users)} مستخدم من {json_path} إلى {self.db_path}.")
+
+    # --------------------------------------------------------------------------
+    #  دوال داخلية
+    # --------------------------------------------------------------------------
+    def _evict_if_needed(self):
+        """إخراج أقدم المستخدمين من الكاش (يُستدعى والقفل محجوز). المستخدم المعدّل لا يُخرج قبل حفظه."""
+        if len(self._cache) <= self.cache_size:
+            return
+        for chat_id in list(self._cache.keys()):
+            if len(self._cache) <= self.cache_size:
+                break
+            if chat_id not in self._dirty:
+                del self._cache[chat_id]
+
+    def _read_from_db(self, chat_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            history_rows = conn.execute(
+                "SELECT role, parts FROM chat_history WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            ).fetchall()
+        user_data = json.loads(row[0])
+        user_data["chat_history"] = [{"role": role, "parts": json.loads(parts)} for role, parts in history_rows]
+        return user_data
+
+    def _write_to_db(self, users):
+        if not users:
+            return
+        now = time.time()
+        with self._write_lock, self._connect(write=True) as conn:
+            for chat_id, user_data in users.items():
+                data = dict(user_data)
+                history = data.pop("chat_history", None) or []
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (chat_id, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, data.get("state"), json.dumps(data, ensure_ascii=False), now)
+                )
+                conn.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
+                conn.executemany(
+                    "INSERT INTO chat_history (chat_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+                    [(chat_id, seq, turn.get("role", "user"), json.dumps(turn.get("parts", []), ensure_ascii=False))
+                     for seq, turn in enumerate(history)]
+                )
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+class _Transaction:
+    """مدير سياق بسيط لتنفيذ مجموعة أوامر داخل معاملة واحدة."""
+
+    def __init__(self, conn, write):
+        self.conn = conn
+        self.write = write
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE" if self.write else "BEGIN")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
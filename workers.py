@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+#  التشغيل على عدة عمليات: عملية أمامية توزع التحديثات على عمال حسب chat_id
+# ==============================================================================
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+WORKER_UPDATE_PATH = "/update"
+
+
+def update_chat_id(update):
+    """المحادثة التي يخصها التحديث (رسالة، callback، chat_member...)، أو None إذا لم توجد."""
+    member = (update.get("chat_member") or {}).get("new_chat_member")
+    if member:
+        # تغير الاشتراك في القناة يحدث كاش الاشتراك للمستخدم نفسه، فيذهب لعامل المستخدم وليس القناة
+        return member["user"]["id"]
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+    return None
+
+
+def shard_for(chat_id, count):
+    """رقم العامل المسؤول عن المحادثة (ثابت طالما لم يتغير عدد العمال)."""
+    if chat_id is None:
+        return 0
+    return int(chat_id) % count
+
+
+# ==============================================================================
+#  مفاتيح Gemini المشتركة (KeyPool واحد في العملية الأمامية، والعمال يحجزون منه)
+# ==============================================================================
+class KeyPoolService:
+    """
+    غلاف KeyPool يُعرض للعمال عبر multiprocessing.managers: الحجز يرجع بيانات بسيطة قابلة للنقل
+    (رقم الحجز، المفتاح، الرموز المقدرة، اسم المفتاح) بدلاً من كائن KeyLease نفسه.
+    الحجوزات التي لا تُعاد خلال lease_ttl ثانية (عامل توقف أثناء الطلب) تُحرر تلقائياً.
+    """
+
+    def __init__(self, pool, lease_ttl=600):
+        self.pool = pool
+        self.lease_ttl = lease_ttl
+        self._leases = {}  # رقم الحجز -> KeyLease
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens=1000, timeout=None):
+        self._reap()
+        return self._register(self.pool.acquire(estimated_tokens=estimated_tokens, timeout=timeout))
+
+    def try_acquire(self, estimated_tokens=1000, exclude=()):
+        lease = self.pool.try_acquire(estimated_tokens, exclude)
+        return self._register(lease) if lease is not None else None
+
+    def _register(self, lease):
+        with self._lock:
+            self._next_id += 1
+            self._leases[self._next_id] = lease
+            return self._next_id, lease.key, lease.estimated_tokens, lease.label
+
+    def release(self, lease_id, status_code=None, failed=False, tokens_used=None, retry_after=None):
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+        if lease is not None:
+            self.pool.release(lease, status_code=status_code, failed=failed, tokens_used=tokens_used,
+                              retry_after=retry_after)
+
+    def stats(self, window=300):
+        return self.pool.stats(window)
+
+    def _reap(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [lease_id for lease_id, lease in self._leases.items() if now - lease.started > self.lease_ttl]
+            leases = [self._leases.pop(lease_id) for lease_id in expired]
+        for lease in leases:
+            self.pool.release(lease, failed=True)
+
+
+class _KeyPoolServer(BaseManager):
+    pass
+
+
+class _KeyPoolClient(BaseManager):
+    pass
+
+
+def serve_key_pool(pool, authkey, address=("127.0.0.1", 0)):
+    """تشغيل خادم KeyPoolService محلي في خيط خلفي. يرجع العنوان (host, port) الذي يتصل به العمال."""
+    service = KeyPoolService(pool)
+    _KeyPoolServer.register("key_pool", callable=lambda: service)
+    server = _KeyPoolServer(address=address, authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name="key-pool-server", daemon=True).start()
+    return server.address
+
+
+class RemoteKeyLease:
+    """مقابل KeyLease في العامل: المفتاح واسمه ورقم الحجز في العملية الأمامية."""
+
+    def __init__(self, lease_id, key, estimated_tokens, label):
+        self.lease_id = lease_id
+        self.key = key
+        self.estimated_tokens = estimated_tokens
+        self.label = label
+        self.started = time.monotonic()
+
+
+class SharedKeyPool:
+    """
+    نفس واجهة KeyPool (acquire/acquire_async/release/stats) لكن الحصص والتبريد والطابور العادل
+    كلها في العملية الأمامية، فلا يتجاوز مجموع العمال حصة أي مفتاح.
+    كل استدعاء يمر عبر اتصال بالعملية الأمامية، لذلك تُستخدم نسخ async (في مجمع خيوط) من حلقة asyncio.
+    """
+
+    def __init__(self, address, authkey, max_waiters=64, max_calls=8):
+        _KeyPoolClient.register("key_pool")
+        manager = _KeyPoolClient(address=address, authkey=authkey)
+        manager.connect()
+        self._service = manager.key_pool()  # الـ proxy يفتح اتصالاً لكل خيط
+        # الانتظار في طابور المفاتيح يحجز خيطاً، فله مجمع خاص حتى لا يستهلك مجمع asyncio الافتراضي
+        self._waiters = ThreadPoolExecutor(max_workers=max_waiters, thread_name_prefix="key-pool-client")
+        # الاستدعاءات السريعة (release/try_acquire) في مجمع منفصل: لا تنتظر خلف acquire عالق، ولا توقف حلقة asyncio
+        self._calls = ThreadPoolExecutor(max_workers=max_calls, thread_name_prefix="key-pool-call")
+
+    def acquire(self, estimated_tokens=1000, timeout=None):
+        return RemoteKeyLease(*self._service.acquire(estimated_tokens, timeout))
+
+    def try_acquire(self, estimated_tokens=1000, exclude=()):
+        result = self._service.try_acquire(estimated_tokens, tuple(exclude))
+        return RemoteKeyLease(*result) if result is not None else None
+
+    async def acquire_async(self, estimated_tokens=1000, timeout=None):
+        future = asyncio.get_running_loop().run_in_executor(self._waiters, self.acquire, estimated_tokens, timeout)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # الطلب أُلغي أثناء الانتظار: المفتاح الذي سيُحجز لاحقاً يُعاد فوراً
+            future.add_done_callback(lambda f: f.cancelled() or f.exception() or self._calls.submit(self.release, f.result()))
+            raise
+
+    async def try_acquire_async(self, estimated_tokens=1000, exclude=()):
+        return await asyncio.get_running_loop().run_in_executor(self._calls, self.try_acquire, estimated_tokens, exclude)
+
+    def release(self, lease, status_code=None, failed=False, tokens_used=None, retry_after=None):
+        self._service.release(lease.lease_id, status_code, failed, tokens_used, retry_after)
+
+    async def release_async(self, lease, status_code=None, failed=False, tokens_used=None, retry_after=None):
+        await asyncio.get_running_loop().run_in_executor(self._calls, self.release, lease, status_code, failed,
+                                                         tokens_used, retry_after)
+
+    def stats(self, window=300):
+        return self._service.stats(window)
+
+
+# ==============================================================================
+#  العمال وتوزيع التحديثات
+# ==============================================================================
+class WorkerRejected(RuntimeError):
+    """العامل استقبل التحديث ورد بخطأ HTTP (وليس خطأ اتصال)."""
+
+
+class WorkerProcess:
+    """
+    عامل واحد: عملية main.py تستقبل التحديثات على منفذ محلي، وخيط يرسلها إليها بالترتيب
+    (تحديثات نفس المحادثة تصل لنفس العامل وبنفس ترتيب وصولها من تليجرام).
+    أخطاء الاتصال (العامل يبدأ أو أُعيد تشغيله) تُعاد بلا حد، أما التحديث الذي يرفضه العامل بخطأ HTTP
+    فيُعاد max_rejections مرة فقط ثم يُتجاهل (حتى لا يوقف تحديث واحد كل محادثات العامل).
+    """
+
+    def __init__(self, index, port, script, env, secret, max_rejections=3):
+        self.index = index
+        self.port = port
+        self.script = script
+        self.env = env
+        self.secret = secret
+        self.process = None
+        self.queue = queue.Queue()
+        self.max_rejections = max_rejections
+        self.forwarded = 0
+        self.dropped = 0
+        self.restarts = 0
+        self._connection = None
+        self._thread = threading.Thread(target=self._forward_loop, name=f"worker-{index}-forward", daemon=True)
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, self.script], env=self.env)
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _post(self, body):
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        self._connection.request("POST", WORKER_UPDATE_PATH, body=body, headers={
+            "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": self.secret})
+        response = self._connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise WorkerRejected(f"رد العامل {self.index}: {response.status}")
+
+    def _forward_loop(self):
+        while True:
+            body = self.queue.get()
+            delay = 0.2
+            rejections = 0
+            while True:
+                try:
+                    self._post(body)
+                    self.forwarded += 1
+                    break
+                except WorkerRejected as e:
+                    rejections += 1
+                    if rejections >= self.max_rejections:
+                        self.dropped += 1
+                        print(f"❌ تم تجاهل تحديث بعد {rejections} محاولات رفضها العامل: {e}")
+                        break
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+                except Exception:
+                    # العامل يبدأ أو أُعيد تشغيله: نعيد نفس التحديث (لا نتخطاه حتى لا يختل الترتيب)
+                    if self._connection is not None:
+                        self._connection.close()
+                        self._connection = None
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class WorkerPool:
+    """
+    يشغل count عاملاً (main.py مع BOT_WORKER_INDEX) ويعيد تشغيل من يتوقف منهم،
+    ويوجه كل تحديث للعامل shard_for(chat_id).
+    """
+
+    def __init__(self, count, script, base_port, secret, env):
+        self.workers = []
+        for index in range(count):
+            worker_env = dict(env, BOT_WORKER_INDEX=str(index), BOT_WORKER_PORT=str(base_port + index))
+            self.workers.append(WorkerProcess(index, base_port + index, script, worker_env, secret))
+        self.routed = 0
+
+    def start(self, check_interval=2.0):
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self._supervise, args=(check_interval,), name="worker-supervisor", daemon=True).start()
+        print(f"🧵 تم تشغيل {len(self.workers)} عمال على المنافذ {self.workers[0].port}-{self.workers[-1].port}.")
+
+    def _supervise(self, interval):
+        while True:
+            time.sleep(interval)
+            for worker in self.workers:
+                if worker.process is not None and not worker.alive():
+                    print(f"⚠️ العامل {worker.index} توقف (رمز الخروج {worker.process.returncode})، جاري إعادة تشغيله...")
+                    worker.restarts += 1
+                    worker.start()
+
+    def route(self, update_json):
+        """توجيه تحديث (نص JSON أو dict) للعامل المسؤول عن محادثته. سريعة: الإرسال يتم في الخلفية."""
+        update = json.loads(update_json) if isinstance(update_json, (str, bytes)) else update_json
+        worker = self.workers[shard_for(update_chat_id(update), len(self.workers))]
+        worker.queue.put(json.dumps(update, ensure_ascii=False).encode("utf-8"))
+        self.routed += 1
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def stats(self):
+        return [{"index": w.index, "alive": w.alive(), "queued": w.queue.qsize(), "forwarded": w.forwarded,
+                 "dropped": w.dropped, "restarts": w.restarts} for w in self.workers]
+
+
+def poll_updates(fetch, on_update):
+    """
+    Long polling في العملية الأمامية: fetch(offset) ترجع التحديثات الخام (dict) التي تُسلم لـ on_update
+    بدون معالجتها هنا، ثم يُؤكد استلامها لتليجرام (offset) في الطلب التالي.
+    """
+    offset = None
+    while True:
+        try:
+            updates = fetch(offset)
+        except Exception as e:
+            print(f"خطأ في جلب التحديثات من تليجرام: {e}")
+            time.sleep(3)
+            continue
+        for update in updates:
+            on_update(update)
+            offset = update["update_id"] + 1
+
+
+def worker_environment():
+    """نسخة من متغيرات البيئة لتمريرها للعمال (بدون متغيرات العامل نفسه)."""
+    return {k: v for k, v in os.environ.items() if not k.startswith("BOT_WORKER_")}